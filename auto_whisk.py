@@ -11,14 +11,23 @@ Author: Enhanced by Claude based on Duck Martians' original work
 """
 
 import sys
+
+# Headless batch mode / benchmarks: dispatch before PySide6 is imported
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'run':
+    from whisk_cli import main
+    sys.exit(main(sys.argv[1:]))
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'bench':
+    from whisk_bench import main
+    sys.exit(main(sys.argv[1:]))
+
 import json
-import requests
 import base64
 import os
 import time
-import re
 import queue
-import random
+import sqlite3
+import hashlib
+import threading
 from datetime import datetime
 from PySide6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, 
@@ -26,20 +35,34 @@ from PySide6.QtWidgets import (
     QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, 
     QProgressBar, QGroupBox, QSplitter, QCheckBox, QDialog, QScrollArea, 
     QSizePolicy, QStyle, QSpinBox, QFrame, QGridLayout, QToolButton, 
-    QInputDialog, QTextEdit
+    QInputDialog, QTextEdit, QListWidget, QListWidgetItem
 )
 from PySide6.QtGui import (
     QPixmap, QImage, QColor, QDesktopServices, QFont, QIcon, QPalette, 
-    QPainter, QResizeEvent, QTextCursor
+    QPainter, QResizeEvent, QTextCursor, QImageReader
 )
 from PySide6.QtCore import Qt, Signal, QThread, QUrl, QSize, QObject, QTimer
+from concurrent.futures import ThreadPoolExecutor
+
+from whisk_core import (
+    APP_VERSION, APP_DIR, AUTH_FILE, RATIO_DATA,
+    DEFAULT_CONCURRENCY, MAX_CONCURRENCY, UPLOAD_CONCURRENCY,
+    ReferenceIndex, get_selection_cache, make_generation_task, iter_generation_tasks,
+    MATCH_WHOLE_WORDS, MATCH_LOCALE, SEMANTIC_MATCH,
+    make_model_settings,
+    fetch_access_token, upload_image_static,
+    get_http_client, GenerationEngine, JobJournal, ReferenceLibrary
+)
 
 # ==================== CONFIGURATION ====================
-APP_VERSION = 'v8.6.0 FIXED FINAL'
-USER_AGENT_STR = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36'
-API_AUTH_SESSION = 'https://labs.google/fx/api/auth/session'
 AUTHOR_API_URL = 'https://gist.githubusercontent.com/duckmartians/51788b5bc97bc83152b08a9886b834e1/raw/info.json'
 
+# Reference slot thumbnails (decoded off the GUI thread, cached on disk)
+THUMB_SIZE = (264, 150)
+THUMB_DIR = os.path.join(APP_DIR, 'thumbs')
+THUMB_CACHE_MAX = 500
+TABLE_FILL_BATCH = 25  # result rows given widgets per event-loop turn
+
 def resource_path(relative_path):
     """Get absolute path to resource, works for dev and for PyInstaller"""
     try:
@@ -50,25 +73,6 @@ def resource_path(relative_path):
 
 ICON_FILE = resource_path('icon.ico')
 
-# App data directory
-APP_NAME = 'AutoWhisk'
-if sys.platform == 'win32':
-    app_data_dir = os.getenv('APPDATA') or os.path.expanduser('~\\AppData\\Roaming')
-elif sys.platform == 'darwin':
-    app_data_dir = os.path.expanduser('~/Library/Application Support')
-else:
-    app_data_dir = os.path.expanduser('~/.local/share')
-
-APP_DIR = os.path.join(app_data_dir, APP_NAME)
-os.makedirs(APP_DIR, exist_ok=True)
-AUTH_FILE = os.path.join(APP_DIR, 'auth_session_final.json')
-
-RATIO_DATA = [
-    ('ratio_landscape', 'IMAGE_ASPECT_RATIO_LANDSCAPE'),
-    ('ratio_portrait', 'IMAGE_ASPECT_RATIO_PORTRAIT'),
-    ('ratio_square', 'IMAGE_ASPECT_RATIO_SQUARE')
-]
-
 # ==================== TRANSLATIONS ====================
 TRANSLATIONS = {
     'en': {
@@ -83,6 +87,8 @@ TRANSLATIONS = {
         'grp_config': 'Configuration & Prompts',
         'lbl_ratio': 'Aspect Ratio:',
         'lbl_num_images': 'Image Count:',
+        'lbl_concurrency': 'Parallel Requests:',
+        'lbl_per_request': 'Images per Request:',
         'lbl_prompts': 'Prompts (one per line):',
         'placeholder_prompts': 'Enter your prompts here, one per line...',
         'btn_ref': 'Reference Images',
@@ -107,6 +113,16 @@ TRANSLATIONS = {
         'btn_add_scene': '+ Add Scene',
         'btn_upload_analyze': 'Upload & Analyze All',
         'btn_save_caption': 'Save All Metadata',
+        'btn_library': 'Library...',
+        'chk_eager_upload': 'Upload as soon as an image is selected',
+        'chk_match_words': 'Whole words only',
+        'chk_semantic_match': 'Match word forms (castles → castle)',
+        'lbl_match_locale': 'Matching language:',
+        'match_locale_default': 'Default',
+        'library_title': 'Reference Library',
+        'library_search': 'Search name or tag...',
+        'library_all': 'All categories',
+        'btn_add_selected': 'Add Selected',
         'btn_ok': 'Done',
         'lbl_click_to_select': 'Click to select image',
         'lbl_name': 'Name:',
@@ -114,13 +130,17 @@ TRANSLATIONS = {
         'lbl_caption': 'Caption:',
         'placeholder_name': 'e.g., John',
         'placeholder_tags': 'e.g., man, hero, brown-hair',
-        'placeholder_caption': 'AI will generate caption...',
+        'placeholder_caption': 'AI will generate caption (or type your own)...',
         'msg_uploading_3dot': 'Uploading...',
         'msg_upload_error_prefix': 'Error: ',
         'status_idle': 'Ready',
         'status_running': 'Running...',
         'status_done': '✓ Complete',
         'status_error': '✗ Error',
+        'lbl_rate': 'Rate: {rate:.2f} req/s · {limit} in flight',
+        'circuit_open': '⚠ Endpoint down - all workers paused for {secs:.0f}s',
+        'resume_title': 'Resume job',
+        'resume_job': 'An unfinished run of these prompts was found ({done}/{total} images done).\n\nResume and generate only the missing images?',
         'tooltip_delete': 'Delete this image',
         'tooltip_retry': 'Retry this row',
         'tooltip_folder': 'Open output folder',
@@ -144,6 +164,8 @@ TRANSLATIONS = {
         'grp_config': 'Yapılandırma ve Promptlar',
         'lbl_ratio': 'Görsel Oranı:',
         'lbl_num_images': 'Görsel Sayısı:',
+        'lbl_concurrency': 'Paralel İstek:',
+        'lbl_per_request': 'İstek Başına Görsel:',
         'lbl_prompts': 'Promptlar (satır başına bir tane):',
         'placeholder_prompts': 'Promptlarınızı buraya girin, her satıra bir tane...',
         'btn_ref': 'Referans Görselleri',
@@ -168,6 +190,16 @@ TRANSLATIONS = {
         'btn_add_scene': '+ Sahne Ekle',
         'btn_upload_analyze': 'Tümünü Yükle ve Analiz Et',
         'btn_save_caption': 'Tüm Meta Verileri Kaydet',
+        'btn_library': 'Kütüphane...',
+        'chk_eager_upload': 'Görsel seçilince hemen yükle',
+        'chk_match_words': 'Yalnızca tam kelimeler',
+        'chk_semantic_match': 'Kelime çekimlerini eşleştir (kediler → kedi)',
+        'lbl_match_locale': 'Eşleştirme dili:',
+        'match_locale_default': 'Varsayılan',
+        'library_title': 'Referans Kütüphanesi',
+        'library_search': 'Ad veya etiket ara...',
+        'library_all': 'Tüm kategoriler',
+        'btn_add_selected': 'Seçilenleri Ekle',
         'btn_ok': 'Tamam',
         'lbl_click_to_select': 'Görsel seçmek için tıklayın',
         'lbl_name': 'İsim:',
@@ -175,13 +207,17 @@ TRANSLATIONS = {
         'lbl_caption': 'Açıklama:',
         'placeholder_name': 'örn: Ahmet',
         'placeholder_tags': 'örn: adam, kahraman, kahverengi-saç',
-        'placeholder_caption': 'AI açıklama oluşturacak...',
+        'placeholder_caption': 'AI açıklama oluşturacak (veya kendiniz yazın)...',
         'msg_uploading_3dot': 'Yükleniyor...',
         'msg_upload_error_prefix': 'Hata: ',
         'status_idle': 'Hazır',
         'status_running': 'Çalışıyor...',
         'status_done': '✓ Tamamlandı',
         'status_error': '✗ Hata',
+        'lbl_rate': 'Hız: {rate:.2f} istek/sn · {limit} paralel',
+        'circuit_open': '⚠ Sunucu yanıt vermiyor - tüm işler {secs:.0f} sn bekliyor',
+        'resume_title': 'İşe devam et',
+        'resume_job': 'Bu promptların yarım kalmış bir çalışması bulundu ({done}/{total} görsel hazır).\n\nDevam edip yalnızca eksik görseller üretilsin mi?',
         'tooltip_delete': 'Bu görseli sil',
         'tooltip_retry': 'Bu satırı tekrar dene',
         'tooltip_folder': 'Çıktı klasörünü aç',
@@ -205,6 +241,8 @@ TRANSLATIONS = {
         'grp_config': 'Cấu hình & Prompts',
         'lbl_ratio': 'Tỉ lệ ảnh:',
         'lbl_num_images': 'Số lượng:',
+        'lbl_concurrency': 'Song song:',
+        'lbl_per_request': 'Ảnh mỗi yêu cầu:',
         'lbl_prompts': 'Prompts (mỗi dòng một prompt):',
         'placeholder_prompts': 'Nhập prompts ở đây, mỗi dòng một cái...',
         'btn_ref': 'Ảnh Tham khảo',
@@ -229,6 +267,16 @@ TRANSLATIONS = {
         'btn_add_scene': '+ Thêm Cảnh',
         'btn_upload_analyze': 'Tải lên & Phân tích',
         'btn_save_caption': 'Lưu Tất cả',
+        'btn_library': 'Thư viện...',
+        'chk_eager_upload': 'Tải lên ngay khi chọn ảnh',
+        'chk_match_words': 'Chỉ khớp nguyên từ',
+        'chk_semantic_match': 'Khớp biến thể của từ (castles → castle)',
+        'lbl_match_locale': 'Ngôn ngữ khớp:',
+        'match_locale_default': 'Mặc định',
+        'library_title': 'Thư viện tham chiếu',
+        'library_search': 'Tìm theo tên hoặc thẻ...',
+        'library_all': 'Tất cả danh mục',
+        'btn_add_selected': 'Thêm mục đã chọn',
         'btn_ok': 'Xong',
         'lbl_click_to_select': 'Nhấp để chọn ảnh',
         'lbl_name': 'Tên:',
@@ -236,13 +284,17 @@ TRANSLATIONS = {
         'lbl_caption': 'Mô tả:',
         'placeholder_name': 'vd: John',
         'placeholder_tags': 'vd: man, hero, brown-hair',
-        'placeholder_caption': 'AI sẽ tạo mô tả...',
+        'placeholder_caption': 'AI sẽ tạo mô tả (hoặc tự nhập)...',
         'msg_uploading_3dot': 'Đang tải lên...',
         'msg_upload_error_prefix': 'Lỗi: ',
         'status_idle': 'Sẵn sàng',
         'status_running': 'Đang chạy...',
         'status_done': '✓ Hoàn thành',
         'status_error': '✗ Lỗi',
+        'lbl_rate': 'Tốc độ: {rate:.2f} req/s · {limit} song song',
+        'circuit_open': '⚠ Máy chủ lỗi - tạm dừng {secs:.0f} giây',
+        'resume_title': 'Tiếp tục công việc',
+        'resume_job': 'Tìm thấy lần chạy chưa xong của các prompt này ({done}/{total} ảnh đã xong).\n\nTiếp tục và chỉ tạo các ảnh còn thiếu?',
         'tooltip_delete': 'Xóa',
         'tooltip_retry': 'Thử lại',
         'tooltip_folder': 'Mở thư mục',
@@ -360,288 +412,6 @@ QMessageBox QPushButton:pressed { background-color: #1f618d; }
 '''
 
 
-# ==================== SMART FILTERING FUNCTIONS ====================
-
-def extract_important_words(text):
-    """Extract important keywords from text for matching"""
-    if not text:
-        return []
-    
-    # Common stopwords (Turkish + English)
-    stopwords_tr = {
-        've', 'bir', 'bu', 'ile', 'için', 'de', 'da', 'mi', 'mı', 
-        'mu', 'mü', 'gibi', 'daha', 'çok', 'en', 'olan', 'olarak',
-        'var', 'yok', 'şey', 'şu', 'o', 'bu'
-    }
-    stopwords_en = {
-        'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 
-        'to', 'for', 'of', 'with', 'by', 'from', 'as', 'is', 'was',
-        'are', 'were', 'be', 'been', 'being', 'have', 'has', 'had',
-        'do', 'does', 'did', 'will', 'would', 'should', 'could',
-        'may', 'might', 'can', 'this', 'that', 'these', 'those'
-    }
-    
-    stopwords = stopwords_tr | stopwords_en
-    
-    # Remove punctuation and split
-    text_clean = re.sub(r'[^\w\s-]', ' ', text.lower())
-    words = text_clean.split()
-    
-    # Filter: length > 3 and not stopword
-    important = [w for w in words if len(w) > 3 and w not in stopwords]
-    
-    return important[:10]  # Return first 10 important words
-
-
-def calculate_match_score(prompt, ref):
-    """
-    Calculate how well a reference matches the prompt
-    
-    FIXED: Style uses caption only (no name/tags)
-    
-    Scoring:
-    - Name exact match: +10
-    - Tag exact match: +5 per tag
-    - Caption important word match: +1 per word
-    """
-    score = 0
-    prompt_lower = prompt.lower()
-    
-    # === STYLE: Caption only (NO name/tags) ===
-    if ref.get('category') == 'MEDIA_CATEGORY_STYLE':
-        if ref.get('caption'):
-            important_words = extract_important_words(ref['caption'])
-            for word in important_words:
-                if word in prompt_lower:
-                    score += 1
-        return score  # Early return for style
-    
-    # Name match (highest priority)
-    if ref.get('name'):
-        name_lower = ref['name'].strip().lower()
-        if name_lower and name_lower in prompt_lower:
-            score += 10
-    
-    # Tags match
-    if ref.get('tags'):
-        tags = [t.strip().lower() for t in ref['tags'].split(',') if t.strip()]
-        for tag in tags:
-            if tag in prompt_lower:
-                score += 5
-    
-    # Caption match (important words only)
-    if ref.get('caption'):
-        important_words = extract_important_words(ref['caption'])
-        for word in important_words:
-            if word in prompt_lower:
-                score += 1
-    
-    return score
-
-
-def smart_filter_references(prompt, all_refs):
-    """
-    Smart filtering: Select most relevant references based on prompt
-    
-    Rules:
-    1. SUBJECTS with names mentioned in prompt → Include ALL matching names
-    2. SUBJECTS without name matches → Top 2 by score (if score > 0)
-    3. SCENES → Include if score > 0 (OR matching)
-    4. STYLES → Include if score > 0 (OR matching)
-    
-    Args:
-        prompt (str): User's generation prompt
-        all_refs (list): List of reference dicts with 'name', 'tags', 'caption', 'category'
-    
-    Returns:
-        list: Filtered list of references
-    """
-    if not all_refs:
-        return []
-    
-    # Separate by category
-    subjects = [r for r in all_refs if r.get('category') == 'MEDIA_CATEGORY_SUBJECT']
-    scenes = [r for r in all_refs if r.get('category') == 'MEDIA_CATEGORY_SCENE']
-    styles = [r for r in all_refs if r.get('category') == 'MEDIA_CATEGORY_STYLE']
-    
-    filtered = []
-    
-    # ===== SUBJECTS FILTERING =====
-    if subjects:
-        # Check for name matches first
-        named_matches = []
-        for ref in subjects:
-            name = ref.get('name', '').strip()
-            if name and name.lower() in prompt.lower():
-                named_matches.append(ref)
-        
-        if named_matches:
-            # Use ALL named matches (no limit when names are explicitly mentioned)
-            filtered.extend(named_matches)
-        else:
-            # No name matches → score all subjects and take top 2
-            scored = [(calculate_match_score(prompt, r), r) for r in subjects]
-            scored.sort(reverse=True, key=lambda x: x[0])
-            
-            # Take top 2 subjects with score > 0
-            for score, ref in scored[:2]:
-                if score > 0:
-                    filtered.append(ref)
-    
-    # ===== SCENES FILTERING (ONLY if match!) =====
-    for ref in scenes:
-        score = calculate_match_score(prompt, ref)
-        if score > 0:  # Only include matching scenes
-            filtered.append(ref)
-            name = ref.get('name', 'Unnamed')
-            print(f"[FILTER] ✓ Scene ({score}): {name}")
-    
-    # ===== STYLES FILTERING (OR matching) =====
-    for ref in styles:
-        if calculate_match_score(prompt, ref) > 0:
-            filtered.append(ref)
-    
-    return filtered
-
-
-# ==================== UTILITY FUNCTIONS ====================
-
-def parse_cookie_input(raw_input):
-    """Parse cookie from various input formats"""
-    raw_input = raw_input.strip()
-    if not raw_input:
-        return ''
-    
-    # JSON format (array or single object)
-    if raw_input.startswith('[') or raw_input.startswith('{'):
-        try:
-            data = json.loads(raw_input)
-            if isinstance(data, dict):
-                data = [data]
-            
-            cookies = []
-            for c in data:
-                if 'name' in c and 'value' in c:
-                    cookies.append(f"{c['name']}={c['value']}")
-            
-            if cookies:
-                return '; '.join(cookies)
-        except:
-            pass
-    
-    # Direct JWT token format
-    if raw_input.startswith('ey'):
-        return f'__Secure-next-auth.session-token={raw_input}'
-    
-    # Already formatted cookie string
-    return raw_input
-
-
-def upload_image_static(path, category, cookie_str, token):
-    """
-    Upload image to Google Labs and get caption + media ID
-    
-    Returns:
-        tuple: (media_id, caption, error_msg)
-    """
-    if not os.path.exists(path):
-        return (None, '', 'File not found')
-    
-    try:
-        # Read and encode image
-        with open(path, 'rb') as f:
-            b64 = base64.b64encode(f.read()).decode('utf-8')
-        
-        ext = os.path.splitext(path)[1].lower()
-        mime = 'image/png' if '.png' in ext else 'image/webp' if '.webp' in ext else 'image/jpeg'
-        data_uri = f'data:{mime};base64,{b64}'
-        
-        sess_id = f';{int(datetime.now().timestamp() * 1000)}'
-        common_headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json',
-            'User-Agent': USER_AGENT_STR,
-            'Origin': 'https://labs.google',
-            'Referer': 'https://labs.google/fx/tools/whisk',
-            'Authority': 'labs.google',
-            'Cookie': parse_cookie_input(cookie_str)
-        }
-        
-        # Step 1: Get caption
-        caption_text = ''
-        try:
-            cap_payload = {
-                'json': {
-                    'clientContext': {
-                        'workflowId': 'be042ce0-b110-463c-be13-5d23c5bf82b3',
-                        'sessionId': sess_id
-                    },
-                    'captionInput': {
-                        'candidatesCount': 1,
-                        'mediaInput': {
-                            'mediaCategory': category,
-                            'rawBytes': data_uri
-                        }
-                    }
-                }
-            }
-            
-            r_cap = requests.post(
-                'https://labs.google/fx/api/trpc/backbone.captionImage',
-                headers=common_headers,
-                json=cap_payload,
-                timeout=40
-            )
-            
-            if r_cap.status_code == 200:
-                cap_data = r_cap.json()
-                try:
-                    candidates = cap_data.get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('candidates', [])
-                    if candidates:
-                        caption_text = candidates[0].get('output', '')
-                except:
-                    pass
-        except Exception:
-            pass  # Caption is optional
-        
-        # Step 2: Upload media
-        up_payload = {
-            'json': {
-                'clientContext': {
-                    'workflowId': 'be042ce0-b110-463c-be13-5d23c5bf82b3',
-                    'sessionId': sess_id
-                },
-                'uploadMediaInput': {
-                    'mediaCategory': category,
-                    'rawBytes': data_uri
-                }
-            }
-        }
-        
-        r_up = requests.post(
-            'https://labs.google/fx/api/trpc/backbone.uploadImage',
-            headers=common_headers,
-            json=up_payload,
-            timeout=60
-        )
-        
-        if r_up.status_code != 200:
-            return (None, '', f'Upload HTTP {r_up.status_code}')
-        
-        up_data = r_up.json()
-        try:
-            mid = up_data.get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('uploadMediaGenerationId')
-            if mid:
-                return (mid, caption_text if caption_text else 'No caption generated', None)
-        except Exception as e:
-            return (None, '', f'Parse error: {str(e)}')
-        
-        return (None, '', 'No Media ID returned')
-        
-    except Exception as e:
-        return (None, '', str(e))
-
-
 # ==================== QTHREAD WORKERS ====================
 
 class AuthorInfoLoader(QThread):
@@ -650,7 +420,7 @@ class AuthorInfoLoader(QThread):
     
     def run(self):
         try:
-            resp = requests.get(AUTHOR_API_URL, timeout=5)
+            resp = get_http_client().get(AUTHOR_API_URL, timeout=5)
             if resp.status_code == 200:
                 self.data_loaded.emit(resp.json())
         except:
@@ -666,68 +436,149 @@ class CookieValidatorWorker(QThread):
         self.cookie_str = cookie_str
     
     def run(self):
-        full_cookie = parse_cookie_input(self.cookie_str)
-        
-        try:
-            # Get session token
-            headers = {
-                'Cookie': full_cookie,
-                'Content-Type': 'text/plain;charset=UTF-8',
-                'User-Agent': USER_AGENT_STR
-            }
-            
-            resp = requests.get(API_AUTH_SESSION, headers=headers, timeout=20)
-            if resp.status_code != 200:
-                self.result_signal.emit(False, '', 0)
-                return
-            
-            data = resp.json()
-            token = data.get('access_token') or data.get('accessToken')
-            
-            if not token:
-                self.result_signal.emit(False, '', 0)
-                return
-            
-            # Validate token and get expiry
-            try:
-                r = requests.get(
-                    f'https://www.googleapis.com/oauth2/v3/tokeninfo?access_token={token}',
-                    timeout=10
-                )
-                if r.status_code == 200:
-                    exp = int(r.json().get('exp', 0))
-                    self.result_signal.emit(True, token, exp)
-                else:
-                    self.result_signal.emit(True, token, 0)
-            except:
-                # Token valid but can't get expiry
-                self.result_signal.emit(True, token, 0)
-                
-        except Exception:
+        token, exp = fetch_access_token(self.cookie_str)
+        if token:
+            self.result_signal.emit(True, token, exp)
+        else:
             self.result_signal.emit(False, '', 0)
 
 
-class UploadWorker(QThread):
-    """Upload single reference image"""
-    finished = Signal(str, str, str)  # path, media_id, caption
-    error = Signal(str, str)  # path, error_msg
+class UploadDispatcher(QObject):
+    """
+    Shared, bounded executor for reference uploads from the dialog
     
-    def __init__(self, path, category, cookie, token):
-        super().__init__()
-        self.path = path
-        self.category = category
-        self.cookie = cookie
-        self.token = token
+    At most UPLOAD_CONCURRENCY uploads run at once; one job per slot, tagged
+    with the path the slot had when it was submitted. Cancelling a slot (or
+    giving it another image) drops a queued upload, or discards the result
+    of one already in flight.
+    """
+    finished = Signal(object, str, str, str)  # slot, path, media_id, caption
+    error = Signal(object, str, str)  # slot, path, error_msg
+    idle = Signal()
     
-    def run(self):
-        mid, cap, err = upload_image_static(
-            self.path, self.category, self.cookie, self.token
-        )
-        
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY,
+                                       thread_name_prefix='whisk-ref-upload')
+        self.jobs = {}  # slot -> (path, Future) of its current job only
+    
+    def submit(self, slot, path, category, cookie, token, caption=None):
+        job = self.jobs.get(slot)
+        if job and job[0] == path:
+            return
+        if job:
+            job[1].cancel()
+        future = self.pool.submit(upload_image_static, path, category, cookie, token,
+                                  caption=caption)
+        self.jobs[slot] = (path, future)
+        future.add_done_callback(lambda f, s=slot, p=path: self._done(s, p, f))
+    
+    def _done(self, slot, path, future):
+        # Pool thread: signals are queued to the GUI thread
+        if future.cancelled():
+            return
+        mid, cap, err = future.result()
         if mid:
-            self.finished.emit(self.path, mid, cap)
+            self.finished.emit(slot, path, mid, cap)
         else:
-            self.error.emit(self.path, err or 'Unknown error')
+            self.error.emit(slot, path, err or 'Unknown error')
+    
+    def on_result(self, slot, path):
+        """GUI thread: True if the result is from the slot's current job"""
+        job = self.jobs.get(slot)
+        if not job or job[0] != path:
+            return False
+        del self.jobs[slot]
+        if not self.jobs:
+            self.idle.emit()
+        return path == slot.image_path
+    
+    def cancel(self, slot):
+        job = self.jobs.pop(slot, None)
+        if job is not None:
+            job[1].cancel()
+            if not self.jobs:
+                self.idle.emit()
+    
+    def is_busy(self):
+        return bool(self.jobs)
+    
+    def shutdown(self):
+        """Drop queued uploads without waiting for the ones in flight"""
+        self.jobs.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ThumbnailLoader(QObject):
+    """
+    Decode reference thumbnails on a worker thread
+    
+    QImageReader decodes straight to the thumbnail size (JPEG skips most
+    of the full-resolution work), and results are cached in THUMB_DIR keyed
+    by path + mtime + size, so reopening a reference set is instant. The
+    cache is pruned at startup and again whenever new thumbnails push it
+    past THUMB_CACHE_MAX.
+    """
+    ready = Signal(str, QImage)  # path, thumbnail
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='whisk-thumb')
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        self._cache_lock = threading.Lock()
+        self._cache_count = self.prune_cache()
+    
+    @staticmethod
+    def prune_cache():
+        """Keep only the THUMB_CACHE_MAX most recently written thumbnails; returns the count kept"""
+        try:
+            files = [os.path.join(THUMB_DIR, f) for f in os.listdir(THUMB_DIR)]
+            files.sort(key=os.path.getmtime, reverse=True)
+            for f in files[THUMB_CACHE_MAX:]:
+                os.remove(f)
+            return min(len(files), THUMB_CACHE_MAX)
+        except OSError:
+            return 0
+    
+    def _written(self):
+        """Count a new cache file; prune once the cap is exceeded"""
+        with self._cache_lock:
+            self._cache_count += 1
+            if self._cache_count > THUMB_CACHE_MAX:
+                self._cache_count = self.prune_cache()
+    
+    @staticmethod
+    def cache_path(path):
+        st = os.stat(path)
+        key = f'{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{THUMB_SIZE[0]}x{THUMB_SIZE[1]}'
+        return os.path.join(THUMB_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.png')
+    
+    def request(self, path):
+        self.pool.submit(self._load, path)
+    
+    def _load(self, path):
+        try:
+            cached = self.cache_path(path)
+        except OSError:
+            return
+        
+        image = QImage(cached) if os.path.exists(cached) else QImage()
+        if image.isNull():
+            reader = QImageReader(path)
+            reader.setAutoTransform(True)
+            size = reader.size()
+            if size.isValid():
+                reader.setScaledSize(size.scaled(QSize(*THUMB_SIZE), Qt.KeepAspectRatio))
+            image = reader.read()
+            if image.isNull():
+                return
+            if image.width() > THUMB_SIZE[0] or image.height() > THUMB_SIZE[1]:
+                # Formats without a reported size were read in full
+                image = image.scaled(QSize(*THUMB_SIZE), Qt.KeepAspectRatio,
+                                     Qt.SmoothTransformation)
+            if image.save(cached, 'PNG'):
+                self._written()
+        self.ready.emit(path, image)
 
 
 class QueueWorker(QThread):
@@ -737,9 +588,13 @@ class QueueWorker(QThread):
     task_failed = Signal(int, int, str)  # row_idx, col_idx, error_msg
     all_done = Signal()
     reference_uploaded = Signal(str, str, str)  # path, media_id, caption
+    reference_failed = Signal(str, str)  # path, error_msg
+    rate_changed = Signal(float, int)  # requests_per_sec, in_flight_limit
+    circuit_changed = Signal(str, float)  # state, cooldown_secs
     
     def __init__(self, task_queue, model_settings, output_dir, num_images, 
-                 ref_data_list, cookie_str, token):
+                 ref_data_list, cookie_str, token, max_workers=DEFAULT_CONCURRENCY,
+                 candidates_per_request=1, journal=None, job_id=None):
         super().__init__()
         self.task_queue = task_queue
         self.model_settings = model_settings
@@ -750,215 +605,101 @@ class QueueWorker(QThread):
         self.access_token = token
         self.is_running = True
         self.is_paused = False
-        self.prepared_refs = []
-        self.prep_error = None
-    
-    def get_safe_filename(self, prompt):
-        """Create safe filename from prompt"""
-        slug = re.sub(r'[^\w\s-]', '', prompt).strip().replace(' ', '_')
-        slug = re.sub(r'_+', '_', slug)[:40]
-        return slug
-    
-    def prepare_references(self):
-        """Upload any non-uploaded references"""
-        final_list = []
-        
-        for item in self.ref_data_list:
-            if not self.is_running:
-                return False
-            
-            if item['type'] == 'uploaded':
-                # Already uploaded
-                final_list.append({
-                    'caption': item['caption'],
-                    'mediaInput': {
-                        'mediaCategory': item['category'],
-                        'mediaGenerationId': item['media_id']
-                    }
-                })
-            else:
-                # Need to upload
-                mid, cap, err = upload_image_static(
-                    item['path'], item['category'],
-                    self.cookie_str, self.access_token
-                )
-                
-                if mid:
-                    self.reference_uploaded.emit(item['path'], mid, cap)
-                    final_list.append({
-                        'caption': cap,
-                        'mediaInput': {
-                            'mediaCategory': item['category'],
-                            'mediaGenerationId': mid
-                        }
-                    })
-                else:
-                    self.prep_error = f"Upload Fail {os.path.basename(item['path'])}: {err}"
-                    return False
-        
-        self.prepared_refs = final_list
-        return True
+        
+        # Signals are thread-safe, so pool threads can emit directly
+        self.engine = GenerationEngine(
+            task_queue, model_settings, output_dir, num_images,
+            cookie_str, token, max_workers=max_workers,
+            candidates_per_request=candidates_per_request,
+            journal=journal, job_id=job_id,
+            on_started=self.task_started.emit,
+            on_success=self.task_success.emit,
+            on_failed=self.task_failed.emit,
+            on_rate_changed=self.rate_changed.emit,
+            on_circuit_changed=self.circuit_changed.emit
+        )
     
     def run(self):
         """Main processing loop"""
-        # Prepare references if any
+        # References upload as rows that selected them come up; rows whose
+        # references are ready (or that need none) generate meanwhile
         if self.ref_data_list:
-            success = self.prepare_references()
-            if not success:
-                # Fail first task and exit
-                try:
-                    r, _ = self.task_queue.get_nowait()
-                    self.task_failed.emit(r, 0, self.prep_error or 'Ref prep error')
-                    self.task_queue.task_done()
-                except:
-                    pass
-                self.all_done.emit()
-                return
+            self.engine.upload_on_demand(
+                self.ref_data_list,
+                on_uploaded=self.reference_uploaded.emit,
+                on_failed=self.reference_failed.emit
+            )
         
-        # Process queue
-        while self.is_running:
-            # Wait if paused
-            while self.is_paused and self.is_running:
-                time.sleep(0.5)
-            
-            # Get task
-            try:
-                item = self.task_queue.get(timeout=1)
-                
-                # Support both formats
-                if len(item) == 3:
-                    row_idx, prompt, indices_to_process = item
-                else:
-                    row_idx, prompt = item
-                    indices_to_process = range(self.num_images)
-                    
-            except queue.Empty:
-                continue
-            
-            # Process each image in row
-            for i in indices_to_process:
-                if not self.is_running:
-                    break
-                
-                while self.is_paused and self.is_running:
-                    time.sleep(0.5)
-                
-                col_idx = i + 1
-                self.task_started.emit(row_idx, f'{i+1}/{self.num_images}')
-                
-                try:
-                    # Prepare request
-                    sess_id = f';{int(datetime.now().timestamp() * 1000)}'
-                    clean_cookie = parse_cookie_input(self.cookie_str)
-                    
-                    req_headers = {
-                        'Authorization': f'Bearer {self.access_token}',
-                        'Content-Type': 'application/json',
-                        'User-Agent': USER_AGENT_STR,
-                        'Origin': 'https://labs.google',
-                        'Referer': 'https://labs.google/fx/tools/whisk',
-                        'Authority': 'labs.google',
-                        'Accept-Language': 'en-US,en;q=0.9',
-                        'X-Kl-Ajax-Request': 'Ajax_Request',
-                        'Cookie': clean_cookie
-                    }
-                    
-                    random_seed = random.randint(1, 2147483647)
-                    
-                    # Choose endpoint and payload based on references
-                    if self.prepared_refs:
-                        target_url = 'https://aisandbox-pa.googleapis.com/v1/whisk:runImageRecipe'
-                        settings = self.model_settings.copy()
-                        
-                        # Model selection based on ref count
-                        if len(self.prepared_refs) == 1:
-                            settings['imageModel'] = 'GEM_PIX'
-                        else:
-                            settings['imageModel'] = 'R2I'
-                        
-                        payload = {
-                            'clientContext': {
-                                'workflowId': '',
-                                'tool': 'BACKBONE',
-                                'sessionId': sess_id
-                            },
-                            'imageModelSettings': settings,
-                            'userInstruction': prompt,
-                            'recipeMediaInputs': self.prepared_refs,
-                            'seed': random_seed
-                        }
-                    else:
-                        target_url = 'https://aisandbox-pa.googleapis.com/v1/whisk:generateImage'
-                        payload = {
-                            'clientContext': {
-                                'workflowId': '',
-                                'tool': 'BACKBONE',
-                                'sessionId': sess_id
-                            },
-                            'imageModelSettings': self.model_settings,
-                            'prompt': prompt,
-                            'mediaCategory': 'MEDIA_CATEGORY_BOARD',
-                            'seed': random_seed
-                        }
-                    
-                    # Make request
-                    resp = requests.post(
-                        target_url,
-                        headers=req_headers,
-                        json=payload,
-                        timeout=60
-                    )
-                    
-                    if not self.is_running:
-                        self.task_queue.task_done()
-                        break
-                    
-                    # Handle response
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        panels = data.get('imagePanels', [])
-                        
-                        if panels:
-                            gen_imgs = panels[0].get('generatedImages', [])
-                            if gen_imgs:
-                                b64_img = gen_imgs[0].get('encodedImage', '')
-                                
-                                # Save image
-                                safe_name = self.get_safe_filename(prompt)
-                                ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-                                fn = f'{row_idx+1}_{safe_name}_{ts}_{i+1}.jpg'
-                                fpath = os.path.join(self.output_dir, fn)
-                                
-                                with open(fpath, 'wb') as f:
-                                    f.write(base64.b64decode(b64_img))
-                                
-                                self.task_success.emit(row_idx, col_idx, fpath)
-                            else:
-                                self.task_failed.emit(row_idx, col_idx, 'No image data')
-                        else:
-                            self.task_failed.emit(row_idx, col_idx, 'No panels')
-                    else:
-                        self.task_failed.emit(row_idx, col_idx, f'HTTP {resp.status_code}')
-                    
-                except Exception as e:
-                    self.task_failed.emit(row_idx, col_idx, str(e)[:30])
-                
-                # Delay between images
-                time.sleep(2)
-            
-            self.task_queue.task_done()
-            time.sleep(1)
+        # Process queue with N requests in flight
+        if self.is_running:
+            self.engine.run()
         
         self.all_done.emit()
     
     def stop(self):
         self.is_running = False
+        self.engine.stop()
     
     def pause(self):
         self.is_paused = True
+        self.engine.pause()
     
     def resume(self):
         self.is_paused = False
+        self.engine.resume()
+
+
+class JobPreparer(QThread):
+    """
+    Smart-filters a job's prompts off the GUI thread and streams the tasks
+    into the queue, so the first rows generate while the rest are prepared
+    """
+    PREVIEW_ROWS = 3
+    
+    def __init__(self, task_queue, prompts, missing, ref_data, match_options=None, library=None):
+        super().__init__()
+        self.task_queue = task_queue
+        self.prompts = prompts
+        self.missing = missing
+        self.ref_data = ref_data
+        self.match_options = match_options or {}  # ReferenceIndex keyword arguments
+        self.library = library  # keeps the keyword vectors semantic matching computes
+    
+    def run(self):
+        if self.library and self.ref_data and self.match_options.get('semantic'):
+            self.library.store_embeddings(self.ref_data, self.match_options.get('locale'))
+        ref_index = ReferenceIndex(self.ref_data, **self.match_options) if self.ref_data else None
+        cache = get_selection_cache() if ref_index else None
+        by_path = {ref['path']: ref for ref in self.ref_data}
+        
+        if self.ref_data:
+            print(f"\n{'='*60}")
+            print("SMART FILTERING PREVIEW")
+            print(f"{'='*60}")
+            print(f"Total references loaded: {len(self.ref_data)}\n")
+        
+        # Each task carries the refs smart filtering picked for its prompt
+        for n, task in enumerate(iter_generation_tasks(self.prompts, self.missing,
+                                                       ref_index, cache), 1):
+            if self.isInterruptionRequested():
+                break
+            self.task_queue.put(task)
+            if not self.ref_data:
+                continue
+            row_idx, prompt, _, ref_paths = task
+            if n <= self.PREVIEW_ROWS:
+                print(f"{n}. Prompt: \"{prompt[:50]}...\"" if len(prompt) > 50 else f"{n}. Prompt: \"{prompt}\"")
+                print(f"   → {len(ref_paths)}/{len(self.ref_data)} references selected")
+                for path in ref_paths:
+                    ref = by_path[path]
+                    name = ref.get('name', 'Unnamed')
+                    cat = ref.get('category', '').replace('MEDIA_CATEGORY_', '')
+                    print(f"      • {cat}: {name}")
+                print()
+            print(f"Row {row_idx+1}: {len(ref_paths)} refs selected for \"{prompt[:40]}...\"")
+    
+    def stop(self):
+        self.requestInterruption()
 
 
 # ==================== CUSTOM WIDGETS ====================
@@ -985,6 +726,7 @@ class ReferenceImageSlot(QFrame):
         self.category_api_val = category_api_val
         self.image_path = None
         self.media_id = None
+        self.embedding = None  # stored library embedding (validated on use)
         self.removable = removable
         
         self.setProperty('class', 'ref-slot')
@@ -1026,7 +768,7 @@ class ReferenceImageSlot(QFrame):
             self.txt_name.setStyleSheet('font-size: 11px; padding: 4px;')
             layout.addWidget(lbl_name)
             layout.addWidget(self.txt_name)
-        
+            
             # Tags input
             lbl_tags = QLabel(TRANSLATIONS[lang]['lbl_tags'])
             lbl_tags.setStyleSheet('font-size: 11px; font-weight: bold; color: #555;')
@@ -1106,68 +848,111 @@ class ReferenceImageSlot(QFrame):
     
     def set_image(self, path):
         """Set image from file path"""
+        if self.parent_dialog:
+            self.parent_dialog.uploads.cancel(self)  # upload of the previous image
         self.image_path = path
         self.media_id = None
+        self.embedding = None
         
-        pixmap = QPixmap(path)
-        self.lbl_thumb.setPixmap(
-            pixmap.scaled(264, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        )
+        # Thumbnail arrives asynchronously (set_thumbnail)
+        self.lbl_thumb.clear()
+        if self.parent_dialog:
+            self.parent_dialog.thumbnails.request(path)
+        else:
+            self.set_thumbnail(path, QImage(path).scaled(
+                QSize(*THUMB_SIZE), Qt.KeepAspectRatio, Qt.SmoothTransformation
+            ))
         
         self.lbl_icon.setVisible(False)
         self.lbl_thumb.setVisible(True)
         self.btn_clear.setVisible(True)
         
-        # Reset caption
+        # Reset caption (a caption typed before upload skips AI captioning)
         self.txt_caption.setPlainText('')
-        self.txt_caption.setReadOnly(True)
+        self.txt_caption.setReadOnly(False)
+        self.txt_caption.setToolTip('')
+        lang = self.parent_dialog.lang if self.parent_dialog else 'en'
+        self.txt_caption.setPlaceholderText(TRANSLATIONS[lang]['placeholder_caption'])
         self.txt_caption.setStyleSheet(
             'font-size: 11px; border: 1px solid #ddd; background: #f9f9f9;'
         )
         
         self.image_changed.emit()
+        if self.parent_dialog:
+            self.parent_dialog.image_selected(self)
+    
+    def set_thumbnail(self, path, image):
+        """Show a decoded thumbnail if it is still this slot's image"""
+        if path == self.image_path:
+            self.lbl_thumb.setPixmap(QPixmap.fromImage(image))
     
     def set_upload_start(self):
         """Show uploading status"""
         lang = self.parent_dialog.lang if self.parent_dialog else 'en'
         self.txt_caption.setPlaceholderText(TRANSLATIONS[lang]['msg_uploading_3dot'])
     
-    def set_upload_success(self, path, mid, caption):
-        """Handle successful upload"""
+    def set_upload_success(self, path, mid, caption, record=True):
+        """Handle successful upload (record=False: restored, not a new upload)"""
         if path != self.image_path:
             return
         
         self.media_id = mid
         self.txt_caption.setPlainText(caption)
         self.txt_caption.setReadOnly(False)
+        self.txt_caption.setToolTip('')
         self.txt_caption.setStyleSheet(
             'font-size: 11px; border: 1px solid #27ae60; background: #fff;'
         )
         
+        library = self.parent_dialog.library if self.parent_dialog else None
+        if library and record:
+            library.record_upload(path, mid, caption)
+        
         self.image_changed.emit()
     
     def set_upload_error(self, err):
-        """Handle upload error"""
+        """Handle upload error (keeps any caption the user typed)"""
         lang = self.parent_dialog.lang if self.parent_dialog else 'en'
-        self.txt_caption.setPlainText(
-            f"{TRANSLATIONS[lang]['msg_upload_error_prefix']}{err}"
+        msg = f"{TRANSLATIONS[lang]['msg_upload_error_prefix']}{err}"
+        self.txt_caption.setPlaceholderText(msg)
+        self.txt_caption.setToolTip(msg)
+        self.txt_caption.setStyleSheet(
+            'font-size: 11px; border: 1px solid #e74c3c; background: #fff;'
         )
         self.media_id = None
         self.image_changed.emit()
     
     def clear_image(self):
         """Clear selected image"""
+        if self.parent_dialog:
+            self.parent_dialog.uploads.cancel(self)
         self.image_path = None
         self.media_id = None
+        self.embedding = None
         self.lbl_thumb.clear()
         self.lbl_thumb.setVisible(False)
         self.btn_clear.setVisible(False)
         self.txt_caption.clear()
+        lang = self.parent_dialog.lang if self.parent_dialog else 'en'
+        self.txt_caption.setPlaceholderText(TRANSLATIONS[lang]['placeholder_caption'])
         self.txt_name.clear()
         self.txt_tags.clear()
         self.lbl_icon.setVisible(True)
         self.image_changed.emit()
     
+    def load_reference(self, ref):
+        """Fill the slot from a get_reference_data-style dict (e.g. from the library)"""
+        self.set_image(ref['path'])
+        self.embedding = ref.get('embedding')
+        if self.txt_name is not None:
+            self.txt_name.setText(ref.get('name', ''))
+            self.txt_tags.setText(ref.get('tags', ''))
+        if ref.get('media_id'):
+            self.set_upload_success(ref['path'], ref['media_id'], ref.get('caption', ''),
+                                    record=False)
+        else:
+            self.txt_caption.setPlainText(ref.get('caption', ''))
+    
     def get_data(self):
         """Get slot data for processing"""
         if not self.image_path:
@@ -1180,6 +965,7 @@ class ReferenceImageSlot(QFrame):
             'name': self.txt_name.text().strip() if self.txt_name else '',
             'tags': self.txt_tags.text().strip() if self.txt_tags else '',
             'caption': self.txt_caption.toPlainText().strip(),
+            'embedding': self.embedding,
             'type': 'uploaded' if self.media_id else 'pending'
         }
 
@@ -1187,12 +973,29 @@ class ReferenceImageSlot(QFrame):
 class ReferenceDialog(QDialog):
     """Enhanced reference dialog with dynamic slots and smart filtering"""
     images_updated = Signal(int)  # total_count
+    match_options_changed = Signal()
+    
+    # (label, locale) for the matching language box; None label = translated default
+    MATCH_LOCALE_ITEMS = [(None, None), ('Türkçe', 'tr'), ('Tiếng Việt', 'vi')]
     
     def __init__(self, lang='en', parent=None, cookie='', token=''):
         super().__init__(parent)
         self.lang = lang
         self.cookie = cookie
         self.token = token
+        try:
+            self.library = ReferenceLibrary()
+        except sqlite3.Error as e:
+            print(f'[LIBRARY] Disabled: {e}')
+            self.library = None
+        
+        self.thumbnails = ThumbnailLoader(self)
+        self.thumbnails.ready.connect(self.on_thumbnail_ready)
+        
+        self.uploads = UploadDispatcher(self)
+        self.uploads.finished.connect(self.on_upload_finished)
+        self.uploads.error.connect(self.on_upload_error)
+        self.uploads.idle.connect(self.check_upload_complete)
         
         self.setWindowTitle(TRANSLATIONS[lang]['ref_dialog_title'])
         self.setModal(True)
@@ -1340,6 +1143,21 @@ class ReferenceDialog(QDialog):
         )
         self.btn_ok.clicked.connect(self.accept)
         
+        self.btn_library = QPushButton(TRANSLATIONS[lang]['btn_library'])
+        self.btn_library.setStyleSheet(
+            'background-color: #8e44ad; color: white; '
+            'padding: 10px 20px; font-weight: bold; border-radius: 5px;'
+        )
+        self.btn_library.clicked.connect(self.open_library)
+        self.btn_library.setEnabled(self.library is not None)
+        
+        self.chk_eager = QCheckBox(TRANSLATIONS[lang]['chk_eager_upload'])
+        self.chk_eager.setStyleSheet('font-size: 11px;')
+        
+        btn_layout.addWidget(self.chk_eager)
+        btn_layout.addSpacing(10)
+        btn_layout.addWidget(self.btn_library)
+        btn_layout.addSpacing(10)
         btn_layout.addWidget(self.btn_upload)
         btn_layout.addSpacing(10)
         btn_layout.addWidget(self.btn_save_cap)
@@ -1349,6 +1167,33 @@ class ReferenceDialog(QDialog):
         
         main_layout.addLayout(btn_layout)
         
+        # Smart filter options (applied when a job's references are selected)
+        match_layout = QHBoxLayout()
+        self.chk_match_words = QCheckBox(TRANSLATIONS[lang]['chk_match_words'])
+        self.chk_match_words.setChecked(MATCH_WHOLE_WORDS)
+        self.chk_semantic = QCheckBox(TRANSLATIONS[lang]['chk_semantic_match'])
+        self.chk_semantic.setChecked(SEMANTIC_MATCH)
+        self.lbl_match_locale = QLabel(TRANSLATIONS[lang]['lbl_match_locale'])
+        self.cbo_match_locale = QComboBox()
+        for text, locale in self.MATCH_LOCALE_ITEMS:
+            self.cbo_match_locale.addItem(text or TRANSLATIONS[lang]['match_locale_default'], locale)
+        self.cbo_match_locale.setCurrentIndex(max(0, self.cbo_match_locale.findData(MATCH_LOCALE)))
+        for widget in (self.chk_match_words, self.chk_semantic, self.lbl_match_locale):
+            widget.setStyleSheet('font-size: 11px;')
+        self.chk_match_words.toggled.connect(lambda _: self.match_options_changed.emit())
+        self.chk_semantic.toggled.connect(lambda _: self.match_options_changed.emit())
+        self.cbo_match_locale.currentIndexChanged.connect(lambda _: self.match_options_changed.emit())
+        
+        match_layout.addWidget(self.chk_match_words)
+        match_layout.addSpacing(10)
+        match_layout.addWidget(self.chk_semantic)
+        match_layout.addSpacing(10)
+        match_layout.addWidget(self.lbl_match_locale)
+        match_layout.addWidget(self.cbo_match_locale)
+        match_layout.addStretch()
+        
+        main_layout.addLayout(match_layout)
+        
         # Track slots
         self.subject_slots = []
         self.scene_slots = []
@@ -1377,6 +1222,7 @@ class ReferenceDialog(QDialog):
         """Remove a subject slot"""
         if slot in self.subject_slots:
             self.subject_slots.remove(slot)
+            self.uploads.cancel(slot)
             slot.deleteLater()
             self.notify_update()
     
@@ -1400,6 +1246,7 @@ class ReferenceDialog(QDialog):
         """Remove a scene slot"""
         if slot in self.scene_slots:
             self.scene_slots.remove(slot)
+            self.uploads.cancel(slot)
             slot.deleteLater()
             self.notify_update()
     
@@ -1426,51 +1273,105 @@ class ReferenceDialog(QDialog):
             )
             return
         
-        # Disable button
+        for slot in slots_to_upload:
+            self.queue_upload(slot)
+    
+    def queue_upload(self, slot):
+        """Queue a slot's image on the shared upload executor"""
+        if not slot.image_path or slot.media_id:
+            return
+        
+        # Disable button while anything is uploading
         self.btn_upload.setEnabled(False)
         self.btn_upload.setText('Uploading...')
         
-        self.upload_workers = []
-        
-        for slot in slots_to_upload:
-            slot.set_upload_start()
-            
-            worker = UploadWorker(
-                slot.image_path, slot.category_api_val,
-                self.cookie, self.token
-            )
-            worker.finished.connect(
-                lambda p, m, c, s=slot: s.set_upload_success(p, m, c)
-            )
-            worker.error.connect(
-                lambda p, e, s=slot: s.set_upload_error(e)
-            )
-            worker.finished.connect(self.check_upload_complete)
-            worker.error.connect(self.check_upload_complete)
-            
-            self.upload_workers.append(worker)
-            worker.start()
+        slot.set_upload_start()
+        self.uploads.submit(
+            slot, slot.image_path, slot.category_api_val,
+            self.cookie, self.token,
+            caption=slot.txt_caption.toPlainText().strip()
+        )
+    
+    def image_selected(self, slot):
+        """Eager mode: start uploading as soon as a slot gets an image"""
+        if self.chk_eager.isChecked() and self.token:
+            # After load_reference has filled caption/media ID
+            QTimer.singleShot(0, lambda: self.queue_upload(slot) if slot in self.get_all_slots() else None)
+    
+    def on_thumbnail_ready(self, path, image):
+        for slot in self.get_all_slots():
+            slot.set_thumbnail(path, image)
+    
+    def on_upload_finished(self, slot, path, media_id, caption):
+        if self.uploads.on_result(slot, path):
+            slot.set_upload_success(path, media_id, caption)
+    
+    def on_upload_error(self, slot, path, error_msg):
+        if self.uploads.on_result(slot, path):
+            slot.set_upload_error(error_msg)
     
     def check_upload_complete(self):
-        """Check if all uploads done"""
-        if all(not w.isRunning() for w in self.upload_workers):
+        """Re-enable the upload button once nothing is uploading"""
+        if not self.uploads.is_busy():
             self.btn_upload.setEnabled(True)
             self.btn_upload.setText(TRANSLATIONS[self.lang]['btn_upload_analyze'])
-            self.upload_workers.clear()
     
     def save_captions(self):
-        """Save all metadata (no re-upload)"""
-        count = 0
-        for slot in self.get_all_slots():
-            if slot.image_path:
-                # Metadata already in slot widgets
-                count += 1
+        """Save all metadata to the reference library (no re-upload)"""
+        data = self.get_reference_data()
+        count = len(data)
+        self.save_to_library(data)
         
         QMessageBox.information(
             self, 'Saved',
             f'Metadata saved for {count} image(s).'
         )
     
+    def save_to_library(self, data=None):
+        """Store the current references as the library's last set"""
+        if self.library:
+            self.library.save_set(ReferenceLibrary.LAST_SET,
+                                  self.get_reference_data() if data is None else data)
+    
+    def restore_last_set(self):
+        """Reload the references saved when the dialog was last closed"""
+        if self.library:
+            refs = [r for r in self.library.load_set(ReferenceLibrary.LAST_SET)
+                    if os.path.exists(r['path'])]
+            self.load_references(refs)
+    
+    def accept(self):
+        self.save_to_library()
+        super().accept()
+    
+    def free_slot(self, category):
+        """An empty slot for a category (adds one for subjects/scenes)"""
+        if category == 'MEDIA_CATEGORY_STYLE':
+            return self.style_slot
+        if category == 'MEDIA_CATEGORY_SCENE':
+            slots, add = self.scene_slots, self.add_scene_slot
+        else:
+            slots, add = self.subject_slots, self.add_subject_slot
+        for slot in slots:
+            if not slot.image_path:
+                return slot
+        add()
+        return slots[-1]
+    
+    def load_references(self, refs):
+        """Put references into slots, skipping ones already loaded"""
+        loaded = {s.image_path for s in self.get_all_slots() if s.image_path}
+        for ref in refs:
+            if ref['path'] not in loaded:
+                self.free_slot(ref['category']).load_reference(ref)
+                loaded.add(ref['path'])
+    
+    def open_library(self):
+        """Pick references from the library"""
+        dialog = LibraryDialog(self.library, self.lang, self)
+        if dialog.exec() == QDialog.Accepted:
+            self.load_references(dialog.selected_references())
+    
     def get_reference_data(self):
         """Get all reference data for generation"""
         data = []
@@ -1494,7 +1395,101 @@ class ReferenceDialog(QDialog):
         self.btn_add_scene.setText(TRANSLATIONS[lang]['btn_add_scene'])
         self.btn_upload.setText(TRANSLATIONS[lang]['btn_upload_analyze'])
         self.btn_save_cap.setText(TRANSLATIONS[lang]['btn_save_caption'])
+        self.btn_library.setText(TRANSLATIONS[lang]['btn_library'])
+        self.chk_eager.setText(TRANSLATIONS[lang]['chk_eager_upload'])
+        self.chk_match_words.setText(TRANSLATIONS[lang]['chk_match_words'])
+        self.chk_semantic.setText(TRANSLATIONS[lang]['chk_semantic_match'])
+        self.lbl_match_locale.setText(TRANSLATIONS[lang]['lbl_match_locale'])
+        self.cbo_match_locale.setItemText(0, TRANSLATIONS[lang]['match_locale_default'])
         self.btn_ok.setText(TRANSLATIONS[lang]['btn_ok'])
+    
+    def match_options(self):
+        """ReferenceIndex keyword arguments for the chosen matching settings"""
+        return {
+            'whole_words': self.chk_match_words.isChecked(),
+            'locale': self.cbo_match_locale.currentData(),
+            'semantic': self.chk_semantic.isChecked(),
+        }
+    
+    def set_match_options(self, options):
+        """Restore saved matching settings (unknown keys are ignored)"""
+        self.chk_match_words.setChecked(bool(options.get('whole_words', MATCH_WHOLE_WORDS)))
+        self.chk_semantic.setChecked(bool(options.get('semantic', SEMANTIC_MATCH)))
+        index = self.cbo_match_locale.findData(options.get('locale', MATCH_LOCALE))
+        self.cbo_match_locale.setCurrentIndex(max(0, index))
+
+
+class LibraryDialog(QDialog):
+    """Search the reference library and pick references to load"""
+    
+    CATEGORIES = [
+        ('cat_subject', 'MEDIA_CATEGORY_SUBJECT'),
+        ('cat_scene', 'MEDIA_CATEGORY_SCENE'),
+        ('cat_style', 'MEDIA_CATEGORY_STYLE')
+    ]
+    
+    def __init__(self, library, lang='en', parent=None):
+        super().__init__(parent)
+        self.library = library
+        
+        self.setWindowTitle(TRANSLATIONS[lang]['library_title'])
+        self.setModal(True)
+        self.resize(520, 600)
+        
+        layout = QVBoxLayout(self)
+        
+        filter_row = QHBoxLayout()
+        self.txt_search = QLineEdit()
+        self.txt_search.setPlaceholderText(TRANSLATIONS[lang]['library_search'])
+        self.txt_search.textChanged.connect(self.refresh)
+        self.cbo_category = QComboBox()
+        self.cbo_category.addItem(TRANSLATIONS[lang]['library_all'], None)
+        for key, val in self.CATEGORIES:
+            self.cbo_category.addItem(TRANSLATIONS[lang][key], val)
+        self.cbo_category.currentIndexChanged.connect(self.refresh)
+        filter_row.addWidget(self.txt_search, 1)
+        filter_row.addWidget(self.cbo_category)
+        layout.addLayout(filter_row)
+        
+        self.list_refs = QListWidget()
+        layout.addWidget(self.list_refs)
+        
+        btn_row = QHBoxLayout()
+        btn_row.addStretch()
+        btn_add = QPushButton(TRANSLATIONS[lang]['btn_add_selected'])
+        btn_add.setStyleSheet(
+            'background-color: #27ae60; color: white; '
+            'padding: 8px 20px; font-weight: bold; border-radius: 5px;'
+        )
+        btn_add.clicked.connect(self.accept)
+        btn_row.addWidget(btn_add)
+        layout.addLayout(btn_row)
+        
+        self.refresh()
+    
+    def refresh(self):
+        """Re-run the library query for the current filters"""
+        self.list_refs.clear()
+        refs = self.library.search(self.txt_search.text(), self.cbo_category.currentData())
+        for ref in refs:
+            label = ref['name'] or os.path.basename(ref['path'])
+            cat = ref['category'].replace('MEDIA_CATEGORY_', '').title()
+            if ref['tags']:
+                label += f"  [{ref['tags']}]"
+            item = QListWidgetItem(f'{cat}: {label}')
+            item.setToolTip(ref['path'])
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Unchecked)
+            item.setData(Qt.UserRole, ref)
+            self.list_refs.addItem(item)
+    
+    def selected_references(self):
+        refs = []
+        for i in range(self.list_refs.count()):
+            item = self.list_refs.item(i)
+            if item.checkState() == Qt.Checked and os.path.exists(item.data(Qt.UserRole)['path']):
+                refs.append(item.data(Qt.UserRole))
+        return refs
 
 
 # ==================== TABLE CELL WIDGETS ====================
@@ -1504,11 +1499,12 @@ class ImageCellWidget(QWidget):
     view_requested = Signal(str)
     delete_requested = Signal(str, str)
     
-    def __init__(self, image_path, lang_code='en', parent=None):
+    def __init__(self, image_path, lang_code='en', parent=None, lazy=False):
         super().__init__(parent)
         self.image_path = image_path
         self.lang_code = lang_code
-        self.original_pixmap = QPixmap(image_path)
+        # Lazy cells start empty and get a thumbnail through set_image()
+        self.original_pixmap = QPixmap() if lazy else QPixmap(image_path)
         
         # Clickable label
         self.label = ClickableLabel(self)
@@ -1553,6 +1549,10 @@ class ImageCellWidget(QWidget):
                 )
                 self.label.setPixmap(scaled)
     
+    def set_image(self, image):
+        self.original_pixmap = QPixmap.fromImage(image)
+        self.update_pixmap()
+    
     def update_tooltip(self, lang):
         self.lang_code = lang
         self.delete_button.setToolTip(TRANSLATIONS[lang]['tooltip_delete'])
@@ -1561,6 +1561,7 @@ class ImageCellWidget(QWidget):
 class PromptCellWidget(QWidget):
     """Editable prompt cell"""
     text_changed = Signal(str)
+    edit_icon = None  # decoded once, shared by every row
     
     def __init__(self, text='', parent=None):
         super().__init__(parent)
@@ -1574,10 +1575,11 @@ class PromptCellWidget(QWidget):
         
         # Edit button
         self.edit_button = QPushButton(self)
-        icon_data = b'PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHZpZXdCb3g9IjAgMCAyNCAyNCIgZmlsbD0ibm9uZSIgc3Ryb2tlPSJ3aGl0ZSIgc3Ryb2tlLXdpZHRoPSIyIiBzdHJva2UtbGluZWNhcD0icm91bmQiIHN0cm9rZS1saW5lam9pbj0icm91bmQiPjxwYXRoIGQ9Ik0xNyAzYTIuODI4IDIuODI4IDAgMSAxIDQgNEw3LjUgMjAuNSAyIDIybDEuNS01LjVMMTcgM3oiPjwvcGF0aD48L3N2Zz4='
-        img = QImage.fromData(base64.b64decode(icon_data))
-        pix = QPixmap.fromImage(img)
-        self.edit_button.setIcon(QIcon(pix))
+        if PromptCellWidget.edit_icon is None:
+            icon_data = b'PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHZpZXdCb3g9IjAgMCAyNCAyNCIgZmlsbD0ibm9uZSIgc3Ryb2tlPSJ3aGl0ZSIgc3Ryb2tlLXdpZHRoPSIyIiBzdHJva2UtbGluZWNhcD0icm91bmQiIHN0cm9rZS1saW5lam9pbj0icm91bmQiPjxwYXRoIGQ9Ik0xNyAzYTIuODI4IDIuODI4IDAgMSAxIDQgNEw3LjUgMjAuNSAyIDIybDEuNS01LjVMMTcgM3oiPjwvcGF0aD48L3N2Zz4='
+            img = QImage.fromData(base64.b64decode(icon_data))
+            PromptCellWidget.edit_icon = QIcon(QPixmap.fromImage(img))
+        self.edit_button.setIcon(PromptCellWidget.edit_icon)
         self.edit_button.setFixedSize(24, 24)
         self.edit_button.setStyleSheet(
             'background-color: rgba(52, 152, 219, 0.9); '
@@ -1688,10 +1690,22 @@ class BatchImageGenerator(QWidget):
         self.current_num_images = 1
         self.current_token = None
         self.token_exp_timestamp = 0
+        self.last_rate = (0.0, 0)
+        self.circuit_state = 'closed'
+        self.job_id = None
+        self.preparer = None
+        self.worker_done = False
+        try:
+            self.journal = JobJournal()
+        except sqlite3.Error as e:
+            print(f'[JOURNAL] Disabled: {e}')
+            self.journal = None
         
         # Reference dialog
         self.ref_dialog = ReferenceDialog(self.lang, self)
         self.ref_dialog.images_updated.connect(self.update_ref_btn_text)
+        self.ref_dialog.chk_eager.toggled.connect(self.save_eager_upload)
+        self.ref_dialog.match_options_changed.connect(self.save_match_options)
         
         # Timer for token display
         self.timer = QTimer(self)
@@ -1702,6 +1716,7 @@ class BatchImageGenerator(QWidget):
         
         # Load saved session
         self.load_last_session()
+        self.ref_dialog.restore_last_set()
         
         # Update language buttons
         self.update_language_button_styles()
@@ -1870,6 +1885,19 @@ class BatchImageGenerator(QWidget):
         self.cbo_num = QComboBox()
         self.cbo_num.addItems([str(i) for i in range(1, 5)])
         
+        self.lbl_conc = QLabel(TRANSLATIONS[self.lang]['lbl_concurrency'])
+        self.spn_conc = QSpinBox()
+        self.spn_conc.setRange(1, MAX_CONCURRENCY)
+        self.spn_conc.setValue(DEFAULT_CONCURRENCY)
+        
+        self.lbl_per_req = QLabel(TRANSLATIONS[self.lang]['lbl_per_request'])
+        self.spn_per_req = QSpinBox()
+        self.spn_per_req.setRange(1, 4)
+        self.spn_per_req.setValue(1)
+        self.spn_per_req.setToolTip(
+            'Map every image a response returns onto the row (fewer requests)'
+        )
+        
         row_opt = QHBoxLayout()
         vr = QVBoxLayout()
         vr.setSpacing(2)
@@ -1881,11 +1909,27 @@ class BatchImageGenerator(QWidget):
         vn.addWidget(self.lbl_num)
         vn.addWidget(self.cbo_num)
         
+        vc = QVBoxLayout()
+        vc.setSpacing(2)
+        vc.addWidget(self.lbl_conc)
+        vc.addWidget(self.spn_conc)
+        
+        vp = QVBoxLayout()
+        vp.setSpacing(2)
+        vp.addWidget(self.lbl_per_req)
+        vp.addWidget(self.spn_per_req)
+        
         row_opt.addLayout(vr, 1)
         row_opt.addSpacing(10)
         row_opt.addLayout(vn, 1)
         
+        row_net = QHBoxLayout()
+        row_net.addLayout(vc, 1)
+        row_net.addSpacing(10)
+        row_net.addLayout(vp, 1)
+        
         conf_layout.addLayout(row_opt)
+        conf_layout.addLayout(row_net)
         
         # Reference images button
         self.btn_ref = QPushButton(TRANSLATIONS[self.lang]['btn_ref'])
@@ -1977,10 +2021,15 @@ class BatchImageGenerator(QWidget):
         right_layout.setContentsMargins(0, 0, 0, 0)
         right_layout.setSpacing(8)
         
-        # Progress bar
+        # Progress bar + current request rate
+        progress_layout = QHBoxLayout()
         self.progress = QProgressBar()
         self.progress.setValue(0)
-        right_layout.addWidget(self.progress)
+        self.lbl_rate = QLabel('')
+        self.lbl_rate.setStyleSheet('color: #7f8c8d; font-size: 12px;')
+        progress_layout.addWidget(self.progress, 1)
+        progress_layout.addWidget(self.lbl_rate)
+        right_layout.addLayout(progress_layout)
         
         # Results table
         self.table = QTableWidget()
@@ -1988,6 +2037,18 @@ class BatchImageGenerator(QWidget):
         self.table.setSelectionMode(QAbstractItemView.NoSelection)
         self.table.verticalHeader().setVisible(False)
         self.table.horizontalHeader().setStretchLastSection(False)
+        self.table.verticalHeader().setDefaultSectionSize(100)
+        self.table_prompts = []
+        self.table_filled = 0
+        self.table_fill = QTimer(self)
+        self.table_fill.setInterval(0)
+        self.table_fill.timeout.connect(self.fill_table_rows)
+        
+        # Cells restored from the journal show scaled thumbnails, decoded off-thread
+        self.restored_cells = {}  # row -> [(col, path)] not given widgets yet
+        self.thumb_cells = {}  # path -> ImageCellWidget waiting for its thumbnail
+        self.result_thumbs = ThumbnailLoader(self)
+        self.result_thumbs.ready.connect(self.on_result_thumbnail)
         
         right_layout.addWidget(self.table)
         
@@ -2030,7 +2091,7 @@ class BatchImageGenerator(QWidget):
         
         main_layout.addWidget(splitter)
         self.setLayout(main_layout)
-
+    
     
     # ==================== MAIN WINDOW METHODS ====================
     
@@ -2069,6 +2130,8 @@ class BatchImageGenerator(QWidget):
         
         self.lbl_rat.setText(TRANSLATIONS[lang]['lbl_ratio'])
         self.lbl_num.setText(TRANSLATIONS[lang]['lbl_num_images'])
+        self.lbl_conc.setText(TRANSLATIONS[lang]['lbl_concurrency'])
+        self.lbl_per_req.setText(TRANSLATIONS[lang]['lbl_per_request'])
         
         # Update combo items
         for i, (k, v) in enumerate(RATIO_DATA):
@@ -2149,7 +2212,9 @@ class BatchImageGenerator(QWidget):
                         'cookie': self.txt_cookie.toPlainText().strip(),
                         'token': token,
                         'exp': exp_timestamp,
-                        'lang': self.lang
+                        'lang': self.lang,
+                        'eager_upload': self.ref_dialog.chk_eager.isChecked(),
+                        'match': self.ref_dialog.match_options()
                     }, f)
             except:
                 pass
@@ -2196,6 +2261,28 @@ class BatchImageGenerator(QWidget):
         """Open help URL"""
         QDesktopServices.openUrl(QUrl(TRANSLATIONS[self.lang]['help_url']))
     
+    def save_eager_upload(self, checked):
+        """Remember the eager-upload preference"""
+        try:
+            with open(AUTH_FILE, 'r') as f:
+                data = json.load(f)
+            data['eager_upload'] = checked
+            with open(AUTH_FILE, 'w') as f:
+                json.dump(data, f)
+        except:
+            pass
+    
+    def save_match_options(self):
+        """Remember the smart filter matching settings"""
+        try:
+            with open(AUTH_FILE, 'r') as f:
+                data = json.load(f)
+            data['match'] = self.ref_dialog.match_options()
+            with open(AUTH_FILE, 'w') as f:
+                json.dump(data, f)
+        except:
+            pass
+    
     def update_ref_btn_text(self, count):
         """Update reference button text with count"""
         base_text = TRANSLATIONS[self.lang]['btn_ref']
@@ -2259,31 +2346,49 @@ class BatchImageGenerator(QWidget):
         # Get settings
         aspect_ratio = self.cbo_rat.currentData()
         num_images = int(self.cbo_num.currentText())
+        max_workers = self.spn_conc.value()
+        candidates_per_request = self.spn_per_req.value()
         self.current_num_images = num_images
         
-        # Get reference data
+        # Get reference data (smart filtering runs in the JobPreparer)
         ref_data = self.ref_dialog.get_reference_data()
         
-        # Apply smart filtering for display
-        if ref_data:
-            print(f"\n{'='*60}")
-            print(f"SMART FILTERING PREVIEW")
-            print(f"{'='*60}")
-            print(f"Total references loaded: {len(ref_data)}\n")
-            
-            for i, prompt in enumerate(prompts[:3], 1):  # Show first 3
-                filtered = smart_filter_references(prompt, ref_data)
-                print(f"{i}. Prompt: \"{prompt[:50]}...\"" if len(prompt) > 50 else f"{i}. Prompt: \"{prompt}\"")
-                print(f"   → {len(filtered)}/{len(ref_data)} references selected")
-                for ref in filtered:
-                    name = ref.get('name', 'Unnamed')
-                    cat = ref.get('category', '').replace('MEDIA_CATEGORY_', '')
-                    print(f"      • {cat}: {name}")
-                print()
+        model_settings = make_model_settings(aspect_ratio)
         
         # Setup table
         self.setup_table(prompts, num_images)
         
+        # Resume an unfinished identical job (only its missing cells are queued)
+        missing = {row: None for row in range(len(prompts))}
+        self.job_id = None
+        if self.journal:
+            job_id = self.journal.find_resumable(
+                prompts, num_images, self.output_directory, model_settings
+            )
+            done = self.journal.done_cells(job_id) if job_id else []
+            if done and QMessageBox.question(
+                self, TRANSLATIONS[self.lang]['resume_title'],
+                TRANSLATIONS[self.lang]['resume_job'].format(
+                    done=len(done), total=len(prompts) * num_images
+                )
+            ) == QMessageBox.Yes:
+                self.journal.resume_job(job_id)
+                self.job_id = job_id
+                # Done cells are shown as their rows get widgets (no decoding here)
+                for row, i, path in done:
+                    self.restored_cells.setdefault(row, []).append((i + 1, path))
+                for row in range(self.table_filled):
+                    self.restore_row(row)
+                self.progress.setValue(len(done))
+                missing = self.journal.missing_cells(job_id)
+            else:
+                if job_id:
+                    # Declined (or nothing to keep): stop offering it
+                    self.journal.abandon_job(job_id)
+                self.job_id = self.journal.create_job(
+                    prompts, num_images, self.output_directory, model_settings
+                )
+        
         # Clear queue
         while not self.task_queue.empty():
             try:
@@ -2291,32 +2396,19 @@ class BatchImageGenerator(QWidget):
             except:
                 break
         
-        # Add tasks
-        for idx, prompt in enumerate(prompts):
-            # Apply smart filtering per prompt
-            if ref_data:
-                filtered_refs = smart_filter_references(prompt, ref_data)
-                print(f"Row {idx+1}: {len(filtered_refs)} refs selected for \"{prompt[:40]}...\"")
-            else:
-                filtered_refs = []
-            
-            # Store filtered refs for this prompt
-            self.task_queue.put((idx, prompt))
-        
-        # Create worker with ALL reference data (filtering happens per-prompt in worker)
-        model_settings = {
-            'imageModel': 'imagen-3.0-generate-001',
-            'aspectRatio': aspect_ratio
-        }
-        
+        # Create worker with ALL reference data (uploaded once, selected per row)
         self.worker = QueueWorker(
             self.task_queue,
             model_settings,
             self.output_directory,
             num_images,
-            ref_data,  # Pass all refs, worker will filter per-prompt
+            ref_data,  # Pass all refs, tasks carry the per-row selection
             self.txt_cookie.toPlainText().strip(),
-            self.current_token
+            self.current_token,
+            max_workers=max_workers,
+            candidates_per_request=candidates_per_request,
+            journal=self.journal,
+            job_id=self.job_id
         )
         
         # Connect signals
@@ -2324,9 +2416,20 @@ class BatchImageGenerator(QWidget):
         self.worker.task_success.connect(self.on_task_success)
         self.worker.task_failed.connect(self.on_task_failed)
         self.worker.all_done.connect(self.on_all_done)
-        
-        # Start
+        self.worker.reference_uploaded.connect(self.on_reference_uploaded)
+        self.worker.reference_failed.connect(self.on_reference_failed)
+        self.worker.rate_changed.connect(self.on_rate_changed)
+        self.worker.circuit_changed.connect(self.on_circuit_changed)
+        self.on_circuit_changed('closed', 0)
+        self.on_rate_changed(self.worker.engine.rate.rate, self.worker.engine.rate.limit)
+        
+        # Start; tasks stream in from the preparer as rows are filtered
+        self.worker_done = False
         self.worker.start()
+        self.preparer = JobPreparer(self.task_queue, prompts, missing, ref_data,
+                                    self.ref_dialog.match_options(), self.ref_dialog.library)
+        self.preparer.finished.connect(self.on_preparer_finished)
+        self.preparer.start()
         
         # Update UI
         self.btn_start.setVisible(False)
@@ -2335,11 +2438,15 @@ class BatchImageGenerator(QWidget):
         self.txt_prompts.setEnabled(False)
         self.cbo_rat.setEnabled(False)
         self.cbo_num.setEnabled(False)
+        self.spn_conc.setEnabled(False)
+        self.spn_per_req.setEnabled(False)
         self.btn_ref.setEnabled(False)
         self.btn_import.setEnabled(False)
     
     def stop_generation(self):
         """Stop generation"""
+        if self.preparer:
+            self.preparer.stop()
         if self.worker:
             self.worker.stop()
     
@@ -2370,16 +2477,28 @@ class BatchImageGenerator(QWidget):
         prompts_text = self.txt_prompts.toPlainText().strip()
         prompts = [p.strip() for p in prompts_text.split('\n') if p.strip()]
         
-        for row_idx in error_rows:
-            if row_idx < len(prompts):
-                self.task_queue.put((row_idx, prompts[row_idx]))
+        error_rows = [row_idx for row_idx in error_rows if row_idx < len(prompts)]
+        selections = ReferenceIndex(self.ref_dialog.get_reference_data(),
+                                    **self.ref_dialog.match_options()).select_all(
+            [prompts[row_idx] for row_idx in error_rows], cache=get_selection_cache()
+        )
+        missing = self.journal.missing_cells(self.job_id) if self.journal and self.job_id else {}
+        for row_idx, selected in zip(error_rows, selections):
+            # Only the row's failed images when the journal knows them
+            self.task_queue.put(
+                make_generation_task(row_idx, prompts[row_idx], None,
+                                     indices=missing.get(row_idx), selected=selected)
+            )
         
         # Hide retry button
         self.btn_retry_errors.setVisible(False)
     
     def setup_table(self, prompts, num_images):
-        """Setup results table"""
+        """Setup results table (row widgets are created in batches, see fill_table_rows)"""
+        self.table_fill.stop()
         self.table.clear()
+        self.restored_cells = {}
+        self.thumb_cells = {}
         self.table.setRowCount(len(prompts))
         self.table.setColumnCount(num_images + 2)  # Prompt + Images + Status
         
@@ -2392,26 +2511,79 @@ class BatchImageGenerator(QWidget):
             self.table.setColumnWidth(i, 120)
         self.table.setColumnWidth(num_images + 1, 150)
         
-        # Fill prompts
-        for row, prompt in enumerate(prompts):
-            prompt_widget = PromptCellWidget(prompt)
-            self.table.setCellWidget(row, 0, prompt_widget)
-            self.table.setRowHeight(row, 100)
-            
-            # Empty image cells
-            for col in range(1, num_images + 1):
-                self.table.setItem(row, col, QTableWidgetItem(''))
-            
-            # Status cell
-            status_widget = StatusCellWidget(self.lang)
-            status_widget.set_status(TRANSLATIONS[self.lang]['status_idle'], '#999')
-            self.table.setCellWidget(row, num_images + 1, status_widget)
+        # Fill prompts: the first batch now, the rest between events
+        self.table_prompts = prompts
+        self.table_filled = 0
+        self.fill_table_rows()
+        if self.table_filled < len(prompts):
+            self.table_fill.start()
         
         self.progress.setValue(0)
         self.progress.setMaximum(len(prompts) * num_images)
     
+    def fill_table_rows(self):
+        """Create the next TABLE_FILL_BATCH rows' widgets"""
+        end = min(self.table_filled + TABLE_FILL_BATCH, len(self.table_prompts))
+        for row in range(self.table_filled, end):
+            self.ensure_row(row)
+        self.table_filled = end
+        if end >= len(self.table_prompts):
+            self.table_fill.stop()
+    
+    def ensure_row(self, row):
+        """Create a row's prompt/status widgets unless they already exist"""
+        if row >= len(self.table_prompts) or self.table.cellWidget(row, 0):
+            return
+        num_images = self.current_num_images
+        prompt_widget = PromptCellWidget(self.table_prompts[row])
+        self.table.setCellWidget(row, 0, prompt_widget)
+        
+        # Empty image cells
+        for col in range(1, num_images + 1):
+            self.table.setItem(row, col, QTableWidgetItem(''))
+        
+        # Status cell
+        status_widget = StatusCellWidget(self.lang)
+        status_widget.set_status(TRANSLATIONS[self.lang]['status_idle'], '#999')
+        self.table.setCellWidget(row, num_images + 1, status_widget)
+        self.restore_row(row)
+    
+    def restore_row(self, row):
+        """Place a row's journaled images; thumbnails load on ThumbnailLoader"""
+        cells = self.restored_cells.pop(row, None)
+        if not cells:
+            return
+        for col, path in cells:
+            img_widget = ImageCellWidget(path, self.lang, lazy=True)
+            self.table.setCellWidget(row, col, img_widget)
+            self.thumb_cells[path] = img_widget
+            self.result_thumbs.request(path)
+        self.update_row_done(row)
+    
+    def on_result_thumbnail(self, path, image):
+        img_widget = self.thumb_cells.pop(path, None)
+        if img_widget is None:
+            return
+        try:
+            img_widget.set_image(image)
+        except RuntimeError:
+            pass  # Table was rebuilt meanwhile
+    
+    def update_row_done(self, row_idx):
+        """Show a row as done once every image column has an image"""
+        for c in range(1, self.current_num_images + 1):
+            if not self.table.cellWidget(row_idx, c):
+                return
+        status_widget = self.table.cellWidget(row_idx, self.current_num_images + 1)
+        if status_widget:
+            status_widget.set_status(
+                TRANSLATIONS[self.lang]['status_done'],
+                '#27ae60', False, True
+            )
+    
     def on_task_started(self, row_idx, status_text):
         """Handle task started"""
+        self.ensure_row(row_idx)
         status_widget = self.table.cellWidget(row_idx, self.current_num_images + 1)
         if status_widget:
             status_widget.set_status(
@@ -2421,6 +2593,8 @@ class BatchImageGenerator(QWidget):
     
     def on_task_success(self, row_idx, col_idx, file_path):
         """Handle task success"""
+        self.ensure_row(row_idx)
+        
         # Add image
         img_widget = ImageCellWidget(file_path, self.lang)
         self.table.setCellWidget(row_idx, col_idx, img_widget)
@@ -2430,22 +2604,12 @@ class BatchImageGenerator(QWidget):
         self.progress.setValue(current)
         
         # Check if row complete
-        all_done = True
-        for c in range(1, self.current_num_images + 1):
-            if not self.table.cellWidget(row_idx, c):
-                all_done = False
-                break
-        
-        if all_done:
-            status_widget = self.table.cellWidget(row_idx, self.current_num_images + 1)
-            if status_widget:
-                status_widget.set_status(
-                    TRANSLATIONS[self.lang]['status_done'],
-                    '#27ae60', False, True
-                )
+        self.update_row_done(row_idx)
     
     def on_task_failed(self, row_idx, col_idx, error_msg):
         """Handle task failure"""
+        self.ensure_row(row_idx)
+        
         # Update progress
         current = self.progress.value() + 1
         self.progress.setValue(current)
@@ -2459,14 +2623,63 @@ class BatchImageGenerator(QWidget):
             )
             self.btn_retry_errors.setVisible(True)
     
+    def on_reference_uploaded(self, path, media_id, caption):
+        """Keep the uploaded media ID on its slot so it is reused next run"""
+        for slot in self.ref_dialog.get_all_slots():
+            slot.set_upload_success(path, media_id, caption)
+    
+    def on_reference_failed(self, path, error_msg):
+        """Show a reference's upload error on its slot"""
+        for slot in self.ref_dialog.get_all_slots():
+            if slot.image_path == path:
+                slot.set_upload_error(error_msg)
+    
+    def on_rate_changed(self, rate, limit):
+        """Show the adaptive request rate"""
+        self.last_rate = (rate, limit)
+        if self.circuit_state == 'open':
+            return
+        self.lbl_rate.setText(
+            TRANSLATIONS[self.lang]['lbl_rate'].format(rate=rate, limit=limit)
+        )
+    
+    def on_circuit_changed(self, state, cooldown_secs):
+        """Show when the circuit breaker is holding all workers"""
+        self.circuit_state = state
+        if state == 'open':
+            self.lbl_rate.setStyleSheet('color: #e74c3c; font-size: 12px; font-weight: bold;')
+            self.lbl_rate.setText(
+                TRANSLATIONS[self.lang]['circuit_open'].format(secs=cooldown_secs)
+            )
+        else:
+            self.lbl_rate.setStyleSheet('color: #7f8c8d; font-size: 12px;')
+            self.on_rate_changed(*self.last_rate)
+    
     def on_all_done(self):
-        """Handle all tasks complete"""
+        """Handle all tasks complete (finished up once the preparer has stopped too)"""
+        self.worker_done = True
+        if self.preparer and not self.preparer.isFinished():
+            self.preparer.stop()  # on_preparer_finished takes it from there
+        else:
+            self.finish_job()
+    
+    def on_preparer_finished(self):
+        if self.worker_done:
+            self.finish_job()
+    
+    def finish_job(self):
+        """Close the job and re-enable the controls"""
+        self.worker_done = False
+        if self.journal and self.job_id:
+            self.journal.finish_job(self.job_id)
         self.btn_start.setVisible(True)
         self.btn_stop.setVisible(False)
         self.btn_pause.setVisible(False)
         self.txt_prompts.setEnabled(True)
         self.cbo_rat.setEnabled(True)
         self.cbo_num.setEnabled(True)
+        self.spn_conc.setEnabled(True)
+        self.spn_per_req.setEnabled(True)
         self.btn_ref.setEnabled(True)
         self.btn_import.setEnabled(True)
         
@@ -2486,9 +2699,12 @@ class BatchImageGenerator(QWidget):
                 self.current_token = data.get('token')
                 self.token_exp_timestamp = data.get('exp', 0)
                 
+                self.ref_dialog.set_match_options(data.get('match') or {})
+                
                 saved_lang = data.get('lang', 'en')
                 if saved_lang in TRANSLATIONS:
                     self.change_language(saved_lang)
+                self.ref_dialog.chk_eager.setChecked(data.get('eager_upload', False))
                 
                 if self.current_token:
                     self.ref_dialog.cookie = data.get('cookie', '')
@@ -2497,6 +2713,11 @@ class BatchImageGenerator(QWidget):
                     self.timer.start(60000)
         except:
             pass
+    
+    def closeEvent(self, event):
+        """Don't keep the process alive for reference uploads nobody will see"""
+        self.ref_dialog.uploads.shutdown()
+        super().closeEvent(event)
 
 
 # ==================== MAIN ====================
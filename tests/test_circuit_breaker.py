@@ -0,0 +1,45 @@
+import queue
+import threading
+
+from whisk_core import CircuitBreaker, GenerationEngine
+
+
+def half_open_breaker():
+    breaker = CircuitBreaker()
+    breaker.state = 'open'
+    breaker.open_until = 0.0
+    return breaker
+
+
+def test_probe_released_when_request_errors_before_sending(monkeypatch, tmp_path):
+    failed = []
+    engine = GenerationEngine(queue.Queue(), {}, str(tmp_path), 1, 'cookie', 'token',
+                              on_failed=lambda r, c, e: failed.append(e))
+    engine.breaker = half_open_breaker()
+    
+    def broken(*args, **kwargs):
+        raise RuntimeError('journal is gone')
+    
+    monkeypatch.setattr(engine, 'build_request', broken)
+    engine.generate_images(0, 'a castle', [0])
+    
+    assert failed == ['RuntimeError: journal is gone']
+    assert engine.breaker.state == 'half_open'
+    # The next worker gets to probe instead of waiting forever
+    timeout = threading.Timer(2, lambda: None)
+    timeout.start()
+    assert engine.breaker.wait_until_closed(timeout.is_alive)
+    timeout.cancel()
+
+
+def test_release_probe_only_frees_own_probe():
+    breaker = half_open_breaker()
+    assert breaker.wait_until_closed(lambda: True)
+    
+    other = threading.Thread(target=breaker.release_probe)
+    other.start()
+    other.join()
+    assert breaker._probe_in_flight
+    
+    breaker.release_probe()
+    assert not breaker._probe_in_flight
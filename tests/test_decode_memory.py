@@ -0,0 +1,12 @@
+from whisk_core import probe_decode_memory
+
+
+def test_streaming_decode_peak_is_bounded():
+    image_size = 8 * 1024 * 1024
+    peaks = probe_decode_memory(image_size)
+    
+    # Buffered decode holds the body, the parsed str and the decoded bytes
+    assert peaks['buffered'] > 2 * image_size
+    # Streaming holds a few chunks (plus writer queue), never the image
+    assert peaks['streaming'] < image_size / 2
+    assert peaks['streaming'] * 8 < peaks['buffered']
@@ -0,0 +1,36 @@
+import os
+
+from whisk_core import DiskWriter
+
+
+def test_commit_renames_and_failed_sync_cleans_up_once(tmp_path, monkeypatch):
+    writer = DiskWriter()
+    writer.start()
+    results = []
+    
+    good = writer.open(str(tmp_path / 'good.jpg'))
+    good.write(b'image')
+    good.commit(lambda path, err: results.append((path, err)))
+    writer.close()
+    assert results == [(str(tmp_path / 'good.jpg'), None)]
+    assert os.listdir(tmp_path) == ['good.jpg']
+    
+    discards = []
+    original = DiskWriter._discard
+    monkeypatch.setattr(DiskWriter, '_discard',
+                        lambda self, h: (discards.append(h.path), original(self, h)))
+    
+    def failing_replace(src, dst):
+        raise OSError('disk full')
+    
+    monkeypatch.setattr(os, 'replace', failing_replace)
+    writer = DiskWriter()
+    writer.start()
+    bad = writer.open(str(tmp_path / 'bad.jpg'))
+    bad.write(b'image')
+    bad.commit(lambda path, err: results.append((path, err)))
+    writer.close()
+    
+    assert results[-1] == (None, 'disk full')
+    assert discards == [str(tmp_path / 'bad.jpg')]
+    assert sorted(os.listdir(tmp_path)) == ['good.jpg']
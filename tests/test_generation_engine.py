@@ -0,0 +1,114 @@
+import base64
+import json
+import queue
+import threading
+
+from whisk_core import AdaptiveRateController, GenerationEngine
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+    
+    def __init__(self, count):
+        panel = {'generatedImages': [
+            {'encodedImage': base64.b64encode(b'img%d' % k * 64).decode()}
+            for k in range(count)
+        ]}
+        self.body = json.dumps({'imagePanels': [panel]}).encode()
+    
+    def iter_content(self, chunk_size=1):
+        for k in range(0, len(self.body), chunk_size):
+            yield self.body[k:k + chunk_size]
+    
+    def close(self):
+        pass
+
+
+class RejectedResponse:
+    status_code = 400
+    headers = {}
+    
+    def json(self):
+        return {'error': {'code': 400, 'status': 'INVALID_ARGUMENT',
+                          'message': 'Unknown name "candidatesCount"'}}
+    
+    def close(self):
+        pass
+
+
+class FakeBackend:
+    """Answers every request with `returns(asked)` images (0 = a 400 rejection)"""
+    
+    def __init__(self, returns):
+        self.returns = returns
+        self.asked = []
+        self.lock = threading.Lock()
+    
+    def post(self, url, headers=None, json=None, timeout=None, stream=False):
+        asked = json.get('candidatesCount', 1)
+        with self.lock:
+            self.asked.append(asked)
+        count = self.returns(asked)
+        return FakeResponse(count) if count else RejectedResponse()
+
+
+def run_engine(monkeypatch, tmp_path, backend, rows, num_images, per_request):
+    tasks = queue.Queue()
+    done, failed = [], []
+    engine = GenerationEngine(
+        tasks, {}, str(tmp_path), num_images, 'cookie', 'token',
+        max_workers=4, candidates_per_request=per_request,
+        on_success=lambda r, c, p: done.append((r, c)),
+        on_failed=lambda r, c, e: failed.append((r, c, e)),
+    )
+    engine.rate = AdaptiveRateController(4, initial_rate=AdaptiveRateController.MAX_RATE)
+    monkeypatch.setattr(engine.client, 'post', backend.post)
+    runner = threading.Thread(target=engine.run)
+    runner.start()
+    for row in range(rows):
+        tasks.put((row, f'prompt {row}'))
+    tasks.join()
+    engine.stop()
+    runner.join()
+    return engine, sorted(done), failed
+
+
+def test_request_asks_for_chunk_candidates(monkeypatch, tmp_path):
+    backend = FakeBackend(lambda asked: asked)
+    engine, done, failed = run_engine(monkeypatch, tmp_path, backend, rows=2, num_images=4, per_request=4)
+    
+    assert failed == []
+    assert done == [(r, c) for r in range(2) for c in range(1, 5)]
+    assert backend.asked == [4, 4]
+    assert engine.chunk_size() == 4
+
+
+def test_single_image_backend_fills_every_cell(monkeypatch, tmp_path):
+    backend = FakeBackend(lambda asked: 1)
+    engine, done, failed = run_engine(monkeypatch, tmp_path, backend, rows=2, num_images=3, per_request=3)
+    
+    assert failed == []
+    assert done == [(r, c) for r in range(2) for c in range(1, 4)]
+    assert len(backend.asked) == 6
+    # Later rows are split by what the backend actually returns
+    assert engine.images_per_response == 1
+    assert engine.chunk_size() == 1
+
+
+def test_single_candidate_payload_unchanged():
+    engine = GenerationEngine(queue.Queue(), {}, '.', 1, 'cookie', 'token')
+    _url, _headers, payload = engine.build_request('a castle')
+    assert 'candidatesCount' not in payload
+    _url, _headers, payload = engine.build_request('a castle', count=3)
+    assert payload['candidatesCount'] == 3
+
+
+def test_rejected_candidates_fall_back_to_one(monkeypatch, tmp_path):
+    backend = FakeBackend(lambda asked: 0 if asked > 1 else 1)
+    engine, done, failed = run_engine(monkeypatch, tmp_path, backend, rows=2, num_images=2, per_request=2)
+    
+    assert failed == []
+    assert done == [(r, c) for r in range(2) for c in range(1, 3)]
+    assert engine.candidates_per_request == 1
+    assert backend.asked.count(1) == 4
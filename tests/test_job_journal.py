@@ -0,0 +1,18 @@
+from whisk_core import JobJournal
+
+
+def test_declined_job_is_not_offered_again(tmp_path):
+    journal = JobJournal(str(tmp_path / 'jobs.sqlite3'))
+    args = (['a castle', 'a forest'], 2, str(tmp_path), {'imageModel': 'IMAGEN_3_5'})
+    
+    job_id = journal.create_job(*args)
+    assert journal.find_resumable(*args) == job_id
+    
+    journal.abandon_job(job_id)
+    assert journal.find_resumable(*args) is None
+    
+    # The replacement run is the one offered from now on
+    new_id = journal.create_job(*args)
+    assert journal.find_resumable(*args) == new_id
+    journal.finish_job(new_id)
+    assert journal.find_resumable(*args) == new_id
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_does_not_load_numpy_or_scipy():
+    code = ('import sys, whisk_core; '
+            "print('numpy' in sys.modules, 'scipy' in sys.modules)")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                         text=True, check=True, cwd=ROOT).stdout
+    assert out.split() == ['False', 'False']
+
+
+def test_select_all_falls_back_without_numpy():
+    code = '''
+import sys
+sys.modules['numpy'] = sys.modules['scipy'] = None
+import whisk_core
+refs = [
+    {'name': 'john', 'category': 'MEDIA_CATEGORY_SUBJECT', 'tags': 'man', 'caption': ''},
+    {'name': 'park', 'category': 'MEDIA_CATEGORY_SCENE', 'tags': 'park', 'caption': ''},
+]
+index = whisk_core.ReferenceIndex(refs, semantic=True)
+picked = index.select_all(['john in the park', 'a cat'])
+print([[ref['name'] for ref in row] for row in picked])
+'''
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                         text=True, check=True, cwd=ROOT).stdout
+    assert out.strip().splitlines()[-1] == "[['john', 'park'], []]"
+
+
+def test_library_save_does_not_load_numpy(tmp_path):
+    code = f'''
+import sys, whisk_core
+library = whisk_core.ReferenceLibrary({str(tmp_path / 'library.sqlite3')!r})
+library.save([{{'path': 'castle.png', 'category': 'MEDIA_CATEGORY_SCENE',
+               'name': 'Castle', 'tags': 'castle', 'caption': 'a stone castle'}}])
+library.record_upload('castle.png', 'media-1', 'a tall stone castle')
+print(len(library.search('cas')), 'numpy' in sys.modules)
+'''
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                         text=True, check=True, cwd=ROOT).stdout
+    assert out.split() == ['1', 'False']
@@ -0,0 +1,93 @@
+import pytest
+
+import whisk_core
+from whisk_core import SEMANTIC_THRESHOLD, ReferenceIndex, embed_word
+
+np = pytest.importorskip('numpy')
+
+# Labelled word pairs SEMANTIC_THRESHOLD is tuned on: suffix inflections
+# must match, words that merely look alike must not
+INFLECTIONS = [
+    ('castle', 'castles'), ('kedi', 'kediler'), ('forest', 'forests'),
+    ('ağaç', 'ağaçlar'), ('şehir', 'şehirde'), ('dragon', 'dragons'),
+    ('mountain', 'mountains'), ('knight', 'knights'), ('warrior', 'warriors'),
+    ('flower', 'flowers'), ('çiçek', 'çiçekler'), ('orman', 'ormanda'),
+    ('deniz', 'denizde'), ('princess', 'princesses'), ('horse', 'horses'),
+    ('painting', 'paintings'), ('köpek', 'köpekler'), ('cat', 'cats'),
+    ('tree', 'trees'), ('sword', 'swords'), ('kale', 'kalesi'),
+]
+LOOK_ALIKES = [
+    ('knight', 'night'), ('beach', 'bleach'), ('castle', 'cattle'),
+    ('house', 'mouse'), ('cat', 'hat'), ('light', 'night'), ('bear', 'pear'),
+    ('rain', 'train'), ('tree', 'three'), ('sea', 'tea'), ('forest', 'florist'),
+    ('dog', 'fog'), ('king', 'ring'), ('moon', 'noon'), ('gold', 'cold'),
+    ('war', 'wax'), ('ship', 'shop'), ('river', 'driver'), ('hill', 'mill'),
+    ('lake', 'cake'), ('kedi', 'kadı'), ('castle', 'casket'), ('star', 'stair'),
+]
+
+
+def similarity(a, b):
+    return float(embed_word(a) @ embed_word(b))
+
+
+@pytest.mark.parametrize('a, b', INFLECTIONS)
+def test_inflections_reach_threshold(a, b):
+    assert similarity(a, b) >= SEMANTIC_THRESHOLD
+
+
+@pytest.mark.parametrize('a, b', LOOK_ALIKES)
+def test_look_alikes_stay_below_threshold(a, b):
+    assert similarity(a, b) < SEMANTIC_THRESHOLD
+
+
+def refs():
+    return [
+        {'path': 'village.png', 'name': 'Village', 'category': 'MEDIA_CATEGORY_SCENE',
+         'tags': '', 'caption': 'A quiet village street at night under the stars'},
+        {'path': 'keep.png', 'name': 'Keep', 'category': 'MEDIA_CATEGORY_SCENE',
+         'tags': 'castle', 'caption': ''},
+    ]
+
+
+def test_plural_in_sentence_matches_tag():
+    index = ReferenceIndex(refs(), whole_words=True, semantic=True)
+    picked = index.select_all(['Two castles on a hill above the sea'])
+    assert [ref['name'] for ref in picked[0]] == ['Keep']
+    assert index.similarities(['Two castles on a hill above the sea'])[0][1] >= SEMANTIC_THRESHOLD
+
+
+def test_look_alike_word_does_not_match_caption():
+    index = ReferenceIndex(refs(), whole_words=True, semantic=True)
+    assert index.select_all(['A knight rides through the forest']) == [[]]
+    assert index.select('A knight rides through the forest') == []
+
+
+def test_stored_vectors_are_reused_until_keywords_change():
+    ref = refs()[1]
+    ref['embedding'] = whisk_core.pack_embedding(ref)
+    words, vectors = whisk_core.reference_embedding(ref)
+    assert words == ['castle']
+    assert vectors.shape == (1, whisk_core.EMBED_DIM)
+    
+    ref['tags'] = 'castle, tower'
+    assert whisk_core.pack_embedding(ref) != ref['embedding']
+    assert whisk_core.reference_embedding(ref)[0] == ['castle', 'tower']
+
+
+def test_library_embeds_on_demand_and_keeps_vectors_across_saves(tmp_path):
+    library = whisk_core.ReferenceLibrary(str(tmp_path / 'library.sqlite3'))
+    ref = dict(refs()[1], path=str(tmp_path / 'castle.png'))
+    library.save([ref])
+    assert library.search('castle')[0]['embedding'] is None
+    
+    library.store_embeddings([ref])
+    stored = library.search('castle')[0]['embedding']
+    assert stored == ref['embedding']
+    assert whisk_core.embedding_is_current(ref)
+    
+    # Saving without vectors (e.g. a slot that never had them) keeps them...
+    library.save([dict(ref, embedding=None)])
+    assert library.search('castle')[0]['embedding'] == stored
+    # ...until the keywords change
+    library.record_upload(ref['path'], 'media-1', 'a ruined tower')
+    assert library.search('castle')[0]['embedding'] is None
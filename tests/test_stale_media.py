@@ -0,0 +1,102 @@
+import queue
+import threading
+import time
+
+import whisk_core
+from whisk_core import GenerationEngine, RetryPolicy
+
+
+class FakeResponse:
+    def __init__(self, status_code, error):
+        self.status_code = status_code
+        self.error = error
+    
+    def json(self):
+        return {'error': self.error}
+
+
+def test_stale_media_matches_specific_codes():
+    policy = RetryPolicy()
+    assert policy.is_stale_media(FakeResponse(404, {'code': 404, 'status': 'NOT_FOUND'}))
+    assert policy.is_stale_media(FakeResponse(400, {
+        'status': 'INVALID_ARGUMENT',
+        'details': [{'reason': 'INVALID_MEDIA_GENERATION_ID'}],
+    }))
+    assert policy.is_stale_media(FakeResponse(400, {
+        'status': 'INVALID_ARGUMENT',
+        'details': [{'fieldViolations': [
+            {'field': 'recipeMediaInputs[0].mediaInput.mediaGenerationId'}]}],
+    }))
+
+
+def test_stale_media_ignores_other_rejections():
+    policy = RetryPolicy()
+    # Policy rejections mention "media" too; they must not cause a re-upload
+    assert not policy.is_stale_media(FakeResponse(400, {
+        'status': 'INVALID_ARGUMENT',
+        'message': 'The media you uploaded violates our policies',
+    }))
+    assert not policy.is_stale_media(FakeResponse(400, {
+        'status': 'FAILED_PRECONDITION',
+        'details': [{'reason': 'PUBLIC_ERROR_UNSAFE_GENERATION'}],
+    }))
+    assert not policy.is_stale_media(FakeResponse(403, {'status': 'NOT_FOUND'}))
+
+
+def test_refresh_uploads_outside_the_lock(monkeypatch):
+    uploading = threading.Event()
+    release = threading.Event()
+    
+    def fake_upload(path, category, cookie, token, use_cache=True):
+        uploading.set()
+        assert release.wait(5)
+        return 'NEW', 'caption', None
+    
+    monkeypatch.setattr(whisk_core, 'upload_image_static', fake_upload)
+    monkeypatch.setattr(whisk_core, 'get_media_cache', lambda: None)
+    
+    engine = GenerationEngine(queue.Queue(), {}, '.', 1, 'cookie', 'token')
+    engine.prepared_refs = {'a.png': {
+        'caption': 'a knight',
+        'mediaInput': {'mediaGenerationId': 'OLD', 'mediaCategory': 'MEDIA_CATEGORY_SUBJECT'},
+    }}
+    
+    results = []
+    first = threading.Thread(target=lambda: results.append(engine.refresh_references(['a.png'])))
+    first.start()
+    assert uploading.wait(5)
+    
+    # The lock is free while the upload is in flight
+    assert engine._refresh_lock.acquire(timeout=1)
+    engine._refresh_lock.release()
+    
+    # A second row needing the same path waits for the new ID
+    second = threading.Thread(target=lambda: results.append(engine.refresh_references(['a.png'])))
+    second.start()
+    time.sleep(0.1)
+    assert results == []
+    
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert results == [True, True]
+    assert engine.prepared_refs['a.png']['mediaInput']['mediaGenerationId'] == 'NEW'
+
+
+def test_refreshed_id_reaches_on_uploaded(monkeypatch):
+    monkeypatch.setattr(whisk_core, 'upload_image_static',
+                        lambda path, category, cookie, token, use_cache=True: ('NEW', 'cap', None))
+    monkeypatch.setattr(whisk_core, 'get_media_cache', lambda: None)
+    
+    uploaded = []
+    engine = GenerationEngine(queue.Queue(), {}, '.', 1, 'cookie', 'token')
+    engine.upload_on_demand(
+        [{'path': 'a.png', 'type': 'uploaded', 'category': 'MEDIA_CATEGORY_SUBJECT',
+          'media_id': 'OLD', 'caption': 'a knight'}],
+        on_uploaded=lambda path, mid, caption: uploaded.append((path, mid, caption))
+    )
+    
+    assert engine.refresh_references(['a.png'])
+    assert uploaded == [('a.png', 'NEW', 'a knight')]
+    assert engine.uploader.prepared['a.png']['mediaInput']['mediaGenerationId'] == 'NEW'
+    engine.uploader.shutdown(wait=False)
@@ -0,0 +1,321 @@
+"""
+Auto Whisk benchmarks - hot paths on synthetic data, without Qt
+
+Usage:
+    python auto_whisk.py bench [--save baseline.json] [--check baseline.json]
+
+Times smart filtering (extract_important_words, calculate_match_score,
+smart_filter_references, ReferenceIndex), request/upload payload
+construction and response image decoding on a generated corpus (default
+10k prompts x 1k references, 2 and 8 MB images). Each benchmark reports
+ops/sec (best of --repeat runs) and peak Python heap (one tracemalloc
+run). --save writes the results as a JSON baseline; --check compares
+against one and exits 1 if any benchmark got slower (or used more memory)
+by more than --threshold.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import platform
+import contextlib
+import tracemalloc
+
+import whisk_core
+from whisk_core import (
+    APP_VERSION, STREAM_CHUNK_SIZE, RAW_BYTES_MARK, extract_important_words,
+    calculate_match_score, smart_filter_references, ReferenceIndex,
+    make_model_settings, labs_image_body, GenerationEngine, EncodedImageStream
+)
+
+BASELINE_VERSION = 1
+MEMORY_SLACK = 64 * 1024  # peak heap growth below this is never flagged
+
+CATEGORIES = ['MEDIA_CATEGORY_SUBJECT', 'MEDIA_CATEGORY_SCENE', 'MEDIA_CATEGORY_STYLE']
+SYLLABLES = ['ka', 'de', 'ri', 'mo', 'lu', 'sa', 'ne', 'to', 'vi', 'şe', 'çi', 'ğa',
+             'ıl', 'ön', 'üz', 'an', 'er', 'os', 'in', 'ph', 'đà', 'nẵ']
+
+
+class NullSink:
+    """EncodedImageStream sink that only counts bytes"""
+    
+    def __init__(self):
+        self.size = 0
+    
+    def write(self, data):
+        self.size += len(data)
+    
+    def discard(self):
+        pass
+
+
+def make_corpus(num_prompts, num_refs, seed=1):
+    """Deterministic prompts and references with names, tags and captions"""
+    rng = random.Random(seed)
+    vocab = sorted({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+                    for _ in range(5000)})
+    stopwords = sorted(whisk_core.STOPWORDS)
+    
+    def text(n):
+        return ' '.join(rng.choice(vocab) if rng.random() > 0.3 else rng.choice(stopwords)
+                        for _ in range(n))
+    
+    refs = []
+    for i in range(num_refs):
+        category = CATEGORIES[i % len(CATEGORIES)]
+        is_style = category == 'MEDIA_CATEGORY_STYLE'
+        refs.append({
+            'path': f'ref_{i}.png',
+            'category': category,
+            'media_id': f'media_{i}',
+            'name': '' if is_style else rng.choice(vocab).capitalize(),
+            'tags': '' if is_style else ', '.join(rng.choice(vocab) for _ in range(rng.randint(1, 5))),
+            'caption': text(rng.randint(10, 40)) + '.',
+            'type': 'uploaded'
+        })
+    names = [r['name'] for r in refs if r['name']]
+    
+    prompts = []
+    for _ in range(num_prompts):
+        words = text(rng.randint(8, 30)).split()
+        if names and rng.random() < 0.5:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(names))
+        prompts.append(' '.join(words))
+    return prompts, refs
+
+
+def make_response(image_size, seed=1):
+    """generateImage-shaped response body around image_size random bytes"""
+    raw = random.Random(seed).randbytes(image_size)
+    return json.dumps({
+        'imagePanels': [{'generatedImages': [
+            {'encodedImage': base64.b64encode(raw).decode('ascii'), 'seed': 1}
+        ]}]
+    }).encode('utf-8')
+
+
+def measure(fn, ops, repeat, min_time=0.2, memory=True):
+    """
+    Best-of-repeat timing of fn() plus one tracemalloc run for the peak heap
+    
+    Fast benchmarks call fn() several times per timed run so every run
+    lasts about min_time, which keeps timer and scheduler noise down.
+    """
+    start = time.perf_counter()
+    fn()
+    loops = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+    
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        times.append((time.perf_counter() - start) / loops)
+    best = min(times)
+    result = {'ops': ops, 'seconds': round(best, 6), 'ops_per_sec': round(ops / best, 3)}
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def filtering_benchmarks(prompts, refs, sample):
+    """(name, fn, ops) for the smart filtering paths"""
+    texts = [r['caption'] for r in refs] + prompts
+    few = prompts[:sample]
+    pair_prompts = prompts[:max(1, sample // 5)]
+    index = ReferenceIndex(refs)
+    
+    yield 'extract_important_words', lambda: [extract_important_words(t) for t in texts], len(texts)
+    yield ('calculate_match_score',
+           lambda: [calculate_match_score(p, r) for p in pair_prompts for r in refs],
+           len(pair_prompts) * len(refs))
+    yield 'smart_filter_references', lambda: [smart_filter_references(p, refs) for p in few], len(few)
+    yield 'reference_index_build', lambda: ReferenceIndex(refs), len(refs)
+    yield 'reference_index_select', lambda: [index.select(p) for p in few], len(few)
+    yield 'reference_index_select_all', lambda: index.select_all(prompts), len(prompts)
+    if whisk_core.load_numpy() is not None:
+        semantic = ReferenceIndex(refs, semantic=True)
+        yield 'semantic_select_all', lambda: semantic.select_all(few), len(few)
+
+
+def payload_benchmarks(prompts, refs, image_sizes):
+    """(name, fn, ops) for request bodies: image requests and labs uploads"""
+    engine = GenerationEngine(None, make_model_settings('IMAGE_ASPECT_RATIO_LANDSCAPE'),
+                              '.', 1, 'cookie=1', 'token')
+    engine.prepared_refs = {
+        r['path']: {'caption': r['caption'], 'mediaInput': {
+            'mediaCategory': r['category'], 'mediaGenerationId': r['media_id']
+        }} for r in refs
+    }
+    paths = [r['path'] for r in refs]
+    rng = random.Random(2)
+    tasks = [(p, rng.sample(paths, rng.randint(0, 3))) for p in prompts]
+    
+    def build_requests():
+        for prompt, ref_paths in tasks:
+            json.dumps(engine.build_request(prompt, ref_paths)[2])
+    
+    yield 'build_request', build_requests, len(tasks)
+    
+    payload = {'json': {'uploadMediaInput': {'mediaCategory': CATEGORIES[0],
+                                             'rawBytes': RAW_BYTES_MARK}}}
+    for size in image_sizes:
+        data_uri = b'data:image/jpeg;base64,' + base64.b64encode(random.Random(size).randbytes(size))
+        
+        def upload_body(data_uri=data_uri):
+            body = labs_image_body(payload, data_uri)
+            while body.read(STREAM_CHUNK_SIZE):
+                pass
+        
+        yield f'labs_image_body_{size >> 20}mb', upload_body, 1
+
+
+def decode_benchmarks(image_sizes, chunk_size):
+    """(name, fn, ops) for turning a generateImage response into image bytes"""
+    for size in image_sizes:
+        body = make_response(size)
+        
+        def streaming(body=body):
+            stream = EncodedImageStream(lambda k: NullSink())
+            for start in range(0, len(body), chunk_size):
+                stream.feed(body[start:start + chunk_size])
+            stream.finish()
+        
+        def buffered(body=body):
+            data = json.loads(body.decode('utf-8'))
+            base64.b64decode(data['imagePanels'][0]['generatedImages'][0]['encodedImage'])
+        
+        yield f'decode_stream_{size >> 20}mb', streaming, 1
+        yield f'decode_buffered_{size >> 20}mb', buffered, 1
+
+
+def run_benchmarks(args, log):
+    params = {'prompts': args.prompts, 'refs': args.refs, 'images_mb': args.images_mb,
+              'sample': args.sample, 'chunk': args.chunk}
+    image_sizes = [mb << 20 for mb in args.images_mb]
+    prompts, refs = make_corpus(args.prompts, args.refs)
+    
+    results = {}
+    benches = [
+        filtering_benchmarks(prompts, refs, args.sample),
+        payload_benchmarks(prompts, refs, image_sizes),
+        decode_benchmarks(image_sizes, args.chunk)
+    ]
+    # Filtering logs every selected scene; keep that out of the report
+    with open(os.devnull, 'w') as devnull:
+        for group in benches:
+            for name, fn, ops in group:
+                if args.only and not any(pattern in name for pattern in args.only):
+                    continue
+                with contextlib.redirect_stdout(devnull):
+                    results[name] = measure(fn, ops, args.repeat, args.min_time,
+                                            memory=not args.no_memory)
+                log(format_result(name, results[name]))
+    
+    return {
+        'version': BASELINE_VERSION,
+        'app_version': APP_VERSION,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': whisk_core.load_numpy() is not None,
+        'scipy': whisk_core.load_sparse() is not None,
+        'params': params,
+        'results': results
+    }
+
+
+def format_result(name, result):
+    peak = result.get('peak_bytes')
+    peak = f'{peak / 1e6:9.2f} MB' if peak is not None else ' ' * 12
+    return f"{name:<30} {result['ops_per_sec']:>14,.1f} ops/s {peak}  ({result['seconds']:.3f}s)"
+
+
+def compare(current, baseline, threshold):
+    """Lines describing regressions beyond threshold (empty = none)"""
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        ratio = result['ops_per_sec'] / base['ops_per_sec']
+        if ratio < 1 - threshold:
+            regressions.append(f'{name}: {ratio - 1:+.1%} ops/sec '
+                               f"({base['ops_per_sec']:,.1f} -> {result['ops_per_sec']:,.1f})")
+        peak, base_peak = result.get('peak_bytes'), base.get('peak_bytes')
+        if peak is not None and base_peak is not None and \
+                peak - base_peak > max(MEMORY_SLACK, base_peak * threshold):
+            regressions.append(f'{name}: peak heap {base_peak / 1e6:.2f} -> {peak / 1e6:.2f} MB')
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='auto_whisk.py bench',
+        description=f'Auto Whisk {APP_VERSION} - hot path benchmarks'
+    )
+    parser.add_argument('--prompts', type=int, default=10000, help='Synthetic prompts (default: 10000)')
+    parser.add_argument('--refs', type=int, default=1000, help='Synthetic references (default: 1000)')
+    parser.add_argument('--images-mb', type=int, nargs='+', default=[2, 8], metavar='MB',
+                        help='Image sizes for payload/decode benchmarks (default: 2 8)')
+    parser.add_argument('--sample', type=int, default=500,
+                        help='Prompts used by the per-prompt filtering benchmarks (default: 500)')
+    parser.add_argument('--chunk', type=int, default=STREAM_CHUNK_SIZE,
+                        help=f'Response chunk size for streaming decode (default: {STREAM_CHUNK_SIZE})')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Timed runs per benchmark, the best counts (default: 5)')
+    parser.add_argument('--min-time', type=float, default=0.2, metavar='SECS',
+                        help='Minimum duration of one timed run (default: 0.2)')
+    parser.add_argument('--only', action='append', default=[], metavar='NAME',
+                        help='Only benchmarks whose name contains NAME (repeatable)')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc peak heap runs')
+    parser.add_argument('--save', metavar='FILE', help='Write the results as a JSON baseline')
+    parser.add_argument('--check', metavar='FILE', help='Compare against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='Allowed slowdown / memory growth for --check (default: 0.15 = 15%%)')
+    return parser
+
+
+def main(argv):
+    """Entry point for `auto_whisk.py bench ...`; returns the exit code"""
+    args = build_parser().parse_args(argv[1:])
+    
+    baseline = None
+    if args.check:
+        try:
+            with open(args.check, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'Failed to read baseline: {e}', file=sys.stderr)
+            return 2
+    
+    log = lambda line: print(line, flush=True)
+    log(f'Auto Whisk {APP_VERSION} benchmarks: {args.prompts} prompts x {args.refs} refs, '
+        f"images {', '.join(f'{mb} MB' for mb in args.images_mb)}")
+    report = run_benchmarks(args, log)
+    
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        log(f'Baseline saved to {args.save}')
+    
+    if baseline is not None:
+        if baseline.get('params') != report['params']:
+            log(f"Warning: baseline was run with {baseline.get('params')}")
+        regressions = compare(report, baseline, args.threshold)
+        for line in regressions:
+            log(f'REGRESSION {line}')
+        if regressions:
+            return 1
+        log(f'No regressions beyond {args.threshold:.0%}')
+    return 0
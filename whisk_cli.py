@@ -0,0 +1,308 @@
+"""
+Auto Whisk headless runner - batch generation without Qt
+
+Usage:
+    python auto_whisk.py run --prompts prompts.txt --out output \\
+        --images 4 --ratio square --refs refs.json
+
+Progress is streamed to stdout as JSON lines (one event per line); log
+output goes to stderr. Cookie/token default to the session saved by the
+desktop app.
+
+refs.json is a list of reference dicts, same shape as the reference dialog:
+    [{"path": "john.png", "category": "subject", "name": "John",
+      "tags": "man, hero", "caption": "", "media_id": null}, ...]
+Relative paths are resolved against the refs.json folder. References can
+also come from the desktop app's library: --lib-set NAME ('__last__' is the
+reference dialog's last state) and/or --lib-tag / --lib-category queries.
+
+Each job is journaled (see JobJournal); re-running the same prompts with the
+same settings and output folder resumes it and only generates the images
+still missing. Pass --new-job to start over.
+"""
+
+import sys
+import os
+import json
+import time
+import queue
+import sqlite3
+import argparse
+import threading
+
+from whisk_core import (
+    APP_VERSION, AUTH_FILE, RATIO_DATA, DEFAULT_CONCURRENCY, MAX_CONCURRENCY,
+    MATCH_LOCALES, SEMANTIC_THRESHOLD, ReferenceIndex, get_selection_cache,
+    iter_generation_tasks, make_model_settings, fetch_access_token,
+    UPLOAD_PREPROCESS, upload_stats, GenerationEngine, JobJournal, ReferenceLibrary
+)
+
+RATIO_CHOICES = {k.replace('ratio_', ''): v for k, v in RATIO_DATA}
+
+CATEGORY_ALIASES = {
+    'subject': 'MEDIA_CATEGORY_SUBJECT',
+    'scene': 'MEDIA_CATEGORY_SCENE',
+    'style': 'MEDIA_CATEGORY_STYLE'
+}
+
+
+class JsonLineEmitter:
+    """Thread-safe JSON-lines writer for progress events"""
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+    
+    def emit(self, event, **fields):
+        line = json.dumps(dict(event=event, ts=round(time.time(), 3), **fields),
+                          ensure_ascii=False)
+        with self._lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='auto_whisk.py run',
+        description=f'Auto Whisk {APP_VERSION} - headless batch generation'
+    )
+    parser.add_argument('--prompts', required=True,
+                        help="Prompt file, one prompt per line ('-' = stdin)")
+    parser.add_argument('--out', default=os.path.join(os.getcwd(), 'output'),
+                        help='Output folder (default: ./output)')
+    parser.add_argument('--images', type=int, default=1, choices=range(1, 5),
+                        metavar='1-4', help='Images per prompt (default: 1)')
+    parser.add_argument('--ratio', default='landscape', choices=sorted(RATIO_CHOICES),
+                        help='Aspect ratio (default: landscape)')
+    parser.add_argument('--refs', help='Reference set JSON (see module docs)')
+    parser.add_argument('--lib-set', help='Use a saved reference library set')
+    parser.add_argument('--lib-tag', action='append', default=[],
+                        help='Use library references with this tag (repeatable, all must match)')
+    parser.add_argument('--lib-category', choices=sorted(CATEGORY_ALIASES),
+                        help='Restrict --lib-tag to one category')
+    parser.add_argument('--match-words', action='store_true',
+                        help='Match reference names/tags as whole words only')
+    parser.add_argument('--match-locale', choices=MATCH_LOCALES,
+                        help='Language-aware case matching for names/tags (Turkish I/ı, '
+                             'Vietnamese diacritics)')
+    parser.add_argument('--semantic', action='store_true',
+                        help='Also pick references whose tag/caption keywords are other '
+                             'forms of a prompt word, e.g. castles -> castle (needs NumPy)')
+    parser.add_argument('--semantic-threshold', type=float, default=SEMANTIC_THRESHOLD,
+                        metavar='0-1', help='Minimum word similarity for --semantic '
+                                            f'(default: {SEMANTIC_THRESHOLD})')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        choices=range(1, MAX_CONCURRENCY + 1), metavar=f'1-{MAX_CONCURRENCY}',
+                        help=f'Requests in flight (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--per-request', type=int, default=1, choices=range(1, 5),
+                        metavar='1-4', help='Images mapped from each response (default: 1)')
+    parser.add_argument('--cookie', help='Cookie (JSON, JWT or header string); '
+                                         'default: saved desktop session')
+    parser.add_argument('--token', help='Access token; fetched from the cookie if omitted')
+    parser.add_argument('--ref-max-side', type=int, metavar='PX',
+                        help='Downscale references to this longest side before upload '
+                             '(needs Pillow; 0 = upload originals; default: per category)')
+    parser.add_argument('--recaption', action='store_true',
+                        help='AI-caption references even if refs.json gives a caption')
+    parser.add_argument('--new-job', action='store_true',
+                        help='Start over instead of resuming an unfinished identical job')
+    return parser
+
+
+def load_prompts(path):
+    if path == '-':
+        text = sys.stdin.read()
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    return [p.strip() for p in text.split('\n') if p.strip()]
+
+
+def load_refs(path):
+    """Load a reference set into get_reference_data-style dicts"""
+    with open(path, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+    
+    base_dir = os.path.dirname(os.path.abspath(path))
+    refs = []
+    for item in items:
+        category = item.get('category', 'subject')
+        category = CATEGORY_ALIASES.get(category.lower(), category)
+        ref_path = item['path']
+        if not os.path.isabs(ref_path):
+            ref_path = os.path.join(base_dir, ref_path)
+        media_id = item.get('media_id')
+        refs.append({
+            'path': ref_path,
+            'category': category,
+            'media_id': media_id,
+            'name': '' if category == 'MEDIA_CATEGORY_STYLE' else item.get('name', ''),
+            'tags': '' if category == 'MEDIA_CATEGORY_STYLE' else item.get('tags', ''),
+            'caption': item.get('caption', ''),
+            'type': 'uploaded' if media_id else 'pending'
+        })
+    return refs
+
+
+def load_library_refs(args):
+    """References picked from the desktop app's library"""
+    if not (args.lib_set or args.lib_tag or args.lib_category):
+        return []
+    library = ReferenceLibrary()
+    refs = library.load_set(args.lib_set) if args.lib_set else []
+    if args.lib_tag or args.lib_category:
+        refs += library.search(category=CATEGORY_ALIASES.get(args.lib_category),
+                               tags=args.lib_tag, limit=10000)
+    refs = [r for r in refs if os.path.exists(r['path'])]
+    if args.semantic:
+        library.store_embeddings(refs, args.match_locale)
+    return refs
+
+
+def resolve_auth(args):
+    """Cookie/token from args, falling back to the saved desktop session"""
+    saved = {}
+    if os.path.exists(AUTH_FILE):
+        try:
+            with open(AUTH_FILE, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            pass
+    
+    cookie = args.cookie or saved.get('cookie', '')
+    token = args.token
+    if not token and not args.cookie:
+        exp = saved.get('exp', 0)
+        if saved.get('token') and (not exp or exp > time.time() + 60):
+            token = saved['token']
+    if not token and cookie:
+        token, _ = fetch_access_token(cookie)
+    return cookie, token
+
+
+def main(argv):
+    """Entry point for `auto_whisk.py run ...`; returns the exit code"""
+    args = build_parser().parse_args(argv[1:])
+    
+    # stdout carries the event stream; route log prints to stderr
+    events = JsonLineEmitter(sys.stdout)
+    sys.stdout = sys.stderr
+    
+    try:
+        prompts = load_prompts(args.prompts)
+        ref_data = load_refs(args.refs) if args.refs else []
+        seen = {r['path'] for r in ref_data}
+        for ref in load_library_refs(args):
+            if ref['path'] not in seen:
+                seen.add(ref['path'])
+                ref_data.append(ref)
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        events.emit('error', message=f'Failed to read input: {e}')
+        return 2
+    
+    if not prompts:
+        events.emit('error', message='No prompts')
+        return 2
+    
+    cookie, token = resolve_auth(args)
+    if not token:
+        events.emit('error', message='No valid token - pass --cookie/--token '
+                                     'or check the cookie in the desktop app')
+        return 2
+    
+    if args.ref_max_side is not None:
+        for profile in UPLOAD_PREPROCESS.values():
+            profile['max_side'] = args.ref_max_side
+    
+    os.makedirs(args.out, exist_ok=True)
+    model_settings = make_model_settings(RATIO_CHOICES[args.ratio])
+    
+    # Resume an interrupted identical job, or open a new one
+    journal = JobJournal()
+    job_id = journal.find_resumable(prompts, args.images, args.out, model_settings)
+    if job_id is not None and args.new_job:
+        journal.abandon_job(job_id)
+        job_id = None
+    if job_id is None:
+        job_id = journal.create_job(prompts, args.images, args.out, model_settings)
+        missing = {row: list(range(args.images)) for row in range(len(prompts))}
+        resumed = 0
+    else:
+        journal.resume_job(job_id)
+        missing = journal.missing_cells(job_id)
+        resumed = len(journal.done_cells(job_id))
+    
+    started_at = time.time()
+    events.emit('job_started', job_id=job_id, prompts=len(prompts), images=args.images,
+                refs=len(ref_data), out=os.path.abspath(args.out), already_done=resumed)
+    
+    if not missing:
+        journal.finish_job(job_id)
+        events.emit('job_done', job_id=job_id, succeeded=0, failed=0, elapsed=0.0)
+        return 0
+    
+    task_queue = queue.Queue()
+    ref_index = ReferenceIndex(ref_data, whole_words=args.match_words,
+                               locale=args.match_locale, semantic=args.semantic,
+                               threshold=args.semantic_threshold)
+    
+    counts = {'success': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+    
+    def on_success(row, col, path):
+        with counts_lock:
+            counts['success'] += 1
+        events.emit('task_success', row=row, col=col, path=path)
+    
+    def on_failed(row, col, msg):
+        with counts_lock:
+            counts['failed'] += 1
+        events.emit('task_failed', row=row, col=col, error=msg)
+    
+    engine = GenerationEngine(
+        task_queue, model_settings,
+        args.out, args.images, cookie, token,
+        max_workers=args.concurrency,
+        candidates_per_request=args.per_request,
+        journal=journal, job_id=job_id,
+        on_started=lambda r, s: events.emit('task_started', row=r, status=s),
+        on_success=on_success,
+        on_failed=on_failed,
+        on_rate_changed=lambda rate, limit: events.emit(
+            'rate', requests_per_sec=round(rate, 3), limit=limit
+        ),
+        on_circuit_changed=lambda state, secs: events.emit(
+            'circuit', state=state, cooldown=round(secs, 1)
+        )
+    )
+    if ref_data:
+        # Uploaded on demand: only references some prompt selected, overlapped with generation
+        engine.upload_on_demand(
+            ref_data,
+            on_uploaded=lambda p, m, c: events.emit(
+                'reference_uploaded', path=p, media_id=m, caption=c
+            ),
+            on_failed=lambda p, e: events.emit('reference_failed', path=p, error=e),
+            keep_user_captions=not args.recaption
+        )
+    
+    runner = threading.Thread(target=engine.run, name='whisk-engine')
+    runner.start()
+    try:
+        # Queue every row that still has missing images, with its smart-filtered
+        # references; the first rows generate while the rest are filtered
+        for task in iter_generation_tasks(prompts, missing, ref_index, get_selection_cache()):
+            task_queue.put(task)
+            events.emit('task_queued', row=task[0], prompt=task[1],
+                        images=[i + 1 for i in task[2]], refs=task[3])
+        task_queue.join()
+    except KeyboardInterrupt:
+        events.emit('interrupted')
+    engine.stop()
+    runner.join()
+    journal.finish_job(job_id)
+    
+    events.emit('job_done', job_id=job_id, succeeded=counts['success'], failed=counts['failed'],
+                elapsed=round(time.time() - started_at, 2),
+                upload_bytes_saved=upload_stats.saved_bytes)
+    return 0 if counts['failed'] == 0 else 1
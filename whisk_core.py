@@ -0,0 +1,3300 @@
+"""
+Auto Whisk core - everything that does not need Qt
+
+Smart filtering, HTTP client, rate control, retry policy, disk writer,
+response decoding and the generation engine. Shared by the desktop app
+(auto_whisk.py) and the headless runner (whisk_cli.py); importing this
+module never pulls in PySide6.
+"""
+
+import io
+import sys
+import json
+import requests
+import base64
+import os
+import time
+import re
+import queue
+import random
+import sqlite3
+import zlib
+import hashlib
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    from PIL import Image, ImageOps  # optional: downscale references before upload
+except ImportError:
+    Image = ImageOps = None
+
+# Optional: NumPy (semantic matching) and SciPy (vectorized batch scoring)
+# are imported on first use, since loading them costs ~300 ms at startup
+_numeric_modules = {}
+
+
+def load_numpy():
+    """The numpy module, or None if it isn't installed (imported once)"""
+    if 'numpy' not in _numeric_modules:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numeric_modules['numpy'] = numpy
+    return _numeric_modules['numpy']
+
+
+def load_sparse():
+    """scipy.sparse, or None if NumPy/SciPy aren't installed (imported once)"""
+    if 'sparse' not in _numeric_modules:
+        sparse = None
+        if load_numpy() is not None:
+            try:
+                from scipy import sparse
+            except ImportError:
+                pass
+        _numeric_modules['sparse'] = sparse
+    return _numeric_modules['sparse']
+
+# ==================== CONFIGURATION ====================
+APP_VERSION = 'v8.6.0 FIXED FINAL'
+USER_AGENT_STR = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36'
+API_AUTH_SESSION = 'https://labs.google/fx/api/auth/session'
+API_TOKEN_INFO = 'https://www.googleapis.com/oauth2/v3/tokeninfo'
+DEFAULT_IMAGE_MODEL = 'imagen-3.0-generate-001'
+
+# App data directory
+APP_NAME = 'AutoWhisk'
+if sys.platform == 'win32':
+    app_data_dir = os.getenv('APPDATA') or os.path.expanduser('~\\AppData\\Roaming')
+elif sys.platform == 'darwin':
+    app_data_dir = os.path.expanduser('~/Library/Application Support')
+else:
+    app_data_dir = os.path.expanduser('~/.local/share')
+
+APP_DIR = os.path.join(app_data_dir, APP_NAME)
+os.makedirs(APP_DIR, exist_ok=True)
+AUTH_FILE = os.path.join(APP_DIR, 'auth_session_final.json')
+JOURNAL_FILE = os.path.join(APP_DIR, 'jobs.sqlite3')
+MEDIA_CACHE_FILE = os.path.join(APP_DIR, 'media_cache.sqlite3')
+LIBRARY_FILE = os.path.join(APP_DIR, 'library.sqlite3')
+SELECTION_CACHE_FILE = os.path.join(APP_DIR, 'selections.sqlite3')
+
+# Generation concurrency (images in flight at once)
+DEFAULT_CONCURRENCY = 3
+MAX_CONCURRENCY = 8
+UPLOAD_CONCURRENCY = 4  # parallel reference uploads
+
+# Reference preprocessing before upload (needs Pillow): longest side cap and
+# re-encode quality per category; max_side 0/None uploads the file as-is
+UPLOAD_PREPROCESS = {
+    'MEDIA_CATEGORY_SUBJECT': {'max_side': 1536, 'quality': 90},
+    'MEDIA_CATEGORY_SCENE': {'max_side': 1536, 'quality': 85},
+    'MEDIA_CATEGORY_STYLE': {'max_side': 1024, 'quality': 85}
+}
+
+# Reference matching: whole-word patterns only ("art" no longer hits "party")
+# and locale-aware casefolding (None = plain lower(), 'tr' = dotted/dotless I,
+# 'vi' = NFC-normalized diacritics). Defaults keep substring semantics.
+MATCH_WHOLE_WORDS = False
+MATCH_LOCALE = None
+MATCH_LOCALES = ('tr', 'vi')
+
+# Semantic reference matching (needs NumPy): every prompt word is compared
+# with each reference's tag and caption keywords as hashed character n-gram
+# + word-prefix vectors. A reference with a word pair at cosine similarity
+# SEMANTIC_THRESHOLD or more also qualifies, ranked by its best pair, so
+# inflections ("castles"/"castle", "kediler"/"kedi") match while look-alike
+# words ("knight"/"night") don't. The threshold sits between the labelled
+# word pairs in tests/test_semantic_matching.py (inflections >= 0.64,
+# look-alikes <= 0.38); irregular forms ("wolf"/"wolves") stay unmatched.
+SEMANTIC_MATCH = False
+SEMANTIC_THRESHOLD = 0.55
+EMBED_DIM = 256
+EMBED_NGRAMS = (3, 4)
+EMBED_PREFIX_WEIGHT = 2.0
+
+# Placeholder for the shared image buffer in labs request bodies
+RAW_BYTES_MARK = '@@RAW_BYTES@@'
+
+# Response body read size when streaming images to disk
+STREAM_CHUNK_SIZE = 64 * 1024
+
+RATIO_DATA = [
+    ('ratio_landscape', 'IMAGE_ASPECT_RATIO_LANDSCAPE'),
+    ('ratio_portrait', 'IMAGE_ASPECT_RATIO_PORTRAIT'),
+    ('ratio_square', 'IMAGE_ASPECT_RATIO_SQUARE')
+]
+
+
+# ==================== SMART FILTERING FUNCTIONS ====================
+
+# Common stopwords (Turkish + English)
+STOPWORDS_TR = {
+    've', 'bir', 'bu', 'ile', 'için', 'de', 'da', 'mi', 'mı', 
+    'mu', 'mü', 'gibi', 'daha', 'çok', 'en', 'olan', 'olarak',
+    'var', 'yok', 'şey', 'şu', 'o', 'bu'
+}
+STOPWORDS_EN = {
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 
+    'to', 'for', 'of', 'with', 'by', 'from', 'as', 'is', 'was',
+    'are', 'were', 'be', 'been', 'being', 'have', 'has', 'had',
+    'do', 'does', 'did', 'will', 'would', 'should', 'could',
+    'may', 'might', 'can', 'this', 'that', 'these', 'those'
+}
+STOPWORDS = STOPWORDS_TR | STOPWORDS_EN
+_PUNCT_RE = re.compile(r'[^\w\s-]')
+
+
+def extract_important_words(text):
+    """Extract important keywords from text for matching"""
+    if not text:
+        return []
+    
+    # Remove punctuation and split
+    text_clean = _PUNCT_RE.sub(' ', text.lower())
+    words = text_clean.split()
+    
+    # Filter: length > 3 and not stopword
+    important = [w for w in words if len(w) > 3 and w not in STOPWORDS]
+    
+    return important[:10]  # Return first 10 important words
+
+
+def calculate_match_score(prompt, ref):
+    """
+    Calculate how well a reference matches the prompt
+    
+    FIXED: Style uses caption only (no name/tags)
+    
+    Scoring:
+    - Name exact match: +10
+    - Tag exact match: +5 per tag
+    - Caption important word match: +1 per word
+    """
+    score = 0
+    prompt_lower = prompt.lower()
+    
+    # === STYLE: Caption only (NO name/tags) ===
+    if ref.get('category') == 'MEDIA_CATEGORY_STYLE':
+        if ref.get('caption'):
+            important_words = extract_important_words(ref['caption'])
+            for word in important_words:
+                if word in prompt_lower:
+                    score += 1
+        return score  # Early return for style
+    
+    # Name match (highest priority)
+    if ref.get('name'):
+        name_lower = ref['name'].strip().lower()
+        if name_lower and name_lower in prompt_lower:
+            score += 10
+    
+    # Tags match
+    if ref.get('tags'):
+        tags = [t.strip().lower() for t in ref['tags'].split(',') if t.strip()]
+        for tag in tags:
+            if tag in prompt_lower:
+                score += 5
+    
+    # Caption match (important words only)
+    if ref.get('caption'):
+        important_words = extract_important_words(ref['caption'])
+        for word in important_words:
+            if word in prompt_lower:
+                score += 1
+    
+    return score
+
+
+def smart_filter_references(prompt, all_refs):
+    """
+    Smart filtering: Select most relevant references based on prompt
+    
+    Rules:
+    1. SUBJECTS with names mentioned in prompt → Include ALL matching names
+    2. SUBJECTS without name matches → Top 2 by score (if score > 0)
+    3. SCENES → Include if score > 0 (OR matching)
+    4. STYLES → Include if score > 0 (OR matching)
+    
+    Args:
+        prompt (str): User's generation prompt
+        all_refs (list): List of reference dicts with 'name', 'tags', 'caption', 'category'
+    
+    Returns:
+        list: Filtered list of references
+    """
+    if not all_refs:
+        return []
+    
+    # Separate by category
+    subjects = [r for r in all_refs if r.get('category') == 'MEDIA_CATEGORY_SUBJECT']
+    scenes = [r for r in all_refs if r.get('category') == 'MEDIA_CATEGORY_SCENE']
+    styles = [r for r in all_refs if r.get('category') == 'MEDIA_CATEGORY_STYLE']
+    
+    filtered = []
+    
+    # ===== SUBJECTS FILTERING =====
+    if subjects:
+        # Check for name matches first
+        named_matches = []
+        for ref in subjects:
+            name = ref.get('name', '').strip()
+            if name and name.lower() in prompt.lower():
+                named_matches.append(ref)
+        
+        if named_matches:
+            # Use ALL named matches (no limit when names are explicitly mentioned)
+            filtered.extend(named_matches)
+        else:
+            # No name matches → score all subjects and take top 2
+            scored = [(calculate_match_score(prompt, r), r) for r in subjects]
+            scored.sort(reverse=True, key=lambda x: x[0])
+            
+            # Take top 2 subjects with score > 0
+            for score, ref in scored[:2]:
+                if score > 0:
+                    filtered.append(ref)
+    
+    # ===== SCENES FILTERING (ONLY if match!) =====
+    for ref in scenes:
+        score = calculate_match_score(prompt, ref)
+        if score > 0:  # Only include matching scenes
+            filtered.append(ref)
+            name = ref.get('name', 'Unnamed')
+            print(f"[FILTER] ✓ Scene ({score}): {name}")
+    
+    # ===== STYLES FILTERING (OR matching) =====
+    for ref in styles:
+        if calculate_match_score(prompt, ref) > 0:
+            filtered.append(ref)
+    
+    return filtered
+
+
+_TR_UPPER_I = str.maketrans({'I': 'ı', 'İ': 'i'})
+
+
+def make_casefold(locale=None):
+    """
+    Text normalizer for reference matching
+    
+    None keeps plain str.lower() (the historical behaviour). 'tr' maps
+    I -> ı and İ -> i before folding, so "IŞIK" matches "ışık" and "İstanbul"
+    matches "istanbul". 'vi' (and 'tr') NFC-normalize first, so decomposed
+    diacritics typed by some IMEs match the precomposed ones, then casefold().
+    """
+    if locale is None:
+        return str.lower
+    if locale not in MATCH_LOCALES:
+        raise ValueError(f'Unsupported match locale: {locale}')
+    if locale == 'tr':
+        return lambda text: unicodedata.normalize('NFC', text).translate(_TR_UPPER_I).casefold()
+    return lambda text: unicodedata.normalize('NFC', text).casefold()
+
+
+class PatternMatcher:
+    """
+    Aho-Corasick automaton over a fixed set of (already folded) patterns
+    
+    find() reports every pattern occurring in a text in one pass over it,
+    however many patterns there are. With whole_words a match only counts
+    when it is not glued to a letter/digit on either side (edges that are
+    not alphanumeric themselves, e.g. "c++", are not checked).
+    """
+    
+    def __init__(self, patterns, whole_words=False):
+        self.whole_words = whole_words
+        self.patterns = []
+        # Trie: per node transitions, failure link, pattern ending here
+        # (-1 = none) and the nearest pattern-ending node on the failure chain
+        goto = [{}]
+        out = [-1]
+        for pattern in patterns:
+            if not pattern:
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(-1)
+                node = nxt
+            if out[node] < 0:
+                out[node] = len(self.patterns)
+                self.patterns.append(pattern)
+        
+        fail = [0] * len(goto)
+        dict_link = [-1] * len(goto)
+        pending = deque(goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, child in goto[node].items():
+                pending.append(child)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                target = goto[f].get(ch, 0)
+                fail[child] = target if target != child else 0
+                dict_link[child] = fail[child] if out[fail[child]] >= 0 else dict_link[fail[child]]
+        
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._dict_link = dict_link
+    
+    def __len__(self):
+        return len(self.patterns)
+    
+    def find(self, text):
+        """Set of patterns found in text (text folded like the patterns)"""
+        goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict_link
+        patterns = self.patterns
+        whole_words = self.whole_words
+        found = set()
+        node = 0
+        for end, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = node if out[node] >= 0 else dict_link[node]
+            while hit > 0:
+                pattern = patterns[out[hit]]
+                if not whole_words or self._at_boundary(text, end + 1 - len(pattern), end, pattern):
+                    found.add(pattern)
+                hit = dict_link[hit]
+        return found
+    
+    @staticmethod
+    def _at_boundary(text, start, end, pattern):
+        if pattern[0].isalnum() and start > 0 and text[start - 1].isalnum():
+            return False
+        if pattern[-1].isalnum() and end + 1 < len(text) and text[end + 1].isalnum():
+            return False
+        return True
+
+
+def semantic_keywords(ref, fold=str.lower):
+    """
+    Unique words a reference is matched on semantically: its tag words
+    (not for styles) and the caption keywords the index scores
+    """
+    words = []
+    if ref.get('category') != 'MEDIA_CATEGORY_STYLE' and ref.get('tags'):
+        words.extend(w for w in _PUNCT_RE.sub(' ', fold(ref['tags'])).split()
+                     if w not in STOPWORDS)
+    if ref.get('caption'):
+        words.extend(extract_important_words(fold(ref['caption'])))
+    return list(dict.fromkeys(words))
+
+
+def prompt_words(prompt, fold=str.lower):
+    """Unique non-stopword words of a prompt, in order"""
+    words = _PUNCT_RE.sub(' ', fold(prompt)).split()
+    return list(dict.fromkeys(w for w in words if w not in STOPWORDS))
+
+
+def embed_word(word):
+    """
+    Unit-length hashed feature vector of one word (float32, EMBED_DIM)
+    
+    Features are the padded word's ("<word>") EMBED_NGRAMS character
+    n-grams plus its prefixes (2 chars and up, EMBED_PREFIX_WEIGHT each),
+    hashed into signed buckets. Shared n-grams alone rate "knight"/"night"
+    as close as "castle"/"castles"; the prefixes are what tell a suffix
+    inflection from a different word.
+    """
+    np = load_numpy()
+    padded = f'<{word}>'
+    features = [(padded[i:i + n], 1.0) for n in EMBED_NGRAMS
+                for i in range(len(padded) - n + 1)]
+    features += [('^' + word[:k], EMBED_PREFIX_WEIGHT) for k in range(2, len(word) + 1)]
+    vec = np.zeros(EMBED_DIM, dtype=np.float32)
+    for feature, weight in features:
+        h = zlib.crc32(feature.encode('utf-8'))
+        vec[h % EMBED_DIM] += weight if h & 0x80000000 else -weight
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def embed_words(words):
+    """len(words) x EMBED_DIM matrix of embed_word vectors (float32)"""
+    np = load_numpy()
+    if not words:
+        return np.zeros((0, EMBED_DIM), dtype=np.float32)
+    return np.vstack([embed_word(word) for word in words])
+
+
+def _embedding_key(words, locale):
+    settings = f'{locale}|{EMBED_DIM}|{EMBED_NGRAMS}|{EMBED_PREFIX_WEIGHT}'
+    return hashlib.blake2b('\n'.join([settings] + words).encode('utf-8'),
+                           digest_size=8).digest()
+
+
+def pack_embedding(ref, locale=None):
+    """
+    Stored form of a reference's keyword vectors (key + float16 matrix),
+    or None without NumPy
+    
+    The key covers the keywords and settings, so stored vectors whose
+    caption/tags changed since are recognized as stale and ignored.
+    """
+    if embedding_is_current(ref, locale):
+        return ref['embedding']
+    np = load_numpy()
+    if np is None:
+        return None
+    words = semantic_keywords(ref, make_casefold(locale))
+    return _embedding_key(words, locale) + embed_words(words).astype(np.float16).tobytes()
+
+
+def embedding_is_current(ref, locale=None):
+    """Whether a reference's stored vectors still match its caption/tags (no NumPy needed)"""
+    stored = ref.get('embedding')
+    return bool(stored) and stored[:8] == _embedding_key(
+        semantic_keywords(ref, make_casefold(locale)), locale)
+
+
+def reference_embedding(ref, locale=None):
+    """(keywords, keyword vectors) of a reference, from its stored ones when still valid"""
+    words = semantic_keywords(ref, make_casefold(locale))
+    stored = ref.get('embedding')
+    if stored and stored[:8] == _embedding_key(words, locale):
+        np = load_numpy()
+        vectors = np.frombuffer(stored, dtype=np.float16, offset=8).astype(np.float32)
+        return words, vectors.reshape(-1, EMBED_DIM)
+    return words, embed_words(words)
+
+
+class ReferenceIndex:
+    """
+    Compiled smart-filter index over one reference set
+    
+    Built once per job: every name, tag and caption keyword is normalized
+    once and mapped to the references it scores for, with the same weights
+    as calculate_match_score (name +10, tag +5, caption word +1). Prompts
+    are matched by a PatternMatcher in one pass, regardless of how many
+    references there are. With the default options (substring matching,
+    plain lower()) select() returns exactly what smart_filter_references
+    would; whole_words and locale (see make_casefold) tighten matching.
+    
+    With semantic, the keywords of all references are embedded once into
+    one vocabulary matrix. A reference qualifies too when one of its
+    keywords reaches threshold against a prompt word; the best such
+    similarity (2 decimals) is added to its score, so it also ranks
+    subjects.
+    """
+    
+    SEMANTIC_BLOCK = 512  # prompt words per similarity product (bounds memory)
+    
+    def __init__(self, all_refs, whole_words=MATCH_WHOLE_WORDS, locale=MATCH_LOCALE,
+                 semantic=SEMANTIC_MATCH, threshold=SEMANTIC_THRESHOLD):
+        self.refs = list(all_refs)
+        self.fold = fold = make_casefold(locale)
+        self.postings = {}  # pattern -> {ref position: weight}
+        self.names = {}  # subject position -> lowered name (named pass)
+        self.category = [ref.get('category') for ref in self.refs]
+        
+        for pos, ref in enumerate(self.refs):
+            category = self.category[pos]
+            if category == 'MEDIA_CATEGORY_SUBJECT':
+                name = ref.get('name', '').strip()
+                if name:
+                    self.names[pos] = fold(name)
+            
+            # === STYLE: Caption only (NO name/tags) ===
+            if category != 'MEDIA_CATEGORY_STYLE':
+                if ref.get('name'):
+                    name_lower = fold(ref['name'].strip())
+                    if name_lower:
+                        self._add(name_lower, pos, 10)
+                if ref.get('tags'):
+                    for tag in ref['tags'].split(','):
+                        if tag.strip():
+                            self._add(fold(tag.strip()), pos, 5)
+            if ref.get('caption'):
+                for word in extract_important_words(fold(ref['caption'])):
+                    self._add(word, pos, 1)
+        
+        self.matcher = PatternMatcher(self.postings, whole_words)
+        self._matrices = None  # (pattern ids, weights, named) for select_all
+        
+        self.embeddings = None  # keyword vocabulary x EMBED_DIM, semantic matching only
+        self.threshold = threshold
+        self.locale = locale
+        self.whole_words = whole_words
+        self._fingerprint = None
+        np = load_numpy() if semantic else None
+        if semantic and np is None:
+            print('[FILTER] Semantic matching needs NumPy - using name/tag/caption matches only')
+        elif semantic:
+            self._build_semantic(np)
+    
+    def _build_semantic(self, np):
+        """Keyword vocabulary matrix + each reference's slice of vocabulary ids"""
+        vocab = {}
+        vectors = []
+        keyword_ids = []  # vocabulary ids, grouped by reference
+        starts = []
+        self.keyword_refs = []  # reference position of each group
+        for pos, ref in enumerate(self.refs):
+            words, matrix = reference_embedding(ref, self.locale)
+            if not words:
+                continue
+            self.keyword_refs.append(pos)
+            starts.append(len(keyword_ids))
+            for word, vec in zip(words, matrix):
+                if word not in vocab:
+                    vocab[word] = len(vectors)
+                    vectors.append(vec)
+                keyword_ids.append(vocab[word])
+        self.embeddings = np.array(vectors, dtype=np.float32).reshape(-1, EMBED_DIM)
+        self.keyword_ids = np.array(keyword_ids, dtype=np.intp)
+        self.keyword_starts = np.array(starts, dtype=np.intp)
+        self._word_vectors = {}  # prompt word -> vector, shared by every call
+    
+    def __len__(self):
+        return len(self.refs)
+    
+    @property
+    def fingerprint(self):
+        """
+        Digest of everything selection depends on: each reference's
+        category/name/tags/caption (in order) and the matching options
+        """
+        if self._fingerprint is None:
+            meta = [[ref.get('category'), ref.get('name', ''), ref.get('tags', ''),
+                     ref.get('caption', '')] for ref in self.refs]
+            options = [self.whole_words, self.locale]
+            if self.embeddings is not None:
+                options += [self.threshold, EMBED_DIM, list(EMBED_NGRAMS), EMBED_PREFIX_WEIGHT]
+            self._fingerprint = hashlib.sha256(
+                json.dumps([options, meta], ensure_ascii=False).encode('utf-8')
+            ).hexdigest()
+        return self._fingerprint
+    
+    def _add(self, pattern, pos, weight):
+        refs = self.postings.setdefault(pattern, {})
+        refs[pos] = refs.get(pos, 0) + weight
+    
+    def matched_patterns(self, prompt):
+        """Every indexed pattern that occurs in the prompt"""
+        return self.matcher.find(self.fold(prompt))
+    
+    def scores(self, prompt, found=None):
+        """{ref position: calculate_match_score} for references scoring > 0"""
+        if found is None:
+            found = self.matched_patterns(prompt)
+        scores = {}
+        for pattern in found:
+            for pos, weight in self.postings[pattern].items():
+                scores[pos] = scores.get(pos, 0) + weight
+        return scores
+    
+    def similarities(self, prompts):
+        """
+        prompts x references best keyword similarities, rounded to 2
+        decimals and zeroed below the threshold (float64)
+        
+        Prompt words are scored against the whole keyword vocabulary in
+        blocks of about SEMANTIC_BLOCK words, reduced to the best prompt
+        word per keyword, then to the best keyword per reference.
+        """
+        np = load_numpy()
+        sims = np.zeros((len(prompts), len(self.refs)))
+        if not self.keyword_refs:
+            return sims
+        fold = self.fold
+        cache = self._word_vectors
+        
+        rows, starts, vectors = [], [], []
+        for row, prompt in enumerate(prompts):
+            words = prompt_words(prompt, fold)
+            if not words:
+                continue
+            rows.append(row)
+            starts.append(len(vectors))
+            for word in words:
+                if word not in cache:
+                    cache[word] = embed_word(word)
+                vectors.append(cache[word])
+            if len(vectors) >= self.SEMANTIC_BLOCK:
+                self._fill_similarities(np, sims, rows, starts, vectors)
+                rows, starts, vectors = [], [], []
+        if rows:
+            self._fill_similarities(np, sims, rows, starts, vectors)
+        return sims
+    
+    def _fill_similarities(self, np, sims, rows, starts, vectors):
+        word_sims = np.vstack(vectors) @ self.embeddings.T  # words x vocabulary
+        best_word = np.maximum.reduceat(word_sims, starts, axis=0)  # rows x vocabulary
+        best = np.maximum.reduceat(best_word[:, self.keyword_ids], self.keyword_starts, axis=1)
+        best = np.round(best.astype(np.float64), 2)
+        best[best < self.threshold] = 0.0
+        sims[np.ix_(rows, self.keyword_refs)] = best
+    
+    def select(self, prompt):
+        """Same result as smart_filter_references(prompt, all_refs) by default"""
+        found = self.matched_patterns(prompt)
+        scores = self.scores(prompt, found)
+        if self.embeddings is not None:
+            sims = self.similarities([prompt])[0]
+            scores = {pos: float(score) for pos, score in scores.items()}
+            for pos in sims.nonzero()[0].tolist():
+                scores[pos] = scores.get(pos, 0.0) + float(sims[pos])
+        
+        filtered = []
+        
+        # Only references that scored can be selected; keep list order
+        hits = sorted(scores)
+        
+        # ===== SUBJECTS: all named matches, else top 2 by score =====
+        subjects = [pos for pos in hits if self.category[pos] == 'MEDIA_CATEGORY_SUBJECT']
+        named = [pos for pos in subjects if self.names.get(pos) in found]
+        if named:
+            filtered.extend(self.refs[pos] for pos in named)
+        else:
+            # Highest scores first, ties in list order (stable sort)
+            subjects.sort(key=lambda pos: -scores[pos])
+            filtered.extend(self.refs[pos] for pos in subjects[:2])
+        
+        # ===== SCENES (ONLY if match!) =====
+        for pos in hits:
+            if self.category[pos] == 'MEDIA_CATEGORY_SCENE':
+                ref = self.refs[pos]
+                filtered.append(ref)
+                print(f"[FILTER] ✓ Scene ({scores[pos]}): {ref.get('name', 'Unnamed')}")
+        
+        # ===== STYLES (OR matching) =====
+        filtered.extend(self.refs[pos] for pos in hits
+                        if self.category[pos] == 'MEDIA_CATEGORY_STYLE')
+        
+        return filtered
+    
+    def _score_matrices(self):
+        """Sparse pattern x reference weight and named-subject matrices"""
+        if self._matrices is None:
+            np, sparse = load_numpy(), load_sparse()
+            patterns = self.matcher.patterns
+            pattern_ids = {pattern: pid for pid, pattern in enumerate(patterns)}
+            rows, cols, weights = [], [], []
+            for pid, pattern in enumerate(patterns):
+                for pos, weight in self.postings[pattern].items():
+                    rows.append(pid)
+                    cols.append(pos)
+                    weights.append(weight)
+            shape = (len(patterns), len(self.refs))
+            weight_matrix = sparse.csr_matrix((weights, (rows, cols)), shape=shape, dtype=np.int32)
+            named_pos = list(self.names)
+            named_matrix = sparse.csr_matrix(
+                (np.ones(len(named_pos), dtype=np.int32),
+                 ([pattern_ids[self.names[pos]] for pos in named_pos], named_pos)),
+                shape=shape
+            )
+            self._matrices = (pattern_ids, weight_matrix, named_matrix)
+        return self._matrices
+    
+    def select_all(self, prompts, cache=None):
+        """
+        select() for a whole prompt list at once
+        
+        Repeated prompts are selected once. With a SelectionCache, prompts
+        already selected against this exact reference set (see fingerprint)
+        are answered from it and new selections are stored in it.
+        """
+        prompts = list(prompts)
+        keys = [self.fold(prompt).strip() for prompt in prompts]
+        first = {}
+        for key, prompt in zip(keys, prompts):
+            first.setdefault(key, prompt)
+        
+        known = cache.get_many(self.fingerprint, list(first)) if cache else {}
+        todo = [key for key in first if key not in known]
+        if todo:
+            position = {id(ref): pos for pos, ref in enumerate(self.refs)}
+            computed = {
+                key: [position[id(ref)] for ref in filtered]
+                for key, filtered in zip(todo, self._select_all([first[key] for key in todo]))
+            }
+            if cache:
+                cache.put_many(self.fingerprint, computed)
+            known.update(computed)
+        if cache and len(todo) < len(first):
+            print(f'[FILTER] {len(first) - len(todo)}/{len(first)} prompt selections from cache')
+        
+        refs = self.refs
+        return [[refs[pos] for pos in known[key]] for key in keys]
+    
+    def _select_all(self, prompts):
+        """
+        Builds a sparse prompt x pattern hit matrix (one automaton pass per
+        prompt) and scores every prompt/reference pair with two sparse
+        products; only the subject/scene/style rules run per prompt, over
+        the references that scored. Falls back to select() per prompt
+        without NumPy/SciPy. Results are identical either way.
+        """
+        if not (self.postings or self.embeddings is not None) or not prompts:
+            return [self.select(prompt) for prompt in prompts]
+        sparse = load_sparse()
+        if sparse is None:
+            return [self.select(prompt) for prompt in prompts]
+        np = load_numpy()
+        
+        pattern_ids, weight_matrix, named_matrix = self._score_matrices()
+        indptr = [0]
+        columns = []
+        for prompt in prompts:
+            columns.extend(pattern_ids[pattern] for pattern in self.matched_patterns(prompt))
+            indptr.append(len(columns))
+        hits = sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.int32), columns, indptr),
+            shape=(len(prompts), len(pattern_ids))
+        )
+        scores = (hits @ weight_matrix).tocsr()
+        scores.sort_indices()
+        named = (hits @ named_matrix).tocsr()
+        named.sort_indices()
+        if self.embeddings is not None:
+            # Dense similarities in slices of rows to bound memory
+            step = 1024
+            semantic = sparse.vstack([
+                sparse.csr_matrix(self.similarities(prompts[start:start + step]))
+                for start in range(0, len(prompts), step)
+            ])
+            scores = (scores.astype(np.float64) + semantic).tocsr()
+            scores.sort_indices()
+        
+        codes = {'MEDIA_CATEGORY_SUBJECT': 0, 'MEDIA_CATEGORY_SCENE': 1, 'MEDIA_CATEGORY_STYLE': 2}
+        category = np.array([codes.get(c, -1) for c in self.category], dtype=np.int8)
+        refs = self.refs
+        
+        results = []
+        for row in range(len(prompts)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            hit_pos = scores.indices[start:end]
+            hit_scores = scores.data[start:end]
+            hit_category = category[hit_pos]
+            filtered = []
+            
+            # ===== SUBJECTS: all named matches, else top 2 by score =====
+            named_pos = named.indices[named.indptr[row]:named.indptr[row + 1]]
+            if len(named_pos):
+                filtered.extend(refs[pos] for pos in named_pos.tolist())
+            else:
+                subject = hit_category == 0
+                top = np.argsort(-hit_scores[subject], kind='stable')[:2]
+                filtered.extend(refs[pos] for pos in hit_pos[subject][top].tolist())
+            
+            # ===== SCENES (ONLY if match!) =====
+            scene = hit_category == 1
+            for pos, score in zip(hit_pos[scene].tolist(), hit_scores[scene].tolist()):
+                ref = refs[pos]
+                filtered.append(ref)
+                print(f"[FILTER] ✓ Scene ({score}): {ref.get('name', 'Unnamed')}")
+            
+            # ===== STYLES (OR matching) =====
+            filtered.extend(refs[pos] for pos in hit_pos[hit_category == 2].tolist())
+            results.append(filtered)
+        return results
+
+
+def make_generation_task(row_idx, prompt, all_refs, indices=None, selected=None):
+    """
+    Build a queue task with the references selected for this prompt
+    
+    all_refs may be the reference list or a ReferenceIndex built from it
+    (build one per job when queueing many prompts). selected skips
+    filtering: the references already picked for this prompt, e.g. from
+    ReferenceIndex.select_all.
+    
+    Returns:
+        tuple: (row_idx, prompt, indices, ref_paths)
+            indices   - image indices to generate (None = all)
+            ref_paths - paths of the selected references ([] = no refs,
+                        the row goes to plain generateImage)
+    """
+    if selected is not None:
+        filtered = selected
+    elif not all_refs:
+        filtered = []
+    elif isinstance(all_refs, ReferenceIndex):
+        filtered = all_refs.select(prompt)
+    else:
+        filtered = smart_filter_references(prompt, all_refs)
+    return (row_idx, prompt, indices, [r['path'] for r in filtered])
+
+
+def iter_generation_tasks(prompts, missing, ref_index=None, cache=None,
+                          first_chunk=3, max_chunk=1024):
+    """
+    Yield the queue tasks of a job, smart-filtered in growing chunks
+    
+    The first rows are selected on their own so they can be queued (and
+    generated) right away; later chunks grow x4 up to max_chunk to keep
+    select_all's batching. Consumers can stop between tasks.
+    
+    Args:
+        missing (dict): {row: image indices (None = all)} of the rows to queue
+        ref_index (ReferenceIndex): None or empty = rows go without references
+    """
+    rows = [row for row in range(len(prompts)) if row in missing]
+    size = first_chunk
+    start = 0
+    while start < len(rows):
+        chunk = rows[start:start + size]
+        if ref_index:
+            selections = ref_index.select_all([prompts[row] for row in chunk], cache=cache)
+        else:
+            selections = [[] for _ in chunk]
+        for row, selected in zip(chunk, selections):
+            yield make_generation_task(row, prompts[row], None, indices=missing[row],
+                                       selected=selected)
+        start += size
+        size = min(size * 4, max_chunk)
+
+
+# ==================== UTILITY FUNCTIONS ====================
+
+def parse_cookie_input(raw_input):
+    """Parse cookie from various input formats"""
+    raw_input = raw_input.strip()
+    if not raw_input:
+        return ''
+    
+    # JSON format (array or single object)
+    if raw_input.startswith('[') or raw_input.startswith('{'):
+        try:
+            data = json.loads(raw_input)
+            if isinstance(data, dict):
+                data = [data]
+            
+            cookies = []
+            for c in data:
+                if 'name' in c and 'value' in c:
+                    cookies.append(f"{c['name']}={c['value']}")
+            
+            if cookies:
+                return '; '.join(cookies)
+        except:
+            pass
+    
+    # Direct JWT token format
+    if raw_input.startswith('ey'):
+        return f'__Secure-next-auth.session-token={raw_input}'
+    
+    # Already formatted cookie string
+    return raw_input
+
+
+class SplicedBody:
+    """
+    Read-only file-like request body made of several byte buffers
+    
+    Lets captionImage and uploadImage stream the same encoded image buffer
+    between their own small JSON heads/tails, without building a full copy
+    of the body for each request.
+    """
+    
+    def __init__(self, *parts):
+        self.parts = [memoryview(p) for p in parts]
+        self.length = sum(len(p) for p in self.parts)
+        self.pos = 0
+    
+    def __len__(self):
+        return self.length
+    
+    def tell(self):
+        return self.pos
+    
+    def seek(self, pos, whence=0):
+        self.pos = pos if whence == 0 else self.pos + pos if whence == 1 else self.length + pos
+        return self.pos
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.pos
+        out = []
+        offset = 0
+        for part in self.parts:
+            if size <= 0:
+                break
+            start = self.pos - offset
+            offset += len(part)
+            if start >= len(part):
+                continue
+            chunk = part[start:start + size]
+            out.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+        return b''.join(out)
+
+
+def labs_image_body(payload, data_uri):
+    """JSON body for a labs tRPC call with RAW_BYTES_MARK replaced by the shared data URI"""
+    head, tail = json.dumps(payload).encode('utf-8').split(RAW_BYTES_MARK.encode('ascii'))
+    return SplicedBody(head, data_uri, tail)
+
+
+_caption_pool = None
+_caption_pool_lock = threading.Lock()
+
+
+def get_caption_pool():
+    """Shared executor running captionImage alongside uploadImage"""
+    global _caption_pool
+    if _caption_pool is None:
+        with _caption_pool_lock:
+            if _caption_pool is None:
+                _caption_pool = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY,
+                                                   thread_name_prefix='whisk-caption')
+    return _caption_pool
+
+
+def caption_image(client, headers, category, data_uri, sess_id):
+    """captionImage call; returns the caption or '' (captions are optional)"""
+    try:
+        cap_payload = {
+            'json': {
+                'clientContext': {
+                    'workflowId': 'be042ce0-b110-463c-be13-5d23c5bf82b3',
+                    'sessionId': sess_id
+                },
+                'captionInput': {
+                    'candidatesCount': 1,
+                    'mediaInput': {
+                        'mediaCategory': category,
+                        'rawBytes': RAW_BYTES_MARK
+                    }
+                }
+            }
+        }
+        
+        r_cap = client.post(
+            'https://labs.google/fx/api/trpc/backbone.captionImage',
+            headers=headers,
+            data=labs_image_body(cap_payload, data_uri),
+            timeout=40
+        )
+        
+        if r_cap.status_code == 200:
+            cap_data = r_cap.json()
+            candidates = cap_data.get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('candidates', [])
+            if candidates:
+                return candidates[0].get('output', '')
+    except Exception:
+        pass  # Caption is optional
+    return ''
+
+
+def upload_image_static(path, category, cookie_str, token, use_cache=True, caption=None):
+    """
+    Upload image to Google Labs and get caption + media ID
+    
+    captionImage and uploadImage run concurrently on one shared encoded
+    buffer. With a non-empty caption (the user's own) captioning is skipped
+    and that caption is returned.
+    
+    Identical bytes already uploaded to the same account (see MediaCache)
+    are answered from the cache without any network call; pass
+    use_cache=False to force a fresh upload (e.g. for a stale ID).
+    
+    Returns:
+        tuple: (media_id, caption, error_msg)
+    """
+    if not os.path.exists(path):
+        return (None, '', 'File not found')
+    
+    try:
+        # Read and encode image
+        with open(path, 'rb') as f:
+            raw = f.read()
+        
+        profile = preprocess_profile(category)
+        
+        cache = get_media_cache()
+        if cache:
+            digest = hashlib.sha256(raw).hexdigest()
+            if profile:
+                # A different downscale uploads different bytes
+                digest += f":{profile['max_side']}q{profile.get('quality', 85)}"
+            account = account_key(token)
+            hit = cache.get(digest, category, account) if use_cache else None
+            if hit:
+                print(f'[CACHE] {os.path.basename(path)} -> {hit[0][:16]}...')
+                return (hit[0], caption or hit[1], None)
+        
+        ext = os.path.splitext(path)[1].lower()
+        mime = 'image/png' if '.png' in ext else 'image/webp' if '.webp' in ext else 'image/jpeg'
+        
+        # Downscale / strip metadata before encoding
+        data = raw
+        if profile:
+            data, new_mime = preprocess_reference(raw, profile)
+            mime = new_mime or mime
+            if len(data) < len(raw):
+                print(f'[UPLOAD] {os.path.basename(path)}: {len(raw) / 1e6:.2f}MB -> '
+                      f'{len(data) / 1e6:.2f}MB (-{100 - 100 * len(data) // len(raw)}%)')
+        upload_stats.record(len(raw), len(data))
+        
+        # Encoded once, shared by both request bodies
+        data_uri = f'data:{mime};base64,'.encode('ascii') + base64.b64encode(data)
+        del raw, data
+        
+        sess_id = f';{int(datetime.now().timestamp() * 1000)}'
+        client = get_http_client()
+        common_headers = client.headers_for('labs', cookie_str, token)
+        
+        # Caption in the background while the upload runs
+        caption_future = None
+        if not caption:
+            caption_future = get_caption_pool().submit(
+                caption_image, client, common_headers, category, data_uri, sess_id
+            )
+        
+        up_payload = {
+            'json': {
+                'clientContext': {
+                    'workflowId': 'be042ce0-b110-463c-be13-5d23c5bf82b3',
+                    'sessionId': sess_id
+                },
+                'uploadMediaInput': {
+                    'mediaCategory': category,
+                    'rawBytes': RAW_BYTES_MARK
+                }
+            }
+        }
+        
+        r_up = client.post(
+            'https://labs.google/fx/api/trpc/backbone.uploadImage',
+            headers=common_headers,
+            data=labs_image_body(up_payload, data_uri),
+            timeout=60
+        )
+        
+        if r_up.status_code != 200:
+            return (None, '', f'Upload HTTP {r_up.status_code}')
+        
+        up_data = r_up.json()
+        try:
+            mid = up_data.get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('uploadMediaGenerationId')
+            if mid:
+                caption_text = caption or caption_future.result()
+                caption_text = caption_text if caption_text else 'No caption generated'
+                if cache:
+                    cache.put(digest, category, account, mid, caption_text)
+                return (mid, caption_text, None)
+        except Exception as e:
+            return (None, '', f'Parse error: {str(e)}')
+        
+        return (None, '', 'No Media ID returned')
+    
+    except Exception as e:
+        return (None, '', str(e))
+
+
+def make_model_settings(aspect_ratio):
+    """Base imageModelSettings for a job"""
+    return {
+        'imageModel': DEFAULT_IMAGE_MODEL,
+        'aspectRatio': aspect_ratio
+    }
+
+
+def fetch_access_token(cookie_str):
+    """
+    Exchange a cookie for an access token
+    
+    Returns:
+        tuple: (token, exp_timestamp) - (None, 0) if the cookie is invalid,
+               exp_timestamp is 0 when the expiry could not be read
+    """
+    client = get_http_client()
+    
+    try:
+        # Get session token
+        headers = client.headers_for('session', cookie_str)
+        
+        resp = client.get(API_AUTH_SESSION, headers=headers, timeout=20)
+        if resp.status_code != 200:
+            return (None, 0)
+        
+        data = resp.json()
+        token = data.get('access_token') or data.get('accessToken')
+        
+        if not token:
+            return (None, 0)
+        
+        # Validate token and get expiry
+        try:
+            r = client.get(f'{API_TOKEN_INFO}?access_token={token}', timeout=10)
+            if r.status_code == 200:
+                info = r.json()
+                if info.get('sub') or info.get('email'):
+                    _token_accounts[token] = info.get('sub') or info.get('email')
+                return (token, int(info.get('exp', 0)))
+            return (token, 0)
+        except:
+            # Token valid but can't get expiry
+            return (token, 0)
+    
+    except Exception:
+        return (None, 0)
+
+
+class ReferenceUploader:
+    """
+    Uploads references on demand on one bounded pool
+    
+    Nothing is uploaded until some row asks for it (request/when_ready), so
+    references no prompt selects are never sent. prepared / failures fill
+    in as uploads finish and can be shared with the GenerationEngine.
+    """
+    
+    def __init__(self, ref_data_list, cookie_str, token, on_uploaded=None,
+                 on_failed=None, keep_user_captions=True, max_workers=UPLOAD_CONCURRENCY,
+                 should_continue=None):
+        self.cookie_str = cookie_str
+        self.access_token = token
+        self.on_uploaded = on_uploaded
+        self.on_failed = on_failed
+        self.keep_user_captions = keep_user_captions
+        self.should_continue = should_continue
+        self.items = {item['path']: item for item in ref_data_list}
+        self.prepared = {}  # path -> recipeMediaInput
+        self.failures = {}  # path -> error_msg
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers),
+                                        thread_name_prefix='whisk-upload')
+        
+        for item in ref_data_list:
+            if item['type'] == 'uploaded':
+                # Already uploaded
+                self.prepared[item['path']] = {
+                    'caption': item['caption'],
+                    'mediaInput': {
+                        'mediaCategory': item['category'],
+                        'mediaGenerationId': item['media_id']
+                    }
+                }
+    
+    def _upload(self, item):
+        if self.should_continue and not self.should_continue():
+            return
+        caption = item.get('caption') if self.keep_user_captions else None
+        mid, cap, err = upload_image_static(item['path'], item['category'],
+                                            self.cookie_str, self.access_token,
+                                            caption=caption)
+        if mid:
+            self.prepared[item['path']] = {
+                'caption': cap,
+                'mediaInput': {
+                    'mediaCategory': item['category'],
+                    'mediaGenerationId': mid
+                }
+            }
+            if self.on_uploaded:
+                self.on_uploaded(item['path'], mid, cap)
+        else:
+            err = f"Upload Fail {os.path.basename(item['path'])}: {err}"
+            self.failures[item['path']] = err
+            print(f'[REFS] {err}')
+            if self.on_failed:
+                self.on_failed(item['path'], err)
+    
+    def request(self, paths=None):
+        """Start uploads for the given paths (None = all); returns their pending futures"""
+        paths = list(self.items) if paths is None else paths
+        futures = []
+        with self._lock:
+            for path in paths:
+                if path not in self.items or path in self.prepared or path in self.failures:
+                    continue
+                future = self._futures.get(path)
+                if future is None or future.done():
+                    # New, or skipped earlier while paused/stopping
+                    future = self._futures[path] = self._pool.submit(self._upload, self.items[path])
+                if not future.done():
+                    futures.append(future)
+        return futures
+    
+    def when_ready(self, paths, callback):
+        """
+        True if every reference in paths is already uploaded (or failed);
+        otherwise starts the uploads, returns False and calls callback()
+        from a pool thread once the last one finishes
+        """
+        futures = self.request(paths)
+        if not futures:
+            return True
+        
+        state = {'lock': threading.Lock(), 'remaining': len(futures)}
+        
+        def on_done(_):
+            with state['lock']:
+                state['remaining'] -= 1
+                last = state['remaining'] == 0
+            if last:
+                callback()
+        
+        for future in futures:
+            future.add_done_callback(on_done)
+        return False
+    
+    def wait(self, paths=None):
+        """Upload the given references (None = all) and block until finished"""
+        for future in as_completed(self.request(paths)):
+            future.result()
+    
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+        if self._futures:
+            print(f'[UPLOAD] {upload_stats.summary()}')
+
+
+def prepare_references(ref_data_list, cookie_str, token, should_continue=None,
+                       on_uploaded=None, on_failed=None, max_workers=UPLOAD_CONCURRENCY,
+                       keep_user_captions=True):
+    """
+    Upload every non-uploaded reference up front, up to max_workers at a time
+    
+    A failed upload does not stop the others; it is reported through
+    on_failed and in the returned failures, and the job goes on with the
+    references that did upload. (The engine can instead upload lazily, see
+    GenerationEngine.upload_on_demand.)
+    
+    Args:
+        ref_data_list (list): reference dicts (get_reference_data format)
+        should_continue (callable): returns False to abort early
+        on_uploaded (callable): on_uploaded(path, media_id, caption), called
+                                as each upload finishes
+        on_failed (callable): on_failed(path, error_msg)
+        keep_user_captions (bool): skip AI captioning for references that
+                                   already have a caption
+    
+    Returns:
+        tuple: (prepared, failures) - prepared maps path -> recipeMediaInput
+               (keyed by path for per-row selection), failures maps
+               path -> error_msg; prepared is None if aborted
+    """
+    uploader = ReferenceUploader(
+        ref_data_list, cookie_str, token, on_uploaded=on_uploaded, on_failed=on_failed,
+        keep_user_captions=keep_user_captions, max_workers=max_workers,
+        should_continue=should_continue
+    )
+    try:
+        uploader.wait()
+    finally:
+        uploader.shutdown()
+    
+    if should_continue and not should_continue():
+        return (None, uploader.failures)
+    return (uploader.prepared, uploader.failures)
+
+
+# ==================== HTTP CLIENT ====================
+
+class ConnectionStats:
+    """Thread-safe counters for requests sent vs TCP/TLS connections opened"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+    
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+    
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+    
+    @property
+    def reused_connections(self):
+        return max(0, self.requests - self.new_connections)
+    
+    def summary(self):
+        return (f'requests={self.requests} new={self.new_connections} '
+                f'reused={self.reused_connections}')
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that reports every request and every new connection"""
+    
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self.stats
+        
+        class _HTTPPool(HTTPConnectionPool):
+            def _new_conn(pool):
+                stats.record_new_connection()
+                return HTTPConnectionPool._new_conn(pool)
+        
+        class _HTTPSPool(HTTPSConnectionPool):
+            def _new_conn(pool):
+                stats.record_new_connection()
+                return HTTPSConnectionPool._new_conn(pool)
+        
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _HTTPPool,
+            'https': _HTTPSPool
+        }
+    
+    def send(self, request, **kwargs):
+        self.stats.record_request()
+        return super().send(request, **kwargs)
+
+
+class WhiskHttpClient:
+    """
+    Shared keep-alive session used by every network call
+    
+    - One connection pool per host, sized to the generation concurrency
+    - Header sets are built once per (kind, cookie, token) and reused
+    - The session cookie jar is disabled; cookies only travel in the
+      explicit per-account Cookie header, so accounts never mix
+    """
+    
+    HEADER_CACHE_SIZE = 16
+    
+    def __init__(self, pool_size=DEFAULT_CONCURRENCY + 2):
+        self.stats = ConnectionStats()
+        self.pool_size = 0
+        self._lock = threading.Lock()
+        self._headers = {}
+        
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.ensure_pool_size(pool_size)
+    
+    def ensure_pool_size(self, pool_size):
+        """Grow the per-host pool so every in-flight request keeps a socket"""
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            adapter = CountingHTTPAdapter(
+                self.stats,
+                pool_connections=8,
+                pool_maxsize=pool_size
+            )
+            old = self.session.adapters.get('https://')
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.pool_size = pool_size
+        # The replaced adapter's idle sockets would otherwise linger until GC;
+        # connections still checked out are closed when they are released
+        if old is not None:
+            old.close()
+    
+    def headers_for(self, kind, cookie_str='', token=''):
+        """
+        Get a prebuilt header dict (treat as read-only)
+        
+        kind:
+            'labs'    - labs.google tRPC calls (caption/upload)
+            'sandbox' - aisandbox-pa image generation
+            'session' - auth session lookup (cookie only)
+        """
+        key = (kind, cookie_str, token)
+        headers = self._headers.get(key)
+        if headers is not None:
+            return headers
+        
+        if kind == 'session':
+            headers = {
+                'Cookie': parse_cookie_input(cookie_str),
+                'Content-Type': 'text/plain;charset=UTF-8',
+                'User-Agent': USER_AGENT_STR
+            }
+        else:
+            headers = {
+                'Authorization': f'Bearer {token}',
+                'Content-Type': 'application/json',
+                'User-Agent': USER_AGENT_STR,
+                'Origin': 'https://labs.google',
+                'Referer': 'https://labs.google/fx/tools/whisk',
+                'Authority': 'labs.google'
+            }
+            if kind == 'sandbox':
+                headers['Accept-Language'] = 'en-US,en;q=0.9'
+                headers['X-Kl-Ajax-Request'] = 'Ajax_Request'
+            headers['Cookie'] = parse_cookie_input(cookie_str)
+        
+        with self._lock:
+            if len(self._headers) >= self.HEADER_CACHE_SIZE:
+                self._headers.clear()
+            self._headers[key] = headers
+        return headers
+    
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """Get the process-wide WhiskHttpClient (created on first use)"""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = WhiskHttpClient()
+    return _http_client
+
+
+# ==================== MEDIA CACHE ====================
+
+class MediaCache:
+    """
+    Persistent reference upload cache in APP_DIR/media_cache.sqlite3
+    
+    Keyed by SHA-256 of the image bytes + media category + account, so an
+    unchanged reference maps straight to its media ID and caption without
+    any captionImage/uploadImage calls. Entries expire after TTL and can be
+    invalidated when the server no longer accepts an ID.
+    """
+    
+    TTL = 7 * 86400
+    
+    def __init__(self, path=MEDIA_CACHE_FILE, ttl=TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS media (
+                digest TEXT NOT NULL,
+                category TEXT NOT NULL,
+                account TEXT NOT NULL,
+                media_id TEXT NOT NULL,
+                caption TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (digest, category, account)
+            )
+        ''')
+        self.conn.execute('DELETE FROM media WHERE created < ?', (time.time() - self.ttl,))
+        self.conn.commit()
+    
+    def get(self, digest, category, account):
+        """(media_id, caption) for a fresh entry, else None"""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT media_id, caption FROM media WHERE digest = ? AND category = ? '
+                'AND account = ? AND created >= ?',
+                (digest, category, account, time.time() - self.ttl)
+            ).fetchone()
+        return tuple(row) if row else None
+    
+    def put(self, digest, category, account, media_id, caption):
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, category, account, media_id, caption, time.time())
+            )
+            self.conn.commit()
+    
+    def invalidate_media(self, media_id):
+        """Forget a media ID the server rejected (stale / expired)"""
+        with self._lock:
+            self.conn.execute('DELETE FROM media WHERE media_id = ?', (media_id,))
+            self.conn.commit()
+
+
+_media_cache = None
+_media_cache_lock = threading.Lock()
+_token_accounts = {}  # access token -> account id (tokeninfo 'sub')
+
+
+def get_media_cache():
+    """Get the process-wide MediaCache, or None if the database can't be opened"""
+    global _media_cache
+    if _media_cache is None:
+        with _media_cache_lock:
+            if _media_cache is None:
+                try:
+                    _media_cache = MediaCache()
+                except sqlite3.Error as e:
+                    print(f'[CACHE] Disabled: {e}')
+                    _media_cache = False
+    return _media_cache or None
+
+
+def account_key(token):
+    """
+    Stable id of the account behind a token, for cache keys
+    
+    Uses tokeninfo 'sub' (looked up once per token); falls back to a hash of
+    the token itself, which still caches within the token's lifetime.
+    """
+    if token not in _token_accounts:
+        account = None
+        try:
+            r = get_http_client().get(f'{API_TOKEN_INFO}?access_token={token}', timeout=10)
+            if r.status_code == 200:
+                info = r.json()
+                account = info.get('sub') or info.get('email')
+        except Exception:
+            pass
+        _token_accounts[token] = account or 'token:' + hashlib.sha256(token.encode()).hexdigest()
+    return _token_accounts[token]
+
+
+# ==================== REFERENCE LIBRARY ====================
+
+def split_tags(tags):
+    """'Hero, man ,  ' -> ['hero', 'man']"""
+    return [t.strip().lower() for t in (tags or '').split(',') if t.strip()]
+
+
+class ReferenceLibrary:
+    """
+    Persistent reference library in APP_DIR/library.sqlite3
+    
+    Holds every reference ever saved (path, category, name, tags, caption,
+    last media ID, semantic embedding once store_embeddings needs it) with
+    indexes on name, tag and category, plus named sets
+    (the dialog's last state is LAST_SET). Queries return
+    get_reference_data-style dicts that go straight into a job.
+    """
+    
+    LAST_SET = '__last__'
+    
+    def __init__(self, path=LIBRARY_FILE):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS refs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL UNIQUE,
+                category TEXT NOT NULL,
+                name TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+                tags TEXT NOT NULL DEFAULT '',
+                caption TEXT NOT NULL DEFAULT '',
+                media_id TEXT,
+                media_time REAL,
+                embedding BLOB,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_refs_name ON refs (name);
+            CREATE INDEX IF NOT EXISTS idx_refs_category ON refs (category, name);
+            CREATE TABLE IF NOT EXISTS ref_tags (
+                tag TEXT NOT NULL,
+                ref_id INTEGER NOT NULL REFERENCES refs (id) ON DELETE CASCADE,
+                PRIMARY KEY (tag, ref_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_ref_tags_ref ON ref_tags (ref_id);
+            CREATE TABLE IF NOT EXISTS set_refs (
+                set_name TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                ref_id INTEGER NOT NULL REFERENCES refs (id) ON DELETE CASCADE,
+                PRIMARY KEY (set_name, position)
+            );
+        ''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(refs)')}
+        if 'embedding' not in columns:  # libraries created before semantic matching
+            self.conn.execute('ALTER TABLE refs ADD COLUMN embedding BLOB')
+    
+    def _save(self, item, now):
+        """Upsert one reference dict (caller holds the lock); returns its id"""
+        media_id = item.get('media_id')
+        self.conn.execute(
+            'INSERT INTO refs (path, category, name, tags, caption, media_id, media_time, '
+            'embedding, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (path) DO UPDATE SET category = excluded.category, '
+            'name = excluded.name, tags = excluded.tags, caption = excluded.caption, '
+            'media_id = COALESCE(excluded.media_id, refs.media_id), '
+            'media_time = CASE WHEN excluded.media_id IS NULL OR excluded.media_id = refs.media_id '
+            'THEN refs.media_time ELSE excluded.media_time END, '
+            'embedding = CASE WHEN excluded.embedding IS NOT NULL THEN excluded.embedding '
+            'WHEN refs.category = excluded.category AND refs.tags = excluded.tags '
+            'AND refs.caption = excluded.caption THEN refs.embedding END, '
+            'updated = excluded.updated',
+            (os.path.abspath(item['path']), item['category'], item.get('name', ''),
+             item.get('tags', ''), item.get('caption', ''), media_id, now if media_id else None,
+             item['embedding'] if embedding_is_current(item) else None, now)
+        )
+        ref_id = self.conn.execute('SELECT id FROM refs WHERE path = ?',
+                                   (os.path.abspath(item['path']),)).fetchone()[0]
+        self.conn.execute('DELETE FROM ref_tags WHERE ref_id = ?', (ref_id,))
+        self.conn.executemany('INSERT OR IGNORE INTO ref_tags (tag, ref_id) VALUES (?, ?)',
+                              [(tag, ref_id) for tag in split_tags(item.get('tags'))])
+        return ref_id
+    
+    def save(self, ref_data_list):
+        """Add or update references (matched by path); returns their ids"""
+        now = time.time()
+        with self._lock, self.conn:
+            return [self._save(item, now) for item in ref_data_list]
+    
+    def save_set(self, name, ref_data_list):
+        """Save references and remember them, in order, as a named set"""
+        now = time.time()
+        with self._lock, self.conn:
+            ids = [self._save(item, now) for item in ref_data_list]
+            self.conn.execute('DELETE FROM set_refs WHERE set_name = ?', (name,))
+            self.conn.executemany(
+                'INSERT INTO set_refs (set_name, position, ref_id) VALUES (?, ?, ?)',
+                [(name, pos, ref_id) for pos, ref_id in enumerate(ids)]
+            )
+        return ids
+    
+    def set_names(self):
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT DISTINCT set_name FROM set_refs WHERE set_name != ? ORDER BY set_name',
+                (self.LAST_SET,)
+            ).fetchall()
+        return [r[0] for r in rows]
+    
+    def load_set(self, name):
+        """References of a named set, in saved order"""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT refs.* FROM set_refs JOIN refs ON refs.id = set_refs.ref_id '
+                'WHERE set_name = ? ORDER BY position', (name,)
+            ).fetchall()
+        return [self.to_reference_data(r) for r in rows]
+    
+    def search(self, text='', category=None, tags=None, limit=500):
+        """
+        Query the library
+        
+        Args:
+            text (str): name prefix or tag prefix (case-insensitive)
+            category (str): MEDIA_CATEGORY_* to restrict to
+            tags (list): every one of these tags must be present
+        """
+        where, params = [], []
+        text = (text or '').strip().lower()
+        if text:
+            like = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where.append("(name LIKE ? ESCAPE '\\' OR id IN "
+                         '(SELECT ref_id FROM ref_tags WHERE tag >= ? AND tag < ?))')
+            params += [like, text, text + '\uffff']
+        if category:
+            where.append('category = ?')
+            params.append(category)
+        for tag in tags or []:
+            where.append('id IN (SELECT ref_id FROM ref_tags WHERE tag = ?)')
+            params.append(tag.strip().lower())
+        
+        sql = 'SELECT * FROM refs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY category, name LIMIT ?'
+        with self._lock:
+            rows = self.conn.execute(sql, params + [limit]).fetchall()
+        return [self.to_reference_data(r) for r in rows]
+    
+    def record_upload(self, path, media_id, caption):
+        """Keep a library reference's latest media ID/caption"""
+        path = os.path.abspath(path)
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE refs SET media_id = ?, media_time = ?, caption = ?, '
+                'embedding = CASE WHEN caption = ? THEN embedding END WHERE path = ?',
+                (media_id, time.time(), caption, caption, path)
+            )
+    
+    def store_embeddings(self, ref_data_list, locale=None):
+        """
+        Compute and keep the keyword vectors semantic matching needs
+        
+        Run when a semantic job starts, off the GUI thread: only references
+        whose stored vectors are missing or stale are embedded. The dicts get
+        their 'embedding' filled in so the job's ReferenceIndex reuses them.
+        """
+        paths = [os.path.abspath(item['path']) for item in ref_data_list]
+        with self._lock:
+            stored = dict(self.conn.execute(
+                'SELECT path, embedding FROM refs WHERE path IN (SELECT value FROM json_each(?))',
+                (json.dumps(paths),)
+            ).fetchall())
+        updates = []
+        for item, path in zip(ref_data_list, paths):
+            if path in stored and not embedding_is_current(dict(item, embedding=stored[path]), locale):
+                stored[path] = pack_embedding(dict(item, embedding=None), locale)
+                if stored[path] is None:  # no NumPy
+                    return
+                updates.append((stored[path], path))
+            if stored.get(path) is not None:
+                item['embedding'] = stored[path]
+        if updates:
+            with self._lock, self.conn:
+                self.conn.executemany('UPDATE refs SET embedding = ? WHERE path = ?', updates)
+    
+    def remove(self, ref_ids):
+        with self._lock, self.conn:
+            self.conn.executemany('DELETE FROM refs WHERE id = ?', [(i,) for i in ref_ids])
+    
+    @staticmethod
+    def to_reference_data(row):
+        """Library row -> get_reference_data dict (media IDs past the cache TTL are dropped)"""
+        media_id = row['media_id']
+        if media_id and (row['media_time'] or 0) < time.time() - MediaCache.TTL:
+            media_id = None
+        is_style = row['category'] == 'MEDIA_CATEGORY_STYLE'
+        return {
+            'id': row['id'],
+            'path': row['path'],
+            'category': row['category'],
+            'media_id': media_id,
+            'name': '' if is_style else row['name'],
+            'tags': '' if is_style else row['tags'],
+            'caption': row['caption'],
+            'embedding': row['embedding'],
+            'type': 'uploaded' if media_id else 'pending'
+        }
+
+
+# ==================== SELECTION CACHE ====================
+
+class SelectionCache:
+    """
+    Persistent LRU cache of reference selections in APP_DIR/selections.sqlite3
+    
+    Keyed by the folded prompt and ReferenceIndex.fingerprint (reference
+    metadata + matching options), so rerunning a prompt list against an
+    unchanged reference set skips selection entirely. Stores the selected
+    reference positions; keeps at most max_entries selections, evicting
+    the least recently used.
+    """
+    
+    MAX_ENTRIES = 100000
+    CHUNK = 500  # prompts per lookup query
+    
+    def __init__(self, path=SELECTION_CACHE_FILE, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS selections (
+                fingerprint TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                positions TEXT NOT NULL,
+                used REAL NOT NULL,
+                PRIMARY KEY (fingerprint, prompt)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_selections_used ON selections (used);
+        ''')
+    
+    def get_many(self, fingerprint, prompts):
+        """{prompt: [reference positions]} for the cached ones (marks them used)"""
+        found = {}
+        with self._lock, self.conn:
+            for start in range(0, len(prompts), self.CHUNK):
+                chunk = prompts[start:start + self.CHUNK]
+                rows = self.conn.execute(
+                    'SELECT prompt, positions FROM selections WHERE fingerprint = ? '
+                    f'AND prompt IN ({",".join("?" * len(chunk))})', [fingerprint] + chunk
+                ).fetchall()
+                found.update((prompt, json.loads(positions)) for prompt, positions in rows)
+            now = time.time()
+            self.conn.executemany(
+                'UPDATE selections SET used = ? WHERE fingerprint = ? AND prompt = ?',
+                [(now, fingerprint, prompt) for prompt in found]
+            )
+        return found
+    
+    def put_many(self, fingerprint, selections):
+        """Store {prompt: [reference positions]}, then evict past max_entries"""
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO selections VALUES (?, ?, ?, ?)',
+                [(fingerprint, prompt, json.dumps(positions), now)
+                 for prompt, positions in selections.items()]
+            )
+            excess = self.conn.execute('SELECT COUNT(*) FROM selections').fetchone()[0] \
+                - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    'DELETE FROM selections WHERE (fingerprint, prompt) IN '
+                    '(SELECT fingerprint, prompt FROM selections ORDER BY used LIMIT ?)',
+                    (excess,)
+                )
+
+
+_selection_cache = None
+_selection_cache_lock = threading.Lock()
+
+
+def get_selection_cache():
+    """Get the process-wide SelectionCache, or None if the database can't be opened"""
+    global _selection_cache
+    if _selection_cache is None:
+        with _selection_cache_lock:
+            if _selection_cache is None:
+                try:
+                    _selection_cache = SelectionCache()
+                except sqlite3.Error as e:
+                    print(f'[FILTER] Selection cache disabled: {e}')
+                    _selection_cache = False
+    return _selection_cache or None
+
+
+# ==================== UPLOAD PREPROCESSING ====================
+
+class UploadStats:
+    """Thread-safe totals of reference bytes read vs bytes actually uploaded"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files = 0
+        self.original_bytes = 0
+        self.sent_bytes = 0
+    
+    def record(self, original, sent):
+        with self._lock:
+            self.files += 1
+            self.original_bytes += original
+            self.sent_bytes += sent
+    
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - self.sent_bytes
+    
+    def summary(self):
+        return (f'files={self.files} original={self.original_bytes / 1e6:.1f}MB '
+                f'sent={self.sent_bytes / 1e6:.1f}MB saved={self.saved_bytes / 1e6:.1f}MB')
+
+
+upload_stats = UploadStats()
+
+
+def preprocess_profile(category):
+    """Active downscale profile for a category, or None to upload the file as-is"""
+    profile = UPLOAD_PREPROCESS.get(category)
+    if Image is None or not profile or not profile.get('max_side'):
+        return None
+    return profile
+
+
+def preprocess_reference(raw, profile):
+    """
+    Downscale and re-encode a reference image before upload
+    
+    Applies the EXIF orientation, caps the longest side at
+    profile['max_side'] and re-encodes without metadata: JPEG, or WebP when
+    the image has transparency. The original is kept if re-encoding does not
+    make it smaller.
+    
+    Returns:
+        tuple: (bytes, mime) - mime is None when the original was kept
+    """
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((profile['max_side'], profile['max_side']), Image.LANCZOS)
+        
+        out = io.BytesIO()
+        if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+            img.convert('RGBA').save(out, 'WEBP', quality=profile.get('quality', 85))
+            mime = 'image/webp'
+        else:
+            img.convert('RGB').save(out, 'JPEG', quality=profile.get('quality', 85),
+                                    optimize=True, progressive=True)
+            mime = 'image/jpeg'
+    except Exception as e:
+        print(f'[UPLOAD] Preprocess skipped: {e}')
+        return raw, None
+    
+    data = out.getvalue()
+    if len(data) >= len(raw):
+        return raw, None
+    return data, mime
+
+
+# ==================== RATE CONTROL ====================
+
+class AdaptiveRateController:
+    """
+    Token bucket + AIMD pacing for image requests
+    
+    - rate:  requests/second refilled into the bucket
+    - limit: how many requests may be in flight at once
+    
+    Healthy, fast responses raise the rate additively and (every few
+    successes) the in-flight limit by one. 429/5xx, network errors and
+    very slow responses cut both multiplicatively.
+    """
+    
+    MIN_RATE = 0.05
+    MAX_RATE = 5.0
+    RATE_STEP = 0.05  # Additive increase per healthy response
+    DECREASE_FACTOR = 0.5  # Multiplicative decrease on 429/5xx/errors
+    SLOW_FACTOR = 0.8  # Gentler decrease when latency is too high
+    SLOW_LATENCY = 30.0  # Seconds; responses slower than this count as congestion
+    LIMIT_INCREASE_EVERY = 5  # Healthy responses per +1 in-flight slot
+    
+    def __init__(self, max_limit, initial_rate=1.0, on_change=None):
+        self.max_limit = max(1, int(max_limit))
+        self.limit = self.max_limit
+        self.rate = max(self.MIN_RATE, min(initial_rate, self.MAX_RATE))
+        self.on_change = on_change
+        self.in_flight = 0
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._healthy_streak = 0
+        self._last_reported = None
+        self._cond = threading.Condition()
+    
+    def _refill(self):
+        now = time.monotonic()
+        burst = max(1.0, float(self.limit))
+        self._tokens = min(burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+    
+    def acquire_slot(self, should_continue):
+        """Wait for an in-flight slot; False if should_continue() turns False"""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                if not should_continue():
+                    return False
+                self._cond.wait(0.5)
+            self.in_flight += 1
+            return True
+    
+    def release_slot(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+    
+    def acquire_token(self, should_continue):
+        """Wait for a bucket token before sending; False if stopped"""
+        while should_continue():
+            with self._cond:
+                self._refill()
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return True
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(min(wait, 0.5))
+        return False
+    
+    def record(self, status_code, latency):
+        """
+        Feed back one response
+        
+        status_code: HTTP status, or None for timeouts/connection errors
+        latency: seconds from send to response
+        """
+        with self._cond:
+            congested = status_code is None or status_code == 429 or status_code >= 500
+            
+            if congested:
+                self.rate = max(self.MIN_RATE, self.rate * self.DECREASE_FACTOR)
+                self.limit = max(1, self.limit // 2)
+                self._tokens = min(self._tokens, 0.0)
+                self._healthy_streak = 0
+            elif latency > self.SLOW_LATENCY:
+                self.rate = max(self.MIN_RATE, self.rate * self.SLOW_FACTOR)
+                self._healthy_streak = 0
+            else:
+                self.rate = min(self.MAX_RATE, self.rate + self.RATE_STEP)
+                self._healthy_streak += 1
+                if (self._healthy_streak >= self.LIMIT_INCREASE_EVERY
+                        and self.limit < self.max_limit):
+                    self.limit += 1
+                    self._healthy_streak = 0
+            
+            self._cond.notify_all()
+            rate, limit = self.rate, self.limit
+        
+        self._report(rate, limit, status_code, latency)
+    
+    def _report(self, rate, limit, status_code, latency):
+        """Log and publish when the rate moves ≥10% or the limit changes"""
+        last = self._last_reported
+        if last is not None:
+            last_rate, last_limit = last
+            if limit == last_limit and abs(rate - last_rate) < last_rate * 0.1:
+                return
+        self._last_reported = (rate, limit)
+        
+        code = status_code if status_code is not None else 'ERR'
+        print(f'[RATE] {rate:.2f} req/s, limit {limit} '
+              f'(last: {code} in {latency:.1f}s)')
+        if self.on_change:
+            self.on_change(rate, limit)
+
+
+# ==================== RETRY POLICY ====================
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (seconds or HTTP date) into seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def describe_http_error(resp):
+    """Short human-readable reason for a non-200 response"""
+    reason = ''
+    try:
+        err = resp.json().get('error', {})
+        if isinstance(err, dict):
+            reason = err.get('status') or err.get('message') or ''
+        elif isinstance(err, str):
+            reason = err
+    except Exception:
+        pass
+    
+    msg = f'HTTP {resp.status_code}'
+    if resp.status_code == 401:
+        msg += ' Unauthorized - check cookie'
+    elif reason:
+        msg += f': {reason}'
+    return msg[:80]
+
+
+class RetryPolicy:
+    """
+    Sort failures into retryable / terminal and compute backoff delays
+    
+    Retryable: timeouts, connection errors, 408, 429, 5xx
+    Terminal:  everything else (401/403 auth, 400 policy rejections, ...)
+    """
+    
+    RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+    # google.rpc statuses / ErrorInfo reasons for an unknown media ID
+    STALE_MEDIA_STATUS = {'NOT_FOUND'}
+    STALE_MEDIA_REASONS = {'MEDIA_NOT_FOUND', 'INVALID_MEDIA_GENERATION_ID',
+                           'MEDIA_GENERATION_ID_NOT_FOUND'}
+    
+    def __init__(self, max_attempts=4, base_delay=2.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def classify(self, resp, exc):
+        """Return (retryable, error_msg) for a failed attempt"""
+        if exc is not None:
+            if isinstance(exc, requests.Timeout):
+                return True, 'Timeout'
+            if isinstance(exc, requests.ConnectionError):
+                return True, 'Connection error'
+            return False, f'{type(exc).__name__}: {exc}'[:80]
+        
+        code = resp.status_code
+        retryable = code in self.RETRYABLE_STATUS or code >= 500
+        return retryable, describe_http_error(resp)
+    
+    def is_stale_media(self, resp):
+        """
+        True if a rejection names an unknown/expired reference media ID
+        
+        Only NOT_FOUND, a known invalid-media ErrorInfo reason, or an
+        INVALID_ARGUMENT pointing at mediaGenerationId count; policy and
+        other 400s must not trigger a re-upload.
+        """
+        if resp is None or resp.status_code not in (400, 404):
+            return False
+        try:
+            err = resp.json().get('error', {})
+        except Exception:
+            return False
+        if not isinstance(err, dict):
+            return False
+        if err.get('status') in self.STALE_MEDIA_STATUS:
+            return True
+        for detail in err.get('details') or []:
+            if not isinstance(detail, dict):
+                continue
+            if str(detail.get('reason', '')).upper() in self.STALE_MEDIA_REASONS:
+                return True
+            for violation in detail.get('fieldViolations') or []:
+                if 'mediagenerationid' in str(violation.get('field', '')).lower():
+                    return True
+        return (err.get('status') == 'INVALID_ARGUMENT'
+                and 'mediagenerationid' in str(err.get('message', '')).lower())
+    
+    def retry_after(self, resp):
+        """Server-requested delay (Retry-After header or google.rpc.RetryInfo)"""
+        if resp is None:
+            return None
+        delay = parse_retry_after(resp.headers.get('Retry-After'))
+        if delay is not None:
+            return delay
+        try:
+            for detail in resp.json().get('error', {}).get('details', []):
+                retry_delay = detail.get('retryDelay')
+                if retry_delay:
+                    return float(str(retry_delay).rstrip('s'))
+        except Exception:
+            pass
+        return None
+    
+    def backoff(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, never shorter than Retry-After"""
+        cap = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(self.base_delay / 2, cap)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Global breaker shared by all generation threads
+    
+    closed    - requests flow normally
+    open      - endpoint looks down; every worker waits out the cooldown
+    half_open - one probe request is let through; success closes the
+                breaker, failure re-opens it with a doubled cooldown
+    
+    Also honors server-requested holds (429 + Retry-After) for everyone.
+    """
+    
+    FAILURE_THRESHOLD = 5  # Consecutive retryable failures before opening
+    BASE_COOLDOWN = 30.0
+    MAX_COOLDOWN = 300.0
+    
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.state = 'closed'
+        self.failures = 0
+        self.cooldown = self.BASE_COOLDOWN
+        self.open_until = 0.0
+        self.hold_until = 0.0
+        self._probe_in_flight = False
+        self._probe_thread = None  # thread sending the half-open probe
+        self._lock = threading.Lock()
+    
+    def _set_state(self, state):
+        """Change state (caller holds the lock); returns the notification"""
+        if state == self.state:
+            return None
+        self.state = state
+        remaining = max(0.0, self.open_until - time.monotonic()) if state == 'open' else 0.0
+        print(f'[CIRCUIT] {state}' + (f' for {remaining:.0f}s' if remaining else ''))
+        return (state, remaining)
+    
+    def _notify(self, change):
+        if change and self.on_change:
+            self.on_change(*change)
+    
+    def wait_until_closed(self, should_continue):
+        """Block until a request may be sent; False if stopped meanwhile"""
+        while should_continue():
+            change = None
+            with self._lock:
+                now = time.monotonic()
+                if self.state == 'open' and now >= self.open_until:
+                    change = self._set_state('half_open')
+                
+                if self.state == 'closed' and now >= self.hold_until:
+                    allowed = True
+                elif self.state == 'half_open' and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    self._probe_thread = threading.get_ident()
+                    allowed = True
+                else:
+                    allowed = False
+            self._notify(change)
+            if allowed:
+                return True
+            time.sleep(0.5)
+        return False
+    
+    def release_probe(self):
+        """
+        Give up this thread's half-open probe without an outcome (stopped,
+        or the request failed before reaching the endpoint), so another
+        worker can probe instead of every worker waiting forever
+        """
+        with self._lock:
+            if self._probe_in_flight and self._probe_thread == threading.get_ident():
+                self._probe_in_flight = False
+                self._probe_thread = None
+    
+    def hold(self, seconds):
+        """Pause all workers for a server-requested delay"""
+        with self._lock:
+            self.hold_until = max(self.hold_until, time.monotonic() + seconds)
+    
+    def record_success(self):
+        """Endpoint answered (200 or a terminal 4xx)"""
+        with self._lock:
+            self.failures = 0
+            self._probe_in_flight = False
+            self._probe_thread = None
+            self.cooldown = self.BASE_COOLDOWN
+            change = self._set_state('closed')
+        self._notify(change)
+    
+    def record_failure(self):
+        """Endpoint failed with a retryable error"""
+        change = None
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open':
+                self._probe_in_flight = False
+                self._probe_thread = None
+                self.cooldown = min(self.cooldown * 2, self.MAX_COOLDOWN)
+                self.open_until = time.monotonic() + self.cooldown
+                change = self._set_state('open')
+            elif self.state == 'closed' and self.failures >= self.FAILURE_THRESHOLD:
+                self.open_until = time.monotonic() + self.cooldown
+                change = self._set_state('open')
+        self._notify(change)
+
+
+# ==================== DISK WRITER ====================
+
+class WriteHandle:
+    """Producer-side handle for one file queued on a DiskWriter thread"""
+    
+    def __init__(self, work_queue, path):
+        self.work_queue = work_queue
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.file = None
+        self.error = None
+        self.on_done = None
+    
+    def write(self, data):
+        """Queue a chunk (blocks while the writer is behind = backpressure)"""
+        self.work_queue.put(('write', self, data))
+    
+    def commit(self, on_done=None):
+        """Make the file durable and visible; on_done(path, error) runs after"""
+        self.on_done = on_done
+        self.work_queue.put(('commit', self, None))
+    
+    def discard(self):
+        """Drop the file (temp file is removed, nothing is renamed)"""
+        self.work_queue.put(('discard', self, None))
+
+
+class DiskWriter:
+    """
+    Bounded background stage for image files
+    
+    - Each file goes to one writer thread, so its chunks stay in order
+    - Chunks land in '<name>.part'; commit fsyncs and atomically renames it,
+      so a crash never leaves a half-written image under the final name
+    - Every file still gets its own fsync (its data must be durable before
+      the rename); commits that pile up while a thread is busy are renamed
+      as one batch, so the directory is fsynced once per batch, not per file
+    - Per-thread queues are bounded; producers block when the disk lags
+    """
+    
+    QUEUE_CHUNKS = 256  # ~12 MB of decoded chunks per thread
+    FSYNC_BATCH = 8
+    FSYNC_INTERVAL = 0.2
+    
+    def __init__(self, num_threads=1):
+        self.queues = [queue.Queue(maxsize=self.QUEUE_CHUNKS) for _ in range(max(1, num_threads))]
+        self.threads = []
+        self._next = 0
+        self._lock = threading.Lock()
+    
+    def start(self):
+        for n, q in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(q,),
+                                 name=f'whisk-writer-{n}', daemon=True)
+            t.start()
+            self.threads.append(t)
+    
+    def open(self, path):
+        """Get a WriteHandle for path (round-robin across writer threads)"""
+        with self._lock:
+            q = self.queues[self._next % len(self.queues)]
+            self._next += 1
+        return WriteHandle(q, path)
+    
+    def close(self):
+        """Drain every queue, sync what is pending and stop the threads"""
+        for q in self.queues:
+            q.put(('stop', None, None))
+        for t in self.threads:
+            t.join()
+        self.threads = []
+    
+    def _run(self, work_queue):
+        pending = []  # Committed handles waiting for fsync + rename
+        
+        while True:
+            try:
+                if pending:
+                    op, handle, data = work_queue.get(timeout=self.FSYNC_INTERVAL)
+                else:
+                    op, handle, data = work_queue.get()
+            except queue.Empty:
+                self._sync(pending)
+                pending = []
+                continue
+            
+            if op == 'write':
+                self._write(handle, data)
+            elif op == 'commit':
+                self._write(handle, b'')  # Make sure empty files exist too
+                pending.append(handle)
+                if len(pending) >= self.FSYNC_BATCH or work_queue.empty():
+                    self._sync(pending)
+                    pending = []
+            elif op == 'discard':
+                self._discard(handle)
+            else:  # stop
+                self._sync(pending)
+                return
+    
+    def _write(self, handle, data):
+        if handle.error:
+            return
+        try:
+            if handle.file is None:
+                handle.file = open(handle.tmp_path, 'wb')
+            if data:
+                handle.file.write(data)
+        except OSError as e:
+            handle.error = str(e)
+    
+    def _discard(self, handle):
+        try:
+            if handle.file is not None:
+                handle.file.close()
+            if os.path.exists(handle.tmp_path):
+                os.remove(handle.tmp_path)
+        except OSError:
+            pass
+    
+    def _sync(self, handles):
+        dirs = set()
+        for h in handles:
+            if h.error:
+                continue
+            try:
+                h.file.flush()
+                os.fsync(h.file.fileno())
+                h.file.close()
+                os.replace(h.tmp_path, h.path)
+                dirs.add(os.path.dirname(os.path.abspath(h.path)))
+            except OSError as e:
+                h.error = str(e)  # Cleaned up with the other failures below
+        
+        # Persist the renames (not possible on Windows)
+        if hasattr(os, 'O_DIRECTORY'):
+            for d in dirs:
+                try:
+                    fd = os.open(d, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+        
+        for h in handles:
+            if h.error:
+                self._discard(h)
+            if h.on_done:
+                try:
+                    h.on_done(None if h.error else h.path, h.error)
+                except Exception as e:
+                    print(f'[WRITER] Callback failed for {h.path}: {e}')
+
+
+# ==================== RESPONSE DECODING ====================
+
+class EncodedImageStream:
+    """
+    Incremental extractor for "encodedImage" values in a JSON byte stream
+    
+    Response chunks are fed in as they arrive. Each base64 value is decoded
+    in 4-char-aligned pieces straight into the sink returned by
+    open_sink(index), so only one chunk plus a few carry-over bytes are in
+    memory at a time (no full text, dict, base64 str and bytes copies).
+    
+    open_sink(index) -> sink with write(bytes)/discard() (e.g. a
+    WriteHandle), or None to skip that image. Completed sinks are collected
+    in `finished` and left for the caller to commit, so a response that
+    breaks halfway never produces any files.
+    """
+    
+    KEY = b'"encodedImage"'
+    PANELS_KEY = b'"imagePanels"'
+    
+    def __init__(self, open_sink):
+        self.open_sink = open_sink
+        self.state = 'scan'  # scan -> colon -> quote -> value -> scan
+        self.buf = b''
+        self.carry = b''
+        self.sink = None
+        self.sink_bytes = 0
+        self.index = 0
+        self.saw_panels = False
+        self.finished = []  # (image_index, sink) for every non-empty image
+    
+    def feed(self, chunk):
+        data = self.buf + chunk
+        self.buf = b''
+        
+        while data:
+            if self.state == 'scan':
+                if not self.saw_panels and self.PANELS_KEY in data:
+                    self.saw_panels = True
+                pos = data.find(self.KEY)
+                if pos < 0:
+                    # Keep a tail in case a key straddles the chunk boundary
+                    self.buf = data[-(len(self.KEY) - 1):]
+                    return
+                data = data[pos + len(self.KEY):]
+                self.state = 'colon'
+            
+            elif self.state in ('colon', 'quote'):
+                data = data.lstrip()
+                if not data:
+                    return
+                expected = b':' if self.state == 'colon' else b'"'
+                if data[:1] != expected:
+                    self.state = 'scan'  # Not a key/value pair after all
+                    continue
+                data = data[1:]
+                if self.state == 'colon':
+                    self.state = 'quote'
+                else:
+                    self._open()
+                    self.state = 'value'
+            
+            else:  # value
+                end = data.find(b'"')
+                segment = data if end < 0 else data[:end]
+                if end < 0 and segment.endswith(b'\\'):
+                    # Escape sequence split across chunks
+                    self.buf = b'\\'
+                    segment = segment[:-1]
+                self._write(segment.replace(b'\\/', b'/'))
+                if end < 0:
+                    return
+                self._close()
+                data = data[end + 1:]
+                self.state = 'scan'
+    
+    def _open(self):
+        self.sink = self.open_sink(self.index)
+        self.sink_bytes = 0
+        self.carry = b''
+    
+    def _write(self, segment):
+        if self.sink is None:
+            return
+        b64 = self.carry + segment
+        n = len(b64) - len(b64) % 4
+        if n:
+            decoded = base64.b64decode(b64[:n])
+            self.sink.write(decoded)
+            self.sink_bytes += len(decoded)
+        self.carry = b64[n:]
+    
+    def _close(self):
+        if self.sink is not None:
+            if self.carry:
+                decoded = base64.b64decode(self.carry + b'=' * (-len(self.carry) % 4))
+                self.sink.write(decoded)
+                self.sink_bytes += len(decoded)
+            if self.sink_bytes:
+                self.finished.append((self.index, self.sink))
+            else:
+                self.sink.discard()
+        self.sink = None
+        self.carry = b''
+        self.index += 1
+    
+    def finish(self):
+        """Call after the last chunk; returns finished (index, sink) pairs"""
+        if self.state == 'value':
+            self.abort()
+            raise ValueError('Truncated image data')
+        return self.finished
+    
+    def abort(self):
+        """Discard every sink opened so far"""
+        if self.sink is not None:
+            self.sink.discard()
+            self.sink = None
+        for _, sink in self.finished:
+            sink.discard()
+        self.finished = []
+
+
+def probe_decode_memory(image_size=4 * 1024 * 1024, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Measure peak Python heap (tracemalloc) to turn one response into a file
+    
+    Builds a synthetic generateImage response around image_size random
+    bytes, then decodes it the buffered way (json + b64decode) and with
+    EncodedImageStream feeding a DiskWriter (queued chunks included).
+    
+    Returns:
+        dict: {'buffered': peak_bytes, 'streaming': peak_bytes}
+    """
+    import tempfile
+    import tracemalloc
+    
+    b64 = base64.b64encode(os.urandom(image_size)).decode('ascii')
+    body = json.dumps({
+        'imagePanels': [{'generatedImages': [{'encodedImage': b64, 'seed': 1}]}]
+    }).encode('utf-8')
+    del b64
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, 'probe.jpg')
+        
+        tracemalloc.start()
+        data = json.loads(body.decode('utf-8'))
+        img = data['imagePanels'][0]['generatedImages'][0]['encodedImage']
+        with open(out_path, 'wb') as f:
+            f.write(base64.b64decode(img))
+        results['buffered'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del data, img
+        
+        tracemalloc.start()
+        writer = DiskWriter()
+        writer.start()
+        stream = EncodedImageStream(lambda k: writer.open(out_path))
+        for start in range(0, len(body), chunk_size):
+            stream.feed(body[start:start + chunk_size])
+        for _, sink in stream.finish():
+            sink.commit()
+        writer.close()
+        results['streaming'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    
+    return results
+
+
+# ==================== JOB JOURNAL ====================
+
+class JobJournal:
+    """
+    Crash-safe record of every job cell in SQLite (APP_DIR/jobs.sqlite3)
+    
+    One row per (job, prompt row, image index) with its state
+    (pending/running/done/failed), seed, file path and last error.
+    A job is matched again on restart by a fingerprint of its prompts and
+    settings, so an interrupted run resumes with only the missing cells.
+    Jobs the user chose not to resume are marked 'abandoned' and never
+    offered again.
+    """
+    
+    KEEP_DAYS = 30
+    
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fingerprint TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                output_dir TEXT NOT NULL,
+                num_images INTEGER NOT NULL,
+                settings TEXT NOT NULL,
+                prompts TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_fingerprint ON jobs (fingerprint, status);
+            CREATE TABLE IF NOT EXISTS cells (
+                job_id INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                image_index INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                seed INTEGER,
+                path TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL,
+                PRIMARY KEY (job_id, row, image_index)
+            );
+        ''')
+        self.prune()
+    
+    @staticmethod
+    def fingerprint(prompts, num_images, output_dir, model_settings):
+        key = json.dumps([
+            prompts, num_images, os.path.abspath(output_dir),
+            model_settings.get('aspectRatio')
+        ], ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+    
+    def _execute(self, sql, params=(), many=False):
+        with self._lock:
+            cur = self.conn.executemany(sql, params) if many else self.conn.execute(sql, params)
+            rows = cur.fetchall()
+            self.conn.commit()
+            return rows
+    
+    def prune(self):
+        """Drop jobs not touched for KEEP_DAYS"""
+        cutoff = time.time() - self.KEEP_DAYS * 86400
+        self._execute('DELETE FROM cells WHERE job_id IN (SELECT id FROM jobs WHERE updated < ?)', (cutoff,))
+        self._execute('DELETE FROM jobs WHERE updated < ?', (cutoff,))
+    
+    def create_job(self, prompts, num_images, output_dir, model_settings):
+        """Start a new job with every cell pending; returns job_id"""
+        now = time.time()
+        fp = self.fingerprint(prompts, num_images, output_dir, model_settings)
+        with self._lock:
+            cur = self.conn.execute(
+                'INSERT INTO jobs (fingerprint, status, created, updated, output_dir, '
+                'num_images, settings, prompts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (fp, 'running', now, now, os.path.abspath(output_dir), num_images,
+                 json.dumps(model_settings), json.dumps(prompts, ensure_ascii=False))
+            )
+            job_id = cur.lastrowid
+            self.conn.executemany(
+                'INSERT INTO cells (job_id, row, image_index, state, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((job_id, r, i, 'pending', now)
+                 for r in range(len(prompts)) for i in range(num_images))
+            )
+            self.conn.commit()
+        return job_id
+    
+    def find_resumable(self, prompts, num_images, output_dir, model_settings):
+        """Most recent unfinished job with the same prompts/settings, or None"""
+        fp = self.fingerprint(prompts, num_images, output_dir, model_settings)
+        rows = self._execute(
+            'SELECT id FROM jobs WHERE fingerprint = ? '
+            "AND status NOT IN ('done', 'abandoned') ORDER BY updated DESC LIMIT 1", (fp,)
+        )
+        return rows[0][0] if rows else None
+    
+    def resume_job(self, job_id):
+        self._execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                      (time.time(), job_id))
+    
+    def abandon_job(self, job_id):
+        """Drop a job from resume offers (declined, or replaced by a new run)"""
+        self._execute("UPDATE jobs SET status = 'abandoned', updated = ? WHERE id = ?",
+                      (time.time(), job_id))
+    
+    def done_cells(self, job_id):
+        """[(row, image_index, path)] for finished cells whose file still exists"""
+        rows = self._execute(
+            "SELECT row, image_index, path FROM cells WHERE job_id = ? AND state = 'done'",
+            (job_id,)
+        )
+        return [(r, i, p) for r, i, p in rows if p and os.path.exists(p)]
+    
+    def missing_cells(self, job_id):
+        """{row: [image_index, ...]} still to generate (not done, or file gone)"""
+        rows = self._execute(
+            'SELECT row, image_index, state, path FROM cells WHERE job_id = ? '
+            'ORDER BY row, image_index', (job_id,)
+        )
+        missing = {}
+        for r, i, state, path in rows:
+            if state != 'done' or not path or not os.path.exists(path):
+                missing.setdefault(r, []).append(i)
+        return missing
+    
+    def mark_started(self, job_id, row, indices, seed):
+        now = time.time()
+        self._execute(
+            "UPDATE cells SET state = 'running', seed = ?, attempts = attempts + 1, "
+            'updated = ? WHERE job_id = ? AND row = ? AND image_index = ?',
+            [(seed, now, job_id, row, i) for i in indices], many=True
+        )
+    
+    def mark_done(self, job_id, row, index, path):
+        self._execute(
+            "UPDATE cells SET state = 'done', path = ?, error = NULL, updated = ? "
+            'WHERE job_id = ? AND row = ? AND image_index = ?',
+            (path, time.time(), job_id, row, index)
+        )
+    
+    def mark_failed(self, job_id, row, indices, error):
+        now = time.time()
+        self._execute(
+            "UPDATE cells SET state = 'failed', error = ?, updated = ? "
+            'WHERE job_id = ? AND row = ? AND image_index = ?',
+            [(error, now, job_id, row, i) for i in indices], many=True
+        )
+    
+    def finish_job(self, job_id):
+        """Close a run: 'done' if every cell is done, else 'stopped' (resumable)"""
+        status = 'stopped' if self.missing_cells(job_id) else 'done'
+        self._execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ?',
+                      (status, time.time(), job_id))
+        return status
+
+
+# ==================== GENERATION ENGINE ====================
+
+class GenerationEngine:
+    """
+    Generate images for queued rows with several requests in flight
+    
+    Each row task is split into one job per image column. Jobs run on a
+    thread pool; the rate controller's in-flight limit gates dispatch so
+    the queue is only drained as fast as slots free up (keeps
+    pause/stop/retry responsive), and its token bucket paces the sends.
+    
+    Progress is reported through optional callbacks:
+        on_started(row_idx, status_text)
+        on_success(row_idx, col_idx, file_path)
+        on_failed(row_idx, col_idx, error_msg)
+        on_rate_changed(requests_per_sec, in_flight_limit)
+        on_circuit_changed(state, cooldown_secs)
+    
+    Transient failures are retried per RetryPolicy; a shared CircuitBreaker
+    holds every worker while the endpoint is down.
+    
+    With candidates_per_request > 1 a row is split into chunks of that
+    many columns, each request asks for as many candidates as its chunk
+    still needs, and every image a response returns fills the next open
+    column of its chunk, so fewer round trips are needed per row. If the
+    backend returns fewer images than asked for, later rows are chunked
+    by the count it actually delivers, so their columns spread over
+    slots again instead of queueing behind one request at a time. If it
+    rejects a multi-candidate request outright, candidates are turned
+    off for the rest of the run and the request is retried for one.
+    
+    With a JobJournal + job_id every cell's seed, state, file path and
+    error are recorded as they happen, so a crashed run can be resumed.
+    """
+    
+    def __init__(self, task_queue, model_settings, output_dir, num_images,
+                 cookie_str, token, max_workers=DEFAULT_CONCURRENCY,
+                 candidates_per_request=1, journal=None, job_id=None,
+                 on_started=None, on_success=None, on_failed=None,
+                 on_rate_changed=None, on_circuit_changed=None):
+        self.task_queue = task_queue
+        self.model_settings = model_settings
+        self.output_dir = output_dir
+        self.num_images = num_images
+        self.cookie_str = cookie_str
+        self.access_token = token
+        self.max_workers = max(1, min(int(max_workers), MAX_CONCURRENCY))
+        self.candidates_per_request = max(1, int(candidates_per_request))
+        self.journal = journal
+        self.job_id = job_id
+        self.on_started = on_started
+        self.on_success = on_success
+        self.on_failed = on_failed
+        self.prepared_refs = {}  # path -> recipeMediaInput
+        self.failed_refs = {}  # path -> upload error (rows needing them fail)
+        self.uploader = None  # ReferenceUploader when uploading on demand
+        self.refreshed_refs = {}  # path -> Event set once its re-upload settled
+        self._refresh_lock = threading.Lock()
+        self.images_per_response = None  # most images one response has returned
+        self._candidates_lock = threading.Lock()
+        self.is_running = True
+        self.is_paused = False
+        self.rate = AdaptiveRateController(
+            self.max_workers, on_change=on_rate_changed
+        )
+        self.retry = RetryPolicy()
+        self.breaker = CircuitBreaker(on_change=on_circuit_changed)
+        self.writer = DiskWriter()
+        
+        # Keep one pooled socket per in-flight request (+ headroom for uploads)
+        self.client = get_http_client()
+        self.client.ensure_pool_size(self.max_workers + 2)
+    
+    def _emit(self, callback, *args):
+        if callback:
+            callback(*args)
+    
+    def _record(self, method, *args):
+        """Write to the job journal (never lets a journal error stop generation)"""
+        if self.journal is None or self.job_id is None:
+            return
+        try:
+            getattr(self.journal, method)(self.job_id, *args)
+        except sqlite3.Error as e:
+            print(f'[JOURNAL] {method} failed: {e}')
+    
+    def get_safe_filename(self, prompt):
+        """Create safe filename from prompt"""
+        slug = re.sub(r'[^\w\s-]', '', prompt).strip().replace(' ', '_')
+        slug = re.sub(r'_+', '_', slug)[:40]
+        return slug
+    
+    def wait_if_paused(self):
+        """Block while paused (returns early on stop)"""
+        while self.is_paused and self.is_running:
+            time.sleep(0.5)
+    
+    def should_continue(self):
+        return self.is_running
+    
+    def upload_on_demand(self, ref_data_list, on_uploaded=None, on_failed=None,
+                         keep_user_captions=True):
+        """
+        Upload references lazily instead of before the job
+        
+        A row is only dispatched once the references it selected are
+        uploaded; meanwhile rows whose references are ready (or that need
+        none) generate. References no row selects are never uploaded.
+        """
+        self.uploader = ReferenceUploader(
+            ref_data_list, self.cookie_str, self.access_token,
+            on_uploaded=on_uploaded, on_failed=on_failed,
+            keep_user_captions=keep_user_captions, should_continue=self.should_continue
+        )
+        self.prepared_refs = self.uploader.prepared
+        self.failed_refs = self.uploader.failures
+    
+    def requeue(self, item):
+        """Put a row back once its references finished uploading"""
+        if self.is_running:
+            self.task_queue.put(item)
+        self.task_queue.task_done()
+    
+    def unpack_task(self, item):
+        """Normalize a queue task to (row_idx, prompt, indices, ref_paths)"""
+        row_idx, prompt = item[0], item[1]
+        indices = item[2] if len(item) > 2 else None
+        ref_paths = item[3] if len(item) > 3 else None
+        if indices is None:
+            indices = range(self.num_images)
+        return row_idx, prompt, list(indices), ref_paths
+    
+    def select_recipe_inputs(self, ref_paths):
+        """Recipe inputs for a row (None = every prepared reference)"""
+        if ref_paths is None:
+            return list(self.prepared_refs.values())
+        return [self.prepared_refs[p] for p in ref_paths if p in self.prepared_refs]
+    
+    def missing_references(self, ref_paths):
+        """Upload errors of references this request needs but that failed to prepare"""
+        paths = list(self.failed_refs) if ref_paths is None else ref_paths
+        return [self.failed_refs[p] for p in paths if p in self.failed_refs]
+    
+    def refresh_references(self, ref_paths):
+        """
+        Re-upload a request's references after the server rejected their IDs
+        
+        Each path is refreshed at most once per run (bypassing the media
+        cache). Paths are claimed under the lock but uploaded outside it, so
+        other rows are not serialized behind the network; rows needing a
+        path another row is refreshing wait for that upload only. Returns
+        True if the request is worth sending again.
+        """
+        paths = list(self.prepared_refs) if ref_paths is None else ref_paths
+        claimed, waiting = [], []
+        with self._refresh_lock:
+            for path in paths:
+                if path not in self.prepared_refs:
+                    continue
+                if path in self.refreshed_refs:
+                    waiting.append(self.refreshed_refs[path])
+                else:
+                    self.refreshed_refs[path] = threading.Event()
+                    claimed.append(path)
+        
+        ok = True
+        for path in claimed:
+            try:
+                ok = self._reupload_reference(path) and ok
+            finally:
+                self.refreshed_refs[path].set()
+        
+        # Another row is (or was) refreshing these; retry with the new IDs
+        for done in waiting:
+            done.wait()
+        return ok and bool(claimed or waiting)
+    
+    def _reupload_reference(self, path):
+        """
+        Upload one reference again and publish its new media ID, to the
+        engine and through the uploader's on_uploaded (so the GUI slot and
+        the library stop handing out the expired one)
+        """
+        ref = self.prepared_refs[path]
+        media = ref['mediaInput']
+        cache = get_media_cache()
+        if cache:
+            cache.invalidate_media(media['mediaGenerationId'])
+        mid, _, err = upload_image_static(
+            path, media['mediaCategory'], self.cookie_str, self.access_token,
+            use_cache=False
+        )
+        if not mid:
+            print(f'[CACHE] Re-upload failed {os.path.basename(path)}: {err}')
+            return False
+        print(f'[CACHE] Stale media ID replaced for {os.path.basename(path)}')
+        with self._refresh_lock:
+            self.prepared_refs[path] = {
+                'caption': ref['caption'],
+                'mediaInput': dict(media, mediaGenerationId=mid)
+            }
+        if self.uploader and self.uploader.on_uploaded:
+            self.uploader.on_uploaded(path, mid, ref['caption'])
+        return True
+    
+    def build_request(self, prompt, ref_paths=None, count=1):
+        """Build (url, headers, payload) for one request asking for count images"""
+        sess_id = f';{int(datetime.now().timestamp() * 1000)}'
+        req_headers = self.client.headers_for(
+            'sandbox', self.cookie_str, self.access_token
+        )
+        
+        random_seed = random.randint(1, 2147483647)
+        recipe_inputs = self.select_recipe_inputs(ref_paths)
+        
+        # Choose endpoint and payload based on this row's references
+        if recipe_inputs:
+            target_url = 'https://aisandbox-pa.googleapis.com/v1/whisk:runImageRecipe'
+            settings = self.model_settings.copy()
+            
+            # Model selection based on ref count
+            if len(recipe_inputs) == 1:
+                settings['imageModel'] = 'GEM_PIX'
+            else:
+                settings['imageModel'] = 'R2I'
+            
+            payload = {
+                'clientContext': {
+                    'workflowId': '',
+                    'tool': 'BACKBONE',
+                    'sessionId': sess_id
+                },
+                'imageModelSettings': settings,
+                'userInstruction': prompt,
+                'recipeMediaInputs': recipe_inputs,
+                'seed': random_seed
+            }
+        else:
+            target_url = 'https://aisandbox-pa.googleapis.com/v1/whisk:generateImage'
+            payload = {
+                'clientContext': {
+                    'workflowId': '',
+                    'tool': 'BACKBONE',
+                    'sessionId': sess_id
+                },
+                'imageModelSettings': self.model_settings,
+                'prompt': prompt,
+                'mediaCategory': 'MEDIA_CATEGORY_BOARD',
+                'seed': random_seed
+            }
+        
+        if count > 1:
+            payload['candidatesCount'] = count
+        
+        return target_url, req_headers, payload
+    
+    def send_request(self, target_url, req_headers, payload):
+        """One paced POST; returns (response, exception)"""
+        sent_at = time.monotonic()
+        try:
+            resp = self.client.post(
+                target_url,
+                headers=req_headers,
+                json=payload,
+                timeout=60,
+                stream=True
+            )
+        except requests.RequestException as e:
+            self.rate.record(None, time.monotonic() - sent_at)
+            return None, e
+        self.rate.record(resp.status_code, time.monotonic() - sent_at)
+        return resp, None
+    
+    def save_response(self, resp, row_idx, prompt, pending):
+        """
+        Stream images from a 200 response onto the row's pending columns
+        
+        Returns:
+            tuple: (saved, error_msg) where saved lists the image indices
+                   handed to the disk writer
+        """
+        safe_name = self.get_safe_filename(prompt)
+        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        def open_sink(k):
+            # Single-candidate mode keeps the old behavior (first image only)
+            if self.candidates_per_request <= 1 and k > 0:
+                return None
+            if k < len(pending):
+                fn = f'{row_idx+1}_{safe_name}_{ts}_{pending[k]+1}.jpg'
+            else:
+                # More candidates than open columns: keep them, unmapped
+                fn = f'{row_idx+1}_{safe_name}_{ts}_{pending[-1]+1}_extra{k - len(pending) + 1}.jpg'
+            return self.writer.open(os.path.join(self.output_dir, fn))
+        
+        stream = EncodedImageStream(open_sink)
+        try:
+            for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                stream.feed(chunk)
+            finished = stream.finish()
+        except Exception:
+            stream.abort()
+            raise
+        finally:
+            resp.close()
+        
+        if not finished:
+            return [], 'No image data' if stream.saw_panels else 'No panels'
+        if self.candidates_per_request > 1:
+            self.record_candidates(len(finished))
+        
+        # Hand the files to the writer; success is reported once durable
+        saved = []
+        for k, sink in finished:
+            if k < len(pending):
+                i = pending[k]
+                sink.commit(lambda path, err, i=i: self.on_image_written(row_idx, i, path, err))
+                saved.append(i)
+            else:
+                sink.commit(lambda path, err: self.on_extra_written(row_idx, path, err))
+        
+        return saved, None
+    
+    def record_candidates(self, count):
+        """Remember how many images the backend returns per request"""
+        with self._candidates_lock:
+            if self.images_per_response is None or count > self.images_per_response:
+                self.images_per_response = count
+    
+    def chunk_size(self):
+        """Columns per pool job: the requested count, capped by what responses deliver"""
+        with self._candidates_lock:
+            delivered = self.images_per_response
+        if delivered is None:
+            return self.candidates_per_request
+        return max(1, min(self.candidates_per_request, delivered))
+    
+    def rejects_candidates(self, resp):
+        """
+        Fall back to one image per request after a terminal 4xx to a
+        multi-candidate request (the backend may not accept candidatesCount);
+        returns True if the request should be sent again
+        """
+        if resp is None or not 400 <= resp.status_code < 500 or resp.status_code in (401, 403):
+            return False
+        with self._candidates_lock:
+            if self.candidates_per_request > 1:
+                print(f'[HTTP] {describe_http_error(resp)} for a multi-candidate request, '
+                      'falling back to one image per request')
+                self.candidates_per_request = 1
+        return True
+    
+    def on_extra_written(self, row_idx, path, err):
+        """Writer callback for candidates beyond the row's open columns"""
+        if path:
+            print(f'[SAVE] Row {row_idx+1}: extra candidate saved to {os.path.basename(path)}')
+        else:
+            print(f'[SAVE] Row {row_idx+1}: extra candidate failed: {err}')
+    
+    def on_image_written(self, row_idx, i, path, err):
+        """Writer callback: the image is on disk (or failed to get there)"""
+        if path:
+            self._record('mark_done', row_idx, i, path)
+            self._emit(self.on_success, row_idx, i + 1, path)
+        else:
+            err = f'Write error: {err}'[:80]
+            self._record('mark_failed', row_idx, [i], err)
+            self._emit(self.on_failed, row_idx, i + 1, err)
+    
+    def fail_pending(self, row_idx, pending, err):
+        self._record('mark_failed', row_idx, pending, err)
+        for i in pending:
+            self._emit(self.on_failed, row_idx, i + 1, err)
+    
+    def generate_images(self, row_idx, prompt, indices, ref_paths=None):
+        """
+        Fill a row's image columns, retrying transient failures
+        
+        Every request may return several candidates; they are mapped onto
+        the still-empty columns in order, and new requests are only sent
+        for the columns that remain.
+        """
+        pending = list(indices)
+        attempt = 0
+        refreshed = False
+        
+        missing = self.missing_references(ref_paths)
+        if missing:
+            self.fail_pending(row_idx, pending, missing[0][:80])
+            return
+        
+        granted = False  # a breaker grant not yet settled by record_*
+        try:
+            while pending and self.is_running:
+                if not self.breaker.wait_until_closed(self.should_continue):
+                    return
+                granted = True
+                if not self.rate.acquire_token(self.should_continue):
+                    return
+                
+                count = min(len(pending), self.candidates_per_request)
+                target_url, req_headers, payload = self.build_request(prompt, ref_paths, count)
+                self._record('mark_started', row_idx, pending, payload['seed'])
+                resp, exc = self.send_request(target_url, req_headers, payload)
+                
+                if not self.is_running:
+                    if resp is not None:
+                        resp.close()
+                    return
+                
+                if resp is not None and resp.status_code == 200:
+                    self.breaker.record_success()
+                    granted = False
+                    saved, err = self.save_response(resp, row_idx, prompt, pending)
+                    if not saved:
+                        self.fail_pending(row_idx, pending, err)
+                        return
+                    for i in saved:
+                        pending.remove(i)
+                    attempt = 0
+                    continue
+                
+                retryable, err = self.retry.classify(resp, exc)
+                if not retryable:
+                    # Endpoint is up, the request itself was rejected
+                    self.breaker.record_success()
+                    granted = False
+                    if (not refreshed and self.prepared_refs
+                            and self.retry.is_stale_media(resp)):
+                        # Cached media IDs may have expired server-side
+                        refreshed = True
+                        resp.close()
+                        if self.refresh_references(ref_paths):
+                            continue
+                    if count > 1 and self.rejects_candidates(resp):
+                        resp.close()
+                        continue
+                    self.fail_pending(row_idx, pending, err)
+                    return
+                
+                self.breaker.record_failure()
+                granted = False
+                attempt += 1
+                if attempt >= self.retry.max_attempts:
+                    self.fail_pending(row_idx, pending, err)
+                    return
+                
+                retry_after = self.retry.retry_after(resp)
+                if retry_after is not None and resp.status_code == 429:
+                    self.breaker.hold(retry_after)
+                delay = self.retry.backoff(attempt - 1, retry_after)
+                print(f'[RETRY] Row {row_idx+1} image {pending[0]+1}: {err}, '
+                      f'attempt {attempt+1}/{self.retry.max_attempts} in {delay:.1f}s')
+                self._emit(self.on_started, row_idx,
+                           f'{pending[0]+1}/{self.num_images} ↻{attempt} ({err})')
+                
+                deadline = time.monotonic() + delay
+                while self.is_running and time.monotonic() < deadline:
+                    time.sleep(min(0.5, deadline - time.monotonic()))
+        
+        except Exception as e:
+            self.fail_pending(row_idx, pending, f'{type(e).__name__}: {e}'[:80])
+        finally:
+            if granted:
+                self.breaker.release_probe()
+    
+    def run_slot(self, row_idx, prompt, chunk, ref_paths, row_state):
+        """Pool job: one chunk of a row, then release the slot and settle the row"""
+        try:
+            self.wait_if_paused()
+            if self.is_running:
+                if len(chunk) == 1:
+                    status = f'{chunk[0]+1}/{self.num_images}'
+                else:
+                    status = f'{chunk[0]+1}-{chunk[-1]+1}/{self.num_images}'
+                self._emit(self.on_started, row_idx, status)
+                self.generate_images(row_idx, prompt, chunk, ref_paths)
+        finally:
+            self.rate.release_slot()
+            with row_state['lock']:
+                row_state['remaining'] -= 1
+                row_finished = row_state['remaining'] == 0
+            if row_finished:
+                self.task_queue.task_done()
+    
+    def run(self):
+        """Dispatch queued rows until stopped"""
+        self.writer.start()
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix='whisk-gen') as pool:
+            while self.is_running:
+                self.wait_if_paused()
+                
+                # Get task
+                try:
+                    item = self.task_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                
+                row_idx, prompt, indices, ref_paths = self.unpack_task(item)
+                if not indices:
+                    self.task_queue.task_done()
+                    continue
+                
+                # Rows waiting on uploads come back through requeue()
+                if self.uploader and not self.uploader.when_ready(
+                        ref_paths, lambda item=item: self.requeue(item)):
+                    continue
+                
+                # One job per chunk of columns (one column each in single mode)
+                size = self.chunk_size()
+                chunks = [indices[k:k + size] for k in range(0, len(indices), size)]
+                row_state = {'lock': threading.Lock(), 'remaining': len(chunks)}
+                
+                for n, chunk in enumerate(chunks):
+                    if not self.rate.acquire_slot(self.should_continue):
+                        # Stopped: settle the chunks we never submitted
+                        with row_state['lock']:
+                            row_state['remaining'] -= len(chunks) - n
+                            row_finished = row_state['remaining'] == 0
+                        if row_finished:
+                            self.task_queue.task_done()
+                        break
+                    pool.submit(self.run_slot, row_idx, prompt, chunk, ref_paths, row_state)
+        
+        if self.uploader:
+            self.uploader.shutdown(wait=False)
+        
+        # Every file handed over so far becomes durable before we report done
+        self.writer.close()
+        print(f'[HTTP] {self.client.stats.summary()}')
+    
+    def stop(self):
+        self.is_running = False
+    
+    def pause(self):
+        self.is_paused = True
+    
+    def resume(self):
+        self.is_paused = False